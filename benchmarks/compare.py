@@ -0,0 +1,68 @@
+"""Compare two benchmarks/run.py result files.
+
+    python benchmarks/compare.py benchmarks/results/abc1234.json benchmarks/results/def5678.json
+
+Prints the change in µs per page and peak memory of every benchmark and exits
+with status 1 when a benchmark got slower than --threshold or its output no
+longer matches the reference parsers.
+"""
+
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def change(old, new):
+    return (new - old) / old if old else 0.0
+
+
+def compare(old, new, threshold):
+    """Print the comparison and return the names of the failing benchmarks."""
+    failing = []
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    print(f"{'benchmark':40} {'old µs':>10} {'new µs':>10} {'change':>8} {'old KiB':>9} {'new KiB':>9} {'change':>8}")
+    for name, result in new["benchmarks"].items():
+        before = old["benchmarks"].get(name)
+        if before is None:
+            print(f"{name:40} {'':>10} {result['us_per_page']:>10.1f} {'new':>8}")
+            continue
+        speed = change(before["us_per_page"], result["us_per_page"])
+        memory = change(before["peak_kib"], result["peak_kib"])
+        flags = []
+        if speed > threshold:
+            flags.append("SLOWER")
+        if not result["matches_reference"]:
+            flags.append("MISMATCH")
+        if flags:
+            failing.append(name)
+        print(
+            f"{name:40} {before['us_per_page']:>10.1f} {result['us_per_page']:>10.1f} {speed:>+8.1%} "
+            f"{before['peak_kib']:>9.1f} {result['peak_kib']:>9.1f} {memory:>+8.1%} {' '.join(flags)}"
+        )
+    for name in sorted(old["benchmarks"].keys() - new["benchmarks"].keys()):
+        print(f"{name:40} missing from the new results")
+    return failing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold", type=float, default=0.10, help="slowdown that counts as a regression (default: 0.10 = 10%%)"
+    )
+    args = parser.parse_args()
+
+    failing = compare(load(args.old), load(args.new), args.threshold)
+    if failing:
+        print(f"{len(failing)} benchmarks regressed or changed output: {', '.join(failing)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Build the HTML fixtures used by benchmarks/run.py.
+
+By default the fixtures are generated: one list page per list spider and one
+detail page per detail spider, shaped like the tanba.kezekte.kz pages (guid-*
+table, pagination widget, navigation, scripts and a long footer). With
+--record the same pages are downloaded from the live registry instead:
+
+    python benchmarks/fixtures.py            # synthetic fixtures
+    python benchmarks/fixtures.py --record   # real pages
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import re
+import sys
+import urllib.request
+from urllib.parse import urljoin
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SITE = "https://tanba.kezekte.kz/ru/reestr-tanba-public/"
+ROWS_PER_PAGE = 50
+LAST_PAGE = 120
+
+REGIONS = ["г. Алматы", "г. Астана", "г. Шымкент", "Карагандинская область", "Туркестанская область"]
+NAMES = ["Иванов Иван Иванович", "Ахметов Ерлан Серикович", "Ким Анна Викторовна", "Сейткали Айгерим"]
+ORGS = ["ТОО \"Альфа Вет\"", "ИП \"Бета\"", "КГП \"Гамма-Сервис\"", "ТОО «Дельта & Ко»"]
+
+# List spider -> (path on the site, table headers, whether rows link to a detail page)
+LIST_PAGES = {
+    "animals": ("animal/list", ["№", "ИИН/БИН владельца", "Вид животного", "Пол", "Дата рождения", "Идентификационный номер", "Регион"], False),
+    "capturecert": ("capturecert/list", ["№", "Наименование организации", "БИН", "Номер разрешения", "Дата выдачи", "Регион"], True),
+    "inspector_cert_public": ("inspector-cert-public/list", ["№", "ФИО", "Номер удостоверения", "Дата выдачи", "Срок действия", "Регион"], True),
+    "kinolog": ("kinolog/list", ["№", "ФИО", "Организация", "Номер сертификата", "Дата выдачи", "Регион"], False),
+    "mark_factory": ("mark-factory/list", ["№", "Наименование организации", "БИН", "Адрес", "Дата регистрации", "Регион"], True),
+    "place": ("place", ["№", "Наименование", "Тип", "Адрес", "Вместимость", "Регион"], False),
+    "services": ("services/list", ["№", "Наименование организации", "БИН", "Вид услуги", "Адрес", "Регион"], True),
+    "vetclinic": ("vetclinic/list", ["№", "Наименование", "БИН", "Адрес", "Телефон", "Регион"], False),
+}
+
+# Detail spider -> list spider whose first Link it is recorded from
+DETAIL_PAGES = {
+    "capturecert_view": "capturecert",
+    "services_view": "services",
+    "factory_view": "mark_factory",
+}
+
+
+def cell(r, header, row_id):
+    """A plausible value for a column, with the markup noise the site has."""
+    if header == "№":
+        return str(row_id)
+    if "Дата" in header or "Срок" in header:
+        return f" {r.randint(1, 28):02d}.{r.randint(1, 12):02d}.20{r.randint(10, 24)} "
+    if header in ("БИН", "ИИН/БИН владельца"):
+        return f"{r.randint(10 ** 11, 10 ** 12 - 1)}"
+    if header == "Регион":
+        return f'<span class="badge badge-soft">{r.choice(REGIONS)}</span>'
+    if header == "ФИО":
+        return r.choice(NAMES)
+    if "Наименование" in header or header == "Организация":
+        return r.choice(ORGS).replace('"', "&quot;") + "&nbsp;"
+    if header == "Адрес":
+        return f"{r.choice(REGIONS)}, ул. Абая, д.&nbsp;{r.randint(1, 200)}<br>кв. {r.randint(1, 90)}"
+    if header in ("Пол",):
+        return r.choice(["Самец", "Самка"])
+    if header in ("Вместимость",):
+        return str(r.randint(5, 500))
+    return f"{header[:3].upper()}-{r.randint(10000, 99999)}"
+
+
+def page_shell(title, content):
+    nav = "".join(f'<li class="nav-item"><a class="nav-link" href="/ru/{i}">Раздел {i}</a></li>' for i in range(12))
+    footer = "<p>Министерство сельского хозяйства Республики Казахстан. Все права защищены.</p>" * 120
+    return f"""<!DOCTYPE html>
+<html lang="ru"><head><meta charset="utf-8"><title>{title}</title>
+<link rel="stylesheet" href="/css/app.css">
+<script>window.config = {{"locale": "ru", "csrf": "4f1c2a9e", "tables": {{"pageLength": 50}}}};</script>
+</head>
+<body><nav class="navbar navbar-expand-lg"><ul class="navbar-nav">{nav}</ul></nav>
+<div class="container-fluid"><div class="row"><div class="col-12">
+{content}
+</div></div></div>
+<footer class="footer">{footer}</footer>
+<script src="/js/vendor.js"></script><script src="/js/app.js"></script>
+</body></html>"""
+
+
+def pagination(page, last_page, show_last=True):
+    """Pagination widget: «, the first page, pages around `page`, the last page, »."""
+    shown = {1, last_page} if show_last else {1}
+    shown.update(range(max(1, page - 2), min(last_page, page + 2) + 1))
+    items = [f'<li class="page-item"><a class="page-link" href="?p={max(1, page - 1)}">«</a></li>']
+    previous = 0
+    for p in sorted(shown):
+        if p > previous + 1:
+            items.append('<li class="page-item disabled"><span class="page-link">…</span></li>')
+        active = " active" if p == page else ""
+        items.append(f'<li class="page-item{active}"><a class="page-link" href="?p={p}">{p}</a></li>')
+        previous = p
+    if not show_last and previous < last_page:
+        items.append('<li class="page-item disabled"><span class="page-link">…</span></li>')
+    items.append(f'<li class="page-item"><a class="page-link" href="?p={min(last_page, page + 1)}">»</a></li>')
+    return f'<ul class="pagination pagination-rounded">{"".join(items)}</ul>'
+
+
+def list_row(name, row_id):
+    """One table row, the same for a given registry and row id."""
+    path, headers, with_links = LIST_PAGES[name]
+    r = random.Random(f"{name}-{row_id}")
+    cells = [cell(r, header, row_id) for header in headers]
+    if with_links:
+        cells[0] = f'<a href="/ru/reestr-tanba-public/{path.split("/")[0]}/view/{row_id}" class="text-primary"> {row_id} </a>'
+    return "<tr>" + "".join(f"<td>{c}</td>" for c in cells) + "</tr>"
+
+
+def list_page(name, row_ids=None, page=1, last_page=LAST_PAGE, show_last=True):
+    """A registry list page with the given rows (by default a first page of ROWS_PER_PAGE rows)."""
+    _, headers, _ = LIST_PAGES[name]
+    if row_ids is None:
+        row_ids = range(1000 + ROWS_PER_PAGE, 1000, -1)
+    rows = "\n".join(list_row(name, row_id) for row_id in row_ids)
+    head = "".join(f"<th>{h}</th>" for h in headers)
+    guid = hashlib.md5(name.encode()).hexdigest()[:16]
+    content = f"""<div class="card"><div class="card-body">
+<h4 class="header-title">Реестр</h4>
+<div class="table-responsive"><table class="table table-striped" id="guid-{guid}">
+<thead><tr>{head}</tr></thead>
+<tbody>
+{rows}
+</tbody></table></div>
+{pagination(page, last_page, show_last)}
+</div></div>"""
+    return page_shell("Реестр", content)
+
+
+def capturecert_view_page(row_id=1000):
+    content = f"""<div class="card"><div class="card-body">
+<h2> ТОО "Альфа Вет" </h2>
+<h4>Разрешение на отлов безнадзорных животных</h4>
+<h3> № KZ12VKT{row_id:08d} </h3>
+<p class="font-16">Иванов Иван Иванович, Ахметов Ерлан Серикович, Ким Анна Викторовна</p>
+<p class="font-16">12.03.2023, 15.03.2023</p>
+<p class="font-16">12.03.2024, 15.03.2024</p>
+</div></div>"""
+    return page_shell("Разрешение", content)
+
+
+def services_view_page(row_id=1000):
+    fields = [
+        ("Наименование", "ТОО \"Альфа Вет\""),
+        ("БИН", f"{10 ** 11 + row_id}"),
+        ("Вид услуги", "Отлов, транспортировка и&nbsp;содержание животных"),
+        ("Адрес", "г. Алматы, ул. Абая, д.&nbsp;10"),
+        ("Телефон", "+7&nbsp;(727)&nbsp;123-45-67"),
+        ("Дата регистрации", "01.02.2022"),
+    ]
+    rows = "".join(
+        f'<div class="row"><div class="col-md-3"><b>{label}</b></div><div class="col-md-9"> {value} </div></div>'
+        for label, value in fields
+    )
+    return page_shell("Услуги", f'<div class="card"><div class="card-body">{rows}</div></div>')
+
+
+def factory_view_page(row_id=1000):
+    tables = []
+    for t, title in enumerate(["Выданные средства идентификации", "Заказанные средства идентификации"]):
+        r = random.Random(f"{row_id}-{t}")
+        body = "".join(
+            f"<tr><td>{kind}</td><td>{r.randint(10, 5000)}</td></tr>"
+            for kind in ["КРС", "МРС", "Лошади", "Верблюды", "Свиньи", "Собаки", "Кошки"]
+        )
+        tables.append(f'<p class="mt-3">{title}</p><table class="table table-sm"><tr><th>Вид</th><th>Количество</th></tr>{body}</table>')
+    content = f"""<div class="card"><div class="card-body">
+<div class="text-center text-uppercase mt-3 font-18"><b> ТОО "Бирка Завод" </b></div>
+<h5>Адрес</h5><address> г. Астана, пр. Республики, 24 </address>
+<h5>Контакты</h5><address> +7 (7172) 55-66-77, info@birka.kz </address>
+<h5>Данные организации</h5><address>
+  Дата регистрации: 05.06.2019
+  Тип: Производитель
+  БИН: {10 ** 11 + row_id}
+</address>
+{''.join(tables)}
+</div></div>"""
+    return page_shell("Изготовитель", content)
+
+
+DETAIL_BUILDERS = {
+    "capturecert_view": capturecert_view_page,
+    "services_view": services_view_page,
+    "factory_view": factory_view_page,
+}
+
+
+def fixture_path(name):
+    return os.path.join(FIXTURES_DIR, f"{name}.html")
+
+
+def generate():
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    pages = {name: list_page(name) for name in LIST_PAGES}
+    pages.update({name: build() for name, build in DETAIL_BUILDERS.items()})
+    for name, page in pages.items():
+        with open(fixture_path(name), "w", encoding="utf-8") as f:
+            f.write(page)
+        print(f"wrote {fixture_path(name)}")
+
+
+def fetch(url):
+    request = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0 (tanba-scraper benchmarks)"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read()
+
+
+def record():
+    """Download page 1 of every list registry and the first detail page of each detail registry."""
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for name, (path, _, _) in LIST_PAGES.items():
+        body = fetch(urljoin(SITE, path) + "?p=1")
+        with open(fixture_path(name), "wb") as f:
+            f.write(body)
+        print(f"recorded {fixture_path(name)}")
+    for name, list_name in DETAIL_PAGES.items():
+        with open(fixture_path(list_name), "rb") as f:
+            link = re.search(rb'<table[^>]*id="guid-.*?<a[^>]*href="([^"]+)"', f.read(), re.S)
+        if link is None:
+            print(f"no detail link on the {list_name} page, keeping the {name} fixture", file=sys.stderr)
+            continue
+        body = fetch(urljoin(SITE, link.group(1).decode()))
+        with open(fixture_path(name), "wb") as f:
+            f.write(body)
+        print(f"recorded {fixture_path(name)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--record", action="store_true", help="download the pages from tanba.kezekte.kz")
+    args = parser.parse_args()
+    record() if args.record else generate()
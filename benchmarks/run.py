@@ -0,0 +1,200 @@
+"""Offline parser benchmarks on the pages in benchmarks/fixtures.
+
+Times every list spider's `parse` and `parse_page`, every detail spider's
+`parse_detail` and `new_parsing.scrape_page` on saved pages, without any
+network. Each result has the µs per page, rows per second and peak memory of
+one call (Python allocations traced by tracemalloc, lxml's own buffers aren't
+included), and whether the output matches the BeautifulSoup parsers in
+benchmarks/reference.py. Results are written as JSON for benchmarks/compare.py:
+
+    python benchmarks/run.py                       # all benchmarks
+    python benchmarks/run.py -k capturecert -o new.json
+    python benchmarks/compare.py old.json new.json
+
+Exits with status 1 when any parser's output differs from the reference.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)  # Run from anywhere as a plain script
+os.environ.setdefault("SCRAPY_SETTINGS_MODULE", "tanba_scraper.settings")
+
+import lxml.etree
+import scrapy
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.reactor import install_reactor
+from scrapy.utils.test import get_crawler
+
+from benchmarks import reference
+from benchmarks.fixtures import DETAIL_PAGES, LIST_PAGES, fixture_path
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Only the parsing is measured: no state files, dedup, drift check, probing
+# or detail requests.
+SPIDER_SETTINGS = {
+    "TANBA_STATE_DIR": None,
+    "TANBA_DEDUP": False,
+    "TANBA_DRIFT_CHECK": False,
+    "TANBA_PAGE_SIZE_PROBE": False,
+    "TANBA_FOLLOW_DETAILS": False,
+}
+
+
+def git(*args):
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_fixture(name):
+    with open(fixture_path(name), "rb") as f:
+        return f.read()
+
+
+def measure(call, repeat):
+    """Best time per call in seconds and peak traced memory of one call in bytes."""
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat, number)) / number
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def items_of(output):
+    return [dict(item) for item in output if isinstance(item, dict)]
+
+
+def make_spider(loader, settings, name):
+    spidercls = loader.load(name)
+    return spidercls.from_crawler(get_crawler(spidercls, settings))
+
+
+def list_benchmarks(loader, settings, names):
+    for name in names:
+        spider = make_spider(loader, settings, name)
+        url = spider.start_urls[0]
+        body = load_fixture(name)
+        response = HtmlResponse(url=url, body=body, encoding="utf-8", request=Request(url, meta={"page": 1}))
+        expected = reference.list_rows(body.decode("utf-8"), url, spider.with_links)
+        for callback in ("parse", "parse_page"):
+            call = getattr(spider, callback)
+            yield f"{name}.{callback}", lambda call=call, response=response: list(call(response)), expected
+
+
+def detail_benchmarks(loader, settings, names):
+    for name in names:
+        spider = make_spider(loader, settings, name)
+        url = f"https://tanba.kezekte.kz/ru/reestr-tanba-public/{name}/1000"
+        body = load_fixture(name)
+        response = HtmlResponse(url=url, body=body, encoding="utf-8", request=Request(url, meta={"url": url}))
+        expected = reference.DETAIL_PARSERS[name](body.decode("utf-8"), url)
+        yield f"{name}.parse_detail", lambda spider=spider, response=response: list(spider.parse_detail(response)), expected
+
+
+def new_parsing_benchmark():
+    import new_parsing
+
+    body = load_fixture("animals")
+
+    async def fetch_page(session, url, page, retries=3):
+        return body, "utf-8"
+
+    def call():
+        with contextlib.redirect_stdout(io.StringIO()):
+            data, titles = asyncio.run(new_parsing.scrape_page(None, 1))
+        return [dict(zip(titles, row)) for row in data]
+
+    new_parsing.fetch_page = fetch_page
+    expected = reference.list_rows(body.decode("utf-8"), new_parsing.BASE_URL + "1")
+    yield "new_parsing.scrape_page", call, expected
+
+
+def run(selected, repeat):
+    settings = get_project_settings()
+    install_reactor(settings["TWISTED_REACTOR"])  # Crawlers are checked against it
+    settings.update(SPIDER_SETTINGS)
+    settings = settings.copy_to_dict()
+    loader = SpiderLoader.from_settings(get_project_settings())
+
+    benchmarks = []
+    benchmarks.extend(list_benchmarks(loader, settings, LIST_PAGES))
+    benchmarks.extend(detail_benchmarks(loader, settings, DETAIL_PAGES))
+    benchmarks.extend(new_parsing_benchmark())
+
+    results = {}
+    logging.disable(logging.WARNING)  # "Total pages found" etc. on every call
+    try:
+        for name, call, expected in benchmarks:
+            if selected and not any(pattern in name for pattern in selected):
+                continue
+            items = items_of(call())
+            seconds, peak = measure(call, repeat)
+            results[name] = {
+                "rows": len(items),
+                "us_per_page": round(seconds * 1e6, 1),
+                "rows_per_sec": round(len(items) / seconds),
+                "peak_kib": round(peak / 1024, 1),
+                "matches_reference": items == expected,
+            }
+            result = results[name]
+            print(
+                f"{name:40} {result['us_per_page']:>10.1f} µs/page {result['rows_per_sec']:>9} rows/s "
+                f"{result['peak_kib']:>9.1f} KiB {'ok' if result['matches_reference'] else 'MISMATCH'}"
+            )
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline parser benchmarks")
+    parser.add_argument("-k", dest="selected", action="append", help="only benchmarks whose name contains this")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="timing runs per benchmark, the best one counts")
+    parser.add_argument("-o", "--output", help="results file (default: benchmarks/results/<commit>.json)")
+    args = parser.parse_args()
+
+    commit = git("rev-parse", "--short", "HEAD")
+    results = run(args.selected, args.repeat)
+    report = {
+        "commit": commit,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "scrapy": scrapy.__version__,
+        "lxml": ".".join(map(str, lxml.etree.LXML_VERSION)),
+        "machine": platform.machine(),
+        "benchmarks": results,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Results written to {output}")
+
+    if not all(result["matches_reference"] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Local stand-in for the tanba registry, for end-to-end load and fault tests.
+
+Serves every registry of benchmarks/fixtures.py with the site's markup: list
+pages with a guid-* table, pagination and Link columns, and detail pages.
+Registry size, response latency, 429/503 injection and rows inserted while a
+crawl runs are configurable, and the same seed gives the same run:
+
+    python benchmarks/server.py --rows 1000000 --latency 0.05 --error-rate 0.02
+    scrapy crawl animals -s TANBA_BASE_URL=http://127.0.0.1:8080 -s TANBA_STATE_DIR=state-local
+    python new_parsing.py --base-url http://127.0.0.1:8080
+
+Rows are listed newest first, so an insertion shifts every row after it to a
+later page, like on the live registry. GET /_stats returns the request and
+response counters, POST /_insert?registry=animals&rows=10 inserts rows now.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import (
+    LIST_PAGES,
+    ROWS_PER_PAGE,
+    capturecert_view_page,
+    factory_view_page,
+    list_page,
+    services_view_page,
+)
+
+PREFIX = "/ru/reestr-tanba-public/"
+
+# Detail markup served under each registry's /view/<id>
+DETAIL_MARKUP = {
+    "capturecert": capturecert_view_page,
+    "inspector_cert_public": capturecert_view_page,
+    "mark_factory": factory_view_page,
+    "services": services_view_page,
+}
+
+
+class Registry:
+    """Rows of one registry, ids 1..size listed newest first."""
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.path, _, self.with_links = LIST_PAGES[name]
+        self.size = rows
+        self.pending = 0.0  # fraction of a row waiting to be inserted
+
+    def row_ids(self, offset, count):
+        return range(self.size - offset, max(0, self.size - offset - count), -1)
+
+    def insert(self, rows):
+        self.size += rows
+
+
+class RegistryServer:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.registries = {name: Registry(name, args.rows) for name in LIST_PAGES}
+        self.by_path = {registry.path: registry for registry in self.registries.values()}
+        self.by_prefix = {registry.path.split("/")[0]: registry for registry in self.registries.values()}
+        self.stats = Counter()
+        self.in_flight = 0
+        self.started = time.monotonic()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/_stats", self.get_stats)
+        app.router.add_post("/_insert", self.post_insert)
+        app.router.add_get(PREFIX + "{path:.+}", self.handle)
+        app.on_startup.append(self.start_inserting)
+        return app
+
+    async def start_inserting(self, app):
+        if self.args.insert_rate > 0:
+            app["inserter"] = asyncio.create_task(self.insert_rows())
+
+    async def insert_rows(self):
+        """Insert rows at --insert-rate per second into every registry after --insert-after seconds."""
+        await asyncio.sleep(self.args.insert_after)
+        inserted, step = 0, 0.1
+        while not self.args.insert_max or inserted < self.args.insert_max:
+            await asyncio.sleep(step)
+            for registry in self.registries.values():
+                registry.pending += self.args.insert_rate * step
+                rows = int(registry.pending)
+                registry.pending -= rows
+                registry.insert(rows)
+            inserted += rows
+            self.stats["inserted"] += rows
+
+    def latency(self):
+        if self.args.latency <= 0:
+            return 0
+        return self.random.lognormvariate(math.log(self.args.latency), self.args.jitter)
+
+    def fault(self):
+        """Status to answer with instead of the page, or None."""
+        if self.args.max_in_flight and self.in_flight > self.args.max_in_flight:
+            return 503
+        if self.random.random() < self.args.error_rate:
+            return self.random.choice(self.args.error_status)
+        return None
+
+    async def handle(self, request):
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        try:
+            status = self.fault()
+            if status is not None:
+                self.stats[f"status_{status}"] += 1
+                return web.Response(status=status, text="Too many requests" if status == 429 else "Service unavailable")
+            # The page is rendered on arrival, the latency is the time it takes to reach the client
+            response = self.render(request)
+            await asyncio.sleep(self.latency())
+            self.stats[f"status_{response.status}"] += 1
+            return response
+        finally:
+            self.in_flight -= 1
+
+    def render(self, request):
+        path = request.match_info["path"]
+        registry = self.by_path.get(path)
+        if registry is not None:
+            return self.list_response(registry, request.query)
+        prefix, _, row_id = path.partition("/view/")
+        registry = self.by_prefix.get(prefix)
+        if registry is not None and registry.name in DETAIL_MARKUP and row_id.isdigit():
+            if 1 <= int(row_id) <= registry.size:
+                return web.Response(text=DETAIL_MARKUP[registry.name](int(row_id)), content_type="text/html")
+        return web.Response(status=404, text="Not found")
+
+    def list_response(self, registry, query):
+        page_size = ROWS_PER_PAGE
+        if self.args.page_size_param and query.get(self.args.page_size_param, "").isdigit():
+            page_size = max(1, min(int(query[self.args.page_size_param]), self.args.max_page_size))
+        try:
+            page = max(1, int(query.get("p", "1")))
+        except ValueError:
+            page = 1
+        last_page = max(1, math.ceil(registry.size / page_size))
+        # Pages past the end have an empty table, like the live site
+        row_ids = registry.row_ids((page - 1) * page_size, page_size)
+        body = list_page(registry.name, row_ids, min(page, last_page), last_page, show_last=not self.args.hide_last_page)
+        return web.Response(text=body, content_type="text/html")
+
+    async def get_stats(self, request):
+        stats = dict(self.stats)
+        stats["in_flight"] = self.in_flight
+        stats["uptime"] = round(time.monotonic() - self.started, 1)
+        stats["rows"] = {name: registry.size for name, registry in self.registries.items()}
+        return web.json_response(stats)
+
+    async def post_insert(self, request):
+        registry = self.registries.get(request.query.get("registry", ""))
+        if registry is None:
+            return web.json_response({"error": "unknown registry"}, status=404)
+        rows = int(request.query.get("rows", "1"))
+        registry.insert(rows)
+        self.stats["inserted"] += rows
+        return web.json_response({"registry": registry.name, "rows": registry.size})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the tanba registry")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--rows", type=int, default=10_000, help="rows in every registry")
+    parser.add_argument("--latency", type=float, default=0.0, help="median response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="sigma of the lognormal latency distribution")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with an error")
+    parser.add_argument(
+        "--error-status", type=lambda s: [int(x) for x in s.split(",")], default=[429, 503],
+        help="statuses of the injected errors, comma separated (default: 429,503)",
+    )
+    parser.add_argument("--max-in-flight", type=int, default=0, help="answer 503 above this many requests in flight")
+    parser.add_argument("--insert-rate", type=float, default=0.0, help="rows inserted per second into every registry")
+    parser.add_argument("--insert-after", type=float, default=0.0, help="seconds before insertions start")
+    parser.add_argument("--insert-max", type=int, default=0, help="stop after this many rows per registry (0: never)")
+    parser.add_argument("--page-size-param", default="per-page", help="query parameter setting the page size ('' for none)")
+    parser.add_argument("--max-page-size", type=int, default=500)
+    parser.add_argument("--hide-last-page", action="store_true", help="leave the last page out of the pagination")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the latency and error randomness")
+    args = parser.parse_args()
+
+    web.run_app(RegistryServer(args).app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
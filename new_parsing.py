@@ -1,150 +1,251 @@
-import aiohttp
-import asyncio
-import pandas as pd
-import random
-import time
-import logging
-from datetime import datetime 
-from bs4 import BeautifulSoup
-
-# Set up logging
-logging.basicConfig(filename="errors.log", level=logging.ERROR, format="%(asctime)s - %(levelname)s - %(message)s")
-
-# Set up headers to mimic real user behavior
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-}
-
-BASE_URL = "https://tanba.kezekte.kz/ru/reestr-tanba-public/animal/list?p="
-BATCH_SIZE = 20  # Number of pages to process in one batch
-
-parsing_started = datetime.now() 
-print("Parsing started at: ", parsing_started)
-logging.info("Started parsing", parsing_started)
-
-async def fetch_page(session, url, page, retries=3):
-    """Fetch a single page with retry logic."""
-    for attempt in range(retries):
-        try:
-            async with session.get(url, headers=HEADERS, timeout=10) as response:
-                if response.status == 200:
-                    return await response.text()
-                elif response.status in [429, 500, 503]:  # Rate limited or server issue
-                    wait_time = random.uniform(5, 15)
-                    logging.warning(f"Rate limited on page {page}. Retrying in {wait_time:.2f}s...")
-                    await asyncio.sleep(wait_time)
-                elif attempt == retries - 1:  # If it's the last retry attempt
-                    logging.warning(f"Final attempt failed for page {page}, waiting 30 seconds before skipping.")
-                    await asyncio.sleep(30)
-        except Exception as e:
-            logging.error(f"Error fetching page {page} (Attempt {attempt+1}/{retries}): {e}")
-        await asyncio.sleep(random.uniform(2, 10))  # Random delay before retry
-
-    logging.error(f"Failed to fetch page {page} after {retries} attempts.")
-    return None
-
-
-
-async def get_total_pages(session):
-    """Extracts the total number of pages dynamically."""
-    html = await fetch_page(session, BASE_URL + "1", 1)
-    if not html:
-        logging.error("Failed to fetch first page. Cannot determine total pages.")
-        return 1
-
-    soup = BeautifulSoup(html, "html.parser")
-    pagination = soup.find("ul", class_="pagination")
-
-    if not pagination:
-        logging.error("Pagination not found. Defaulting to 1 page.")
-        return 1
-
-    try:
-        last_page_link = pagination.find_all("a", class_="page-link")[-2]
-        total_pages = int(last_page_link.text.strip())
-        print(f"✅ Found total pages: {total_pages}")  # DEBUG PRINT
-        return total_pages
-    except Exception as e:
-        logging.error(f"Error extracting total pages: {e}")
-        return 1
-
-
-async def scrape_page(session, page, amount_of_batches):
-    """Scrape data from a single page."""
-    url = BASE_URL + str(page)
-    html = await fetch_page(session, url, page)
-
-    if not html:
-        logging.error(f"Batch No.{amount_of_batches}. Failed to fetch page {page}. Skipping...")
-        return [], None  # Skip if page fails
-
-    soup = BeautifulSoup(html, "html.parser")
-    table = soup.find("table", {"id": lambda x: x and x.startswith("guid-")})
-
-    if not table:
-        logging.warning(f"Batch No.{amount_of_batches}. No table found on page {page}. Check if the structure has changed!")
-        return [], None
-
-    titles = [th.text.strip() for th in table.find_all("th")]
-    rows = table.find_all("tr")[1:]  # Skip first row (headers)
-    data = [[td.text.strip() for td in row.find_all("td")] for row in rows]
-
-    print(f"✅ Scraped {len(data)} records from page {page}")  
-    return data, titles
-
-
-async def scrape_batch(session, pages, amount_of_batches):
-    """Scrape a batch of pages concurrently."""
-    tasks = [scrape_page(session, page, amount_of_batches) for page in pages]
-    results = await asyncio.gather(*tasks)
-
-    all_data = []
-    headers = None
-    for data, cols in results:
-        if data:
-            all_data.extend(data)
-        if cols and not headers:
-            headers = cols
-    
-    return all_data, headers
-
-
-async def scrape_all_pages(output_file="animal_records_2.csv"):
-    """Scrape all pages using async requests in batches and save data."""
-    async with aiohttp.ClientSession() as session:
-        total_pages = await get_total_pages(session)
-        all_data = []
-        table_titles = None
-        amount_of_batches = 1
-
-        # Process pages in batches
-        for start in range(1, total_pages + 1, BATCH_SIZE):
-            batch = list(range(start, min(start + BATCH_SIZE, total_pages + 1)))
-            print(f"🔄 Scraping batch number {amount_of_batches} {batch}...")
-
-            data, headers = await scrape_batch(session, batch, amount_of_batches)
-
-            if data:
-                all_data.extend(data)
-            if headers and not table_titles:
-                table_titles = headers
-
-            # Save after each batch
-            if all_data:
-                df = pd.DataFrame(all_data, columns=table_titles)
-                df.to_csv(output_file, index=False, mode='a', header=not (start > 1), encoding="utf-8-sig")
-                print(f"💾 Saved {len(all_data)} records to file.")
-                all_data = []  # Reset memory
-
-            amount_of_batches += 1
-
-            # Randomized delay between batches
-            await asyncio.sleep(random.uniform(3, 5))
-
-    parsing_ended = datetime.now() 
-    time_difference = parsing_started - parsing_ended
-    print(f"Scraping started at: {parsing_started}\nScraping completed at: {parsing_ended}\nTotal execution time: {time_difference}\nData saved to {output_file}")
-
-
-# Run the scraper
-asyncio.run(scrape_all_pages("animal_records_2.csv"))
+import aiohttp
+import argparse
+import asyncio
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime 
+
+from tanba_scraper.extractors import extract_last_page, extract_table
+from tanba_scraper.state import PageLedger
+from tanba_scraper.throttle import AimdController, AsyncAimdLimiter
+from tanba_scraper.writers import RowWriter, SchemaError
+
+# Set up logging
+logging.basicConfig(filename="errors.log", level=logging.ERROR, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Set up headers to mimic real user behavior
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
+}
+
+SITE_URL = "https://tanba.kezekte.kz"
+LIST_PATH = "/ru/reestr-tanba-public/animal/list?p="
+BASE_URL = SITE_URL + LIST_PATH
+WORKERS = 20  # Number of fetch workers, i.e. the most requests in flight
+QUEUE_SIZE = WORKERS * 2  # Pages waiting for a free worker
+MAX_AHEAD = WORKERS * 5  # Pages handed out past the oldest page not written yet
+FLUSH_ROWS = 5000  # Buffered rows that trigger a write to the file
+FLUSH_SECONDS = 30  # Longest time rows wait in the buffer
+PARQUET_FILE = None  # Also write Parquet row groups to this file (needs pyarrow)
+
+# Where pages are parsed: "process" ships the raw bytes to a process pool so
+# parsing never blocks the event loop and uses every core, "thread" uses a
+# thread pool (lxml releases the GIL while parsing), None parses on the loop.
+PARSE_EXECUTOR = "process"
+PARSE_WORKERS = os.cpu_count() or 1
+PARSES_IN_FLIGHT = PARSE_WORKERS * 2  # Fetched pages waiting for or in a parser
+
+# Adaptive limit on requests in flight, grows while the site responds well
+# and halves on 429/503, errors or slow responses
+limiter = AsyncAimdLimiter(AimdController(start=4, maximum=WORKERS))
+RETRY_BACKOFF = 1  # Seconds before a retry, times the attempt number
+
+async def fetch_page(session, url, page, retries=3):
+    """Fetch a single page with retry logic."""
+    for attempt in range(retries):
+        await limiter.acquire()
+        started = time.monotonic()
+        status = latency = None
+        try:
+            async with session.get(url, headers=HEADERS, timeout=10) as response:
+                status, latency = response.status, time.monotonic() - started
+                if response.status == 200:
+                    return await response.read(), response.charset or "utf-8"
+                elif response.status in [429, 500, 503]:  # Rate limited or server issue
+                    # The limiter lowers the concurrency window, so only retry after a short pause
+                    logging.warning(f"Rate limited on page {page}. Concurrency window is now {limiter.controller.limit}.")
+        except Exception as e:
+            logging.error(f"Error fetching page {page} (Attempt {attempt+1}/{retries}): {e}")
+        finally:
+            limiter.release(status, latency)
+        if attempt < retries - 1:
+            await asyncio.sleep(RETRY_BACKOFF * (attempt + 1))
+
+    logging.error(f"Failed to fetch page {page} after {retries} attempts.")
+    return None
+
+
+
+async def get_total_pages(session):
+    """Extracts the total number of pages dynamically."""
+    page = await fetch_page(session, BASE_URL + "1", 1)
+    if not page:
+        logging.error("Failed to fetch first page. Cannot determine total pages.")
+        return 1
+
+    total_pages = extract_last_page(*page)
+    print(f"✅ Found total pages: {total_pages}")  # DEBUG PRINT
+    return total_pages
+
+
+parse_pool = None
+parse_slots = None
+
+
+def start_parse_pool():
+    """Create the parser pool selected by PARSE_EXECUTOR (None to parse on the loop)."""
+    global parse_pool, parse_slots
+    parse_slots = asyncio.Semaphore(PARSES_IN_FLIGHT)
+    if PARSE_EXECUTOR == "process":
+        # Spawned like ParsePoolMiddleware's, not forked from the running event loop
+        parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    elif PARSE_EXECUTOR == "thread":
+        parse_pool = ThreadPoolExecutor(max_workers=PARSE_WORKERS)
+    return parse_pool
+
+
+async def parse_table(body, encoding):
+    """Extract the registry table in the parser pool, waiting for a free slot."""
+    if parse_pool is None:
+        return extract_table(body, encoding)
+    async with parse_slots:
+        return await asyncio.get_running_loop().run_in_executor(parse_pool, extract_table, body, encoding)
+
+
+async def scrape_page(session, page):
+    """Scrape data from a single page."""
+    url = BASE_URL + str(page)
+    fetched = await fetch_page(session, url, page)
+
+    if not fetched:
+        logging.error(f"Failed to fetch page {page}. Skipping...")
+        return [], None  # Skip if page fails
+
+    # Only the guid-* table is parsed, the rest of the page is skipped
+    body, encoding = fetched
+    table = await parse_table(body, encoding)
+
+    if not table:
+        logging.warning(f"No table found on page {page}. Check if the structure has changed!")
+        return [], None
+
+    titles, data = table
+
+    print(f"✅ Scraped {len(data)} records from page {page}")  
+    return data, titles
+
+
+async def produce_pages(page_queue, pages, window):
+    """Queue every page number, then one stop marker per worker.
+
+    A page is only handed out once `window` has room for it, so a slow page
+    holds back at most MAX_AHEAD later pages in the writer's buffer.
+    """
+    for page in pages:
+        await window.acquire()
+        await page_queue.put(page)
+    for _ in range(WORKERS):
+        await page_queue.put(None)
+
+
+async def fetch_worker(session, page_queue, result_queue, ledger):
+    """Take pages off the queue until the stop marker and pass on their rows."""
+    while True:
+        page = await page_queue.get()
+        if page is None:
+            return
+        ledger.mark(page, "in_flight")
+        data, titles = await scrape_page(session, page)
+        await result_queue.put((page, data, titles))
+
+
+async def write_pages(result_queue, pages, writer, ledger, window):
+    """Write scraped pages to the file in the order of `pages` as they arrive."""
+    pending = {}  # pages that arrived before an earlier, slower page
+    position = 0
+
+    while position < len(pages):
+        page, data, titles = await result_queue.get()
+        pending[page] = (data, titles)
+
+        while position < len(pages) and pages[position] in pending:
+            page = pages[position]
+            data, titles = pending.pop(page)
+            position += 1
+            window.release()
+            if titles is None:
+                ledger.mark(page, "failed")
+                continue
+            try:
+                writer.write_page(titles, data, page)
+            except SchemaError as e:
+                logging.error(f"Page {page} doesn't match the output columns, skipping it: {e}")
+                ledger.mark(page, "failed")
+
+
+async def scrape_all_pages(output_file="animal_records_2.csv", resume=False):
+    """Scrape all pages with a pool of fetch workers and a single writer.
+
+    Progress is checkpointed in `<output_file>.ledger`. With `resume` the
+    output is cut back to the last checkpoint, then only pages that never
+    finished are fetched, followed by the ones that failed.
+    """
+    parsing_started = datetime.now() 
+    print("Parsing started at: ", parsing_started)
+
+    ledger = PageLedger(output_file + ".ledger")
+    total_pages = int(ledger.get("total_pages", 0))
+    if resume and not total_pages:
+        print("⚠️ Nothing to resume, starting from page 1.")
+        resume = False
+
+    # Keep-alive connections and cached DNS shared by all workers
+    connector = aiohttp.TCPConnector(limit=WORKERS, ttl_dns_cache=300, keepalive_timeout=60)
+    pool = start_parse_pool()
+    writer = None
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            if resume:
+                # Drop rows written after the last checkpoint, their pages are fetched again
+                if os.path.exists(output_file):
+                    os.truncate(output_file, int(ledger.get("output_offset", 0)))
+                pages = ledger.pages_to_resume(total_pages)
+                print(f"🔁 Resuming: {len(pages)} of {total_pages} pages left.")
+            else:
+                total_pages = await get_total_pages(session)
+                pages = list(range(1, total_pages + 1))
+                ledger.start(total_pages, os.path.getsize(output_file) if os.path.exists(output_file) else 0)
+
+            parquet_file = PARQUET_FILE
+            if resume and parquet_file:
+                # A Parquet file can't be appended to, so resumed pages go to a new one
+                root, ext = os.path.splitext(parquet_file)
+                parquet_file = f"{root}.resumed-{int(time.time())}{ext}"
+            writer = RowWriter(output_file, parquet_path=parquet_file, flush_rows=FLUSH_ROWS,
+                               flush_seconds=FLUSH_SECONDS, on_flush=ledger.commit_flush)
+
+            page_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            result_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            window = asyncio.Semaphore(MAX_AHEAD)
+
+            await asyncio.gather(
+                produce_pages(page_queue, pages, window),
+                write_pages(result_queue, pages, writer, ledger, window),
+                *(fetch_worker(session, page_queue, result_queue, ledger) for _ in range(WORKERS)),
+            )
+    finally:
+        if writer is not None:
+            writer.close()
+        ledger.close()
+        if pool is not None:
+            pool.shutdown()
+
+    parsing_ended = datetime.now() 
+    time_difference = parsing_ended - parsing_started
+    print(f"💾 Saved {writer.written} records to file.")
+    print(f"Scraping started at: {parsing_started}\nScraping completed at: {parsing_ended}\nTotal execution time: {time_difference}\nData saved to {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape the tanba animal registry into a CSV file.")
+    parser.add_argument("--output", default="animal_records_2.csv", help="CSV file to append the rows to")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run from its checkpoint")
+    parser.add_argument("--base-url", default=SITE_URL, help="site to scrape, e.g. a local stand-in (benchmarks/server.py)")
+    args = parser.parse_args()
+    BASE_URL = args.base_url.rstrip("/") + LIST_PATH
+
+    # Run the scraper
+    asyncio.run(scrape_all_pages(args.output, resume=args.resume))
@@ -0,0 +1,86 @@
+# On-disk store of validators (ETag, Last-Modified, body hash) and bodies of
+# previously downloaded pages, used by TanbaScraperDownloaderMiddleware.
+
+import hashlib
+import os
+import sqlite3
+import time
+import zlib
+
+
+def body_digest(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed cache of responses keyed by URL."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        # Must be set before the table exists so prune() can shrink the file
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                digest TEXT NOT NULL,
+                content_type TEXT,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_stored_at ON responses (stored_at)")
+
+    def get(self, url):
+        """Return (etag, last_modified, digest) for a cached URL, or None."""
+        return self.db.execute(
+            "SELECT etag, last_modified, digest FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+
+    def load(self, url):
+        """Return (content_type, body) of a cached URL, or None."""
+        row = self.db.execute("SELECT content_type, body FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return row[0], zlib.decompress(row[1])
+
+    def store(self, url, etag, last_modified, content_type, body):
+        compressed = zlib.compress(body)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, body_digest(body), content_type, compressed, len(compressed), time.time()),
+            )
+
+    def touch(self, url, etag=None, last_modified=None):
+        """Mark a cached URL as confirmed unchanged now, keeping known validators."""
+        with self.db:
+            self.db.execute(
+                """UPDATE responses SET stored_at = ?,
+                    etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified)
+                WHERE url = ?""",
+                (time.time(), etag, last_modified, url),
+            )
+
+    def prune(self, max_age, max_bytes):
+        """Drop entries older than `max_age` seconds, then the oldest ones above `max_bytes`."""
+        with self.db:
+            if max_age:
+                self.db.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - max_age,))
+            if max_bytes:
+                self.db.execute(
+                    """DELETE FROM responses WHERE url IN (
+                        SELECT url FROM (
+                            SELECT url, SUM(size) OVER (ORDER BY stored_at DESC, url) AS total
+                            FROM responses
+                        ) WHERE total > ?
+                    )""",
+                    (max_bytes,),
+                )
+        self.db.execute("PRAGMA incremental_vacuum")
+
+    def close(self):
+        self.db.close()
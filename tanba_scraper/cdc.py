@@ -0,0 +1,260 @@
+# Change-data-capture export: per registry, only the rows inserted, updated
+# and deleted since the previous crawl.
+#
+# Rows are keyed like the rest of the crawl state (row_key() with the
+# spider's key_fields, detail_key_fields for detail items). While the crawl
+# runs they are written to sorted runs of TANBA_CDC_SORT_BUFFER rows; when it
+# closes the runs are merged and compared, in one streaming pass, with the
+# previous snapshot kept sorted by key in TANBA_CDC_DIR/<registry>/. The
+# changes go to TANBA_CDC_DIR/<registry>/delta-<time>.csv with an "op"
+# (insert, update, delete) and a "key" column before the row, and the merged
+# rows become the next snapshot. Memory use is bounded by the sort buffer and
+# the delta's size by the number of changes, whatever the registry size.
+#
+# A key seen more than once in a crawl keeps the row crawled last; the others
+# are counted as duplicates. Updates need a key that outlives the row's
+# values: rows without all key_fields values or a Link are keyed by a hash of
+# all their values (row_key()), so a change to one of them is reported as a
+# delete and an insert, never as an update, and they're counted as unkeyed.
+#
+# Deletes are only reported for complete crawls. When the spider closed for
+# another reason than "finished", gave up on a request (see LOST_ROWS_STATS),
+# ran with TANBA_INCREMENTAL or dropped unchanged pages from the validation
+# cache, rows it didn't see are kept in the snapshot as they were.
+
+import csv
+import gzip
+import heapq
+import json
+import os
+import time
+
+from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from tanba_scraper.items import item_key_fields, item_registry
+from tanba_scraper.pipelines import to_text
+from tanba_scraper.state import row_key
+
+SNAPSHOT = "snapshot.jsonl.gz"
+COLUMNS = "snapshot.columns.json"
+
+# Stats showing that some rows may be missing from a crawl
+LOST_ROWS_STATS = ("retry/max_reached", "httperror/response_ignored_count", "spider_exceptions/count")
+
+
+def encode(key, row):
+    """Snapshot line of a row: its JSON key, a tab and its JSON values.
+
+    Lines sort like their keys, since a JSON string can't be the prefix of
+    another one.
+    """
+    return json.dumps(key, ensure_ascii=False) + "\t" + json.dumps(row, ensure_ascii=False, sort_keys=True) + "\n"
+
+
+def has_key(row, key_fields):
+    """Whether row_key() identifies the row by something else than its values."""
+    return bool(key_fields and all(row.get(field) for field in key_fields)) or bool(row.get("Link"))
+
+
+def line_key(line):
+    return line[:line.index("\t")]
+
+
+def line_row(line):
+    return json.loads(line[line.index("\t") + 1:])
+
+
+def numbered(line, number):
+    """Run line of a snapshot line: the crawl order goes between key and row."""
+    tab = line.index("\t")
+    return f"{line[:tab]}\t{number:012d}{line[tab:]}"
+
+
+class ChangeCapture:
+    """Rows of one registry's crawl, diffed against its previous snapshot on close."""
+
+    def __init__(self, directory, buffer_rows=200_000):
+        self.directory = directory
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.runs = []
+        self.columns = {}  # in the order they appear
+        self.rows = 0
+        self.unkeyed = 0
+        self.duplicates = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, key, row, keyed=True):
+        for name in row:
+            if name not in self.columns:
+                self.columns[name] = None
+        self.buffer.append(numbered(encode(key, row), self.rows))
+        self.rows += 1
+        if not keyed:
+            self.unkeyed += 1
+        if len(self.buffer) >= self.buffer_rows:
+            self.spill()
+
+    def spill(self):
+        """Write the buffer as a sorted run file."""
+        self.buffer.sort()
+        path = os.path.join(self.directory, f"run-{len(self.runs):05d}.tmp")
+        with open(path, "w", encoding="utf-8", newline="\n") as f:
+            f.writelines(self.buffer)
+        self.runs.append(path)
+        self.buffer = []
+
+    def sorted_lines(self, files):
+        """Snapshot lines of the merged runs, the one crawled last for each key."""
+        self.buffer.sort()
+        last = None
+        for line in heapq.merge(self.buffer, *files):
+            key, _, rest = line.partition("\t")
+            if last is not None:
+                if key != last[0]:
+                    yield last[0] + "\t" + last[1]
+                else:
+                    self.duplicates += 1
+            last = (key, rest.partition("\t")[2])
+        if last is not None:
+            yield last[0] + "\t" + last[1]
+
+    def previous(self):
+        """Lines and columns of the previous snapshot, empty on the first run."""
+        path = os.path.join(self.directory, SNAPSHOT)
+        if not os.path.exists(path):
+            return None, []
+        with open(os.path.join(self.directory, COLUMNS), encoding="utf-8") as f:
+            columns = json.load(f)
+        return gzip.open(path, "rt", encoding="utf-8", newline="\n"), columns
+
+    def close(self, complete=True):
+        """Write the delta and the new snapshot, return (delta path, counts).
+
+        Counts hold the changes by op, the unchanged rows and the duplicates.
+        """
+        old, old_columns = self.previous()
+        columns = list(self.columns) + [name for name in old_columns if name not in self.columns]
+        counts = {"insert": 0, "update": 0, "delete": 0, "unchanged": 0}
+        delta_path = os.path.join(self.directory, time.strftime("delta-%Y%m%dT%H%M%S.csv"))
+        files = [open(path, encoding="utf-8", newline="\n") for path in self.runs]
+        try:
+            with gzip.open(os.path.join(self.directory, SNAPSHOT + ".tmp"), "wt", encoding="utf-8",
+                           newline="\n", compresslevel=1) as snapshot, \
+                    open(delta_path + ".tmp", "w", newline="", encoding="utf-8-sig") as delta_file:
+                delta = csv.writer(delta_file)
+                delta.writerow(["op", "key"] + columns)
+
+                def change(op, line):
+                    row = line_row(line)
+                    delta.writerow([op, json.loads(line_key(line))] + [to_text(row.get(name)) for name in columns])
+                    counts[op] += 1
+
+                new_lines = self.sorted_lines(files)
+                old_lines = iter(old) if old is not None else iter(())
+                new_line, old_line = next(new_lines, None), next(old_lines, None)
+                while new_line is not None or old_line is not None:
+                    new_key = line_key(new_line) if new_line is not None else None
+                    old_key = line_key(old_line) if old_line is not None else None
+                    if old_key is None or (new_key is not None and new_key < old_key):
+                        change("insert", new_line)
+                        snapshot.write(new_line)
+                        new_line = next(new_lines, None)
+                    elif new_key is None or old_key < new_key:
+                        if complete:
+                            change("delete", old_line)
+                        else:
+                            snapshot.write(old_line)
+                        old_line = next(old_lines, None)
+                    else:
+                        if new_line != old_line:
+                            change("update", new_line)
+                        else:
+                            counts["unchanged"] += 1
+                        snapshot.write(new_line)
+                        new_line, old_line = next(new_lines, None), next(old_lines, None)
+            counts["duplicate"] = self.duplicates
+        finally:
+            for f in files:
+                f.close()
+            if old is not None:
+                old.close()
+            self.discard()
+
+        with open(os.path.join(self.directory, COLUMNS + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(list(self.columns) if complete else columns, f, ensure_ascii=False)
+        os.replace(delta_path + ".tmp", delta_path)
+        os.replace(os.path.join(self.directory, SNAPSHOT + ".tmp"), os.path.join(self.directory, SNAPSHOT))
+        os.replace(os.path.join(self.directory, COLUMNS + ".tmp"), os.path.join(self.directory, COLUMNS))
+        return delta_path, counts
+
+    def discard(self):
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = []
+        self.buffer = []
+
+
+class ChangeCapturePipeline:
+    # Writes the inserted, updated and deleted rows of every registry to
+    # TANBA_CDC_DIR when the spider closes. Enabled with TANBA_CDC_ENABLED,
+    # see settings.py.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("TANBA_CDC_ENABLED"):
+            raise NotConfigured
+        self.directory = settings.get("TANBA_CDC_DIR")
+        self.buffer_rows = settings.getint("TANBA_CDC_SORT_BUFFER")
+        self.stats = crawler.stats
+        self.skips_unchanged = settings.getbool("TANBA_CACHE_ENABLED") and settings.getbool("TANBA_CACHE_SKIP_UNCHANGED")
+        self.captures = {}
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_item(self, item, spider):
+        registry = item_registry(item, spider)
+        capture = self.captures.get(registry)
+        if capture is None:
+            capture = self.captures[registry] = ChangeCapture(os.path.join(self.directory, registry), self.buffer_rows)
+        row = ItemAdapter(item).asdict()
+        key_fields = item_key_fields(item, spider)
+        keyed = has_key(row, key_fields)
+        if not keyed and not capture.unkeyed:
+            spider.logger.warning(
+                f"{registry}: rows without {key_fields or 'Link'} are keyed by their values, "
+                f"their changes show as a delete and an insert"
+            )
+        capture.add(row_key(row, key_fields), row, keyed)
+        return item
+
+    def spider_closed(self, spider, reason):
+        incomplete = [f"closed with {reason}"] if reason != "finished" else []
+        incomplete += [f"{name} {self.stats.get_value(name)}" for name in LOST_ROWS_STATS if self.stats.get_value(name)]
+        if getattr(spider, "incremental", False):
+            incomplete.append("incremental crawl")
+        if self.skips_unchanged:
+            incomplete.append("unchanged pages skipped")
+        complete = not incomplete
+        if not complete:
+            spider.logger.warning(f"Rows not seen by this crawl are not reported as deleted: {', '.join(incomplete)}")
+        for registry, capture in self.captures.items():
+            delta_path, counts = capture.close(complete)
+            for op in ("insert", "update", "delete"):
+                self.stats.set_value(f"cdc/{registry}/{op}", counts[op])
+            self.stats.set_value(f"cdc/{registry}/duplicates", counts["duplicate"])
+            self.stats.set_value(f"cdc/{registry}/unkeyed", capture.unkeyed)
+            spider.logger.info(
+                f"{registry}: {counts['insert']} inserted, {counts['update']} updated, {counts['delete']} deleted, "
+                f"{counts['unchanged']} unchanged rows written to {delta_path}"
+            )
+            if counts["duplicate"]:
+                spider.logger.warning(f"{registry}: {counts['duplicate']} rows repeated a key, kept the last crawled")
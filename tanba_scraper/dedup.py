@@ -0,0 +1,83 @@
+# Compact set of row fingerprints for dropping duplicates across pages.
+#
+# Each fingerprint is a 64-bit hash kept in a sorted array('Q'), 8 bytes per
+# row instead of the ~100 bytes a Python set entry of a string costs. Past
+# `memory_items` fingerprints the array is moved to a SQLite file so memory
+# stays bounded on registries with millions of rows.
+
+import hashlib
+import heapq
+import os
+import sqlite3
+from array import array
+from bisect import bisect_left
+
+
+def fingerprint(key):
+    """64-bit fingerprint of a row key."""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class FingerprintSet:
+    """Set of 64-bit fingerprints in sorted arrays, spilling to disk when large."""
+
+    def __init__(self, memory_items=5_000_000, spill_path=None):
+        self.memory_items = memory_items
+        self.spill_path = spill_path
+        self.sorted = array("Q")
+        self.recent = set()  # merged into `sorted` in batches
+        self.disk = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, fp):
+        if fp in self.recent:
+            return True
+        i = bisect_left(self.sorted, fp)
+        if i < len(self.sorted) and self.sorted[i] == fp:
+            return True
+        return self.disk is not None and self.disk.execute(
+            "SELECT 1 FROM fingerprints WHERE fp = ?", (fp - 2 ** 63,)
+        ).fetchone() is not None
+
+    def add(self, fp):
+        """Add a fingerprint, returning False if it was already there."""
+        if fp in self:
+            return False
+        self.recent.add(fp)
+        self.count += 1
+        # Merge in batches that grow with the array, so merging stays linear overall
+        if len(self.recent) >= max(4096, len(self.sorted) // 8):
+            self.merge()
+        return True
+
+    def merge(self):
+        self.sorted = array("Q", heapq.merge(self.sorted, sorted(self.recent)))
+        self.recent = set()
+        if self.spill_path and len(self.sorted) > self.memory_items:
+            self.spill()
+
+    def spill(self):
+        """Move the in-memory fingerprints to the SQLite file."""
+        if self.disk is None:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            self.disk = sqlite3.connect(self.spill_path)
+            self.disk.execute("PRAGMA journal_mode = OFF")
+            self.disk.execute("PRAGMA synchronous = OFF")
+            self.disk.execute("DROP TABLE IF EXISTS fingerprints")
+            self.disk.execute("CREATE TABLE fingerprints (fp INTEGER PRIMARY KEY) WITHOUT ROWID")
+        with self.disk:
+            # SQLite integers are signed, so shift into the signed range
+            self.disk.executemany(
+                "INSERT OR IGNORE INTO fingerprints VALUES (?)", ((fp - 2 ** 63,) for fp in self.sorted)
+            )
+        self.sorted = array("Q")
+
+    def close(self):
+        """Drop the spill file, fingerprints are only needed for one crawl."""
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+            os.remove(self.spill_path)
@@ -0,0 +1,211 @@
+# Reconciliation of a paginated registry that changed while it was crawled.
+#
+# Rows inserted or deleted mid-crawl shift every following row across page
+# boundaries, so a page fetched before the change and its neighbour fetched
+# after it either repeat rows (dropped by the dedup) or skip them. Instead of
+# crawling everything again, only the pages around the shifted boundaries are
+# fetched once more and the rows on them that weren't extracted yet are
+# passed on.
+#
+# With the row order of the previous crawl (see RowOrder) every boundary is
+# checked against its neighbours: page N's last key has to come right before
+# page N + 1's first key in that order, or after it when rows were repeated.
+# Any other boundary, including one next to a row that's new since then, is
+# refetched, growing the window from the page where the mismatch was found
+# until both keys are on it. A registry that didn't change costs no extra
+# requests.
+#
+# Without a previous order, a page fetched before a change shows its original
+# first and last keys at other positions when fetched again, a page fetched
+# after it doesn't. So the pages are bisected in the order they were
+# requested to find where the positions change, and the boundaries between
+# pages requested on either side of that point are the ones that can have
+# skipped rows. This only sees changes before the bisected pages, so it's a
+# fallback for the first crawl of a registry; it costs two extra requests.
+
+from dataclasses import dataclass
+
+
+@dataclass
+class PageRecord:
+    first: str
+    last: str
+    count: int
+    sent: float  # when the page was requested
+    duplicates: int  # rows dropped as already extracted from another page
+
+
+class DriftReconciler:
+    """Tracks page boundaries during a crawl and plans the pages to refetch.
+
+    `record()` is fed every page of the main crawl and `record_fresh()` every
+    refetched page. `next_round()` returns the pages to fetch next, or an
+    empty list once every suspect boundary is settled or `max_rounds` is hit.
+    Boundary `p` is the one between pages p and p + 1. Pages also go to
+    `order`, a RowOrder, when one is given.
+    """
+
+    def __init__(self, max_rounds=20, spread=2, order=None):
+        self.max_rounds = max_rounds
+        self.spread = spread  # how far requests may have been reordered in flight
+        self.order = order
+        self.previous = bool(order is not None and len(order))
+        self.pages = {}
+        self.fresh = {}
+        self.requested = []  # pages in the order they were requested
+        self.intervals = []  # (start, end) positions in `requested` still to bisect
+        self.windows = {}  # unsettled boundary -> (first page, last page) to refetch
+        self.rounds = 0
+        self.changes = 0
+        self.settled = 0
+        self.unsettled = []
+        self.last_page = 1
+        self.page_size = 0
+
+    def record(self, page, keys, sent, duplicates=0):
+        if not keys:
+            return
+        self.pages[page] = PageRecord(keys[0], keys[-1], len(keys), sent, duplicates)
+        self.page_size = max(self.page_size, len(keys))
+        if self.order is not None:
+            self.order.add_page(page, keys)
+
+    def record_fresh(self, page, keys):
+        self.fresh[page] = list(keys)
+        if self.order is not None and keys:
+            self.order.add_page(page, keys, fresh=True)
+
+    def suspects(self):
+        """Boundaries next to a page that repeated rows or is short."""
+        boundaries = set()
+        for page, record in self.pages.items():
+            if record.duplicates or (page < self.last_page and record.count < self.page_size):
+                boundaries.update((page - 1, page))
+        return {b for b in boundaries if b in self.pages and b + 1 in self.pages}
+
+    def mismatches(self):
+        """Boundaries whose keys weren't neighbours on the previous crawl."""
+        boundaries = set()
+        for page, record in self.pages.items():
+            if page + 1 not in self.pages:
+                continue
+            last = self.order.rank(record.last)
+            first = self.order.rank(self.pages[page + 1].first)
+            if last is None or first is None or first > last + 1:
+                boundaries.add(page)
+        return boundaries
+
+    def signature(self, page):
+        """Positions of the page's original first and last keys on the fresh page."""
+        keys = self.fresh[page]
+        record = self.pages[page]
+        return (
+            keys.index(record.first) if record.first in keys else None,
+            keys.index(record.last) if record.last in keys else None,
+        )
+
+    def next_round(self):
+        """Settle what the last round allows and return the pages to fetch next."""
+        if self.rounds == 0:
+            self.rounds = 1
+            self.windows = {b: (b, b + 1) for b in self.suspects()}
+            if self.previous:
+                self.windows.update((b, (b, b + 1)) for b in self.mismatches() if b not in self.windows)
+            else:
+                self.requested = sorted(self.pages, key=lambda page: self.pages[page].sent)
+                if len(self.requested) > 1:
+                    self.intervals = [(0, len(self.requested) - 1)]
+            pages = self.wanted()
+            if not pages:
+                return self.finish()
+            return sorted(pages)
+
+        while True:
+            self.bisect()
+            self.check_windows()
+            if (not self.windows and not self.intervals) or self.rounds > self.max_rounds:
+                return self.finish()
+            pages = self.wanted() - set(self.fresh)
+            if pages:
+                self.rounds += 1
+                return sorted(pages)
+
+    def wanted(self):
+        pages = set()
+        for first, last in self.windows.values():
+            pages.update(range(first, last + 1))
+        for start, end in self.intervals:
+            ends = (self.requested[start], self.requested[end])
+            pages.update(ends)
+            if all(page in self.fresh for page in ends):
+                pages.add(self.requested[(start + end) // 2])
+        return pages
+
+    def bisect(self):
+        """Narrow down the points in request order where the registry changed."""
+        intervals = []
+        for start, end in self.intervals:
+            middle = (start + end) // 2
+            pages = [self.requested[i] for i in (start, middle, end)]
+            if pages[0] not in self.fresh or pages[2] not in self.fresh:
+                intervals.append((start, end))
+            elif self.signature(pages[0]) == self.signature(pages[2]):
+                continue  # no change between the two
+            elif end - start == 1:
+                self.add_change(start)
+            elif pages[1] not in self.fresh:
+                intervals.append((start, end))
+            else:
+                intervals.extend([(start, middle), (middle, end)])
+        self.intervals = intervals
+
+    def add_change(self, position):
+        """Suspect the boundaries between pages requested before and after `position`.
+
+        Pages requested within `spread` of it may have reached the server in
+        either order, so their boundaries are checked too.
+        """
+        self.changes += 1
+        before = set(self.requested[:position + 1])
+        near = set(self.requested[max(0, position + 1 - self.spread):position + 1 + self.spread])
+        for page in self.pages:
+            if page + 1 not in self.pages:
+                continue
+            if (page in before) != (page + 1 in before) or page in near or page + 1 in near:
+                self.windows.setdefault(page, (page, page + 1))
+
+    def check_windows(self):
+        for boundary, (first, last) in list(self.windows.items()):
+            if any(page not in self.fresh for page in range(first, last + 1)):
+                continue  # not refetched yet
+            keys = []
+            for page in range(first, last + 1):
+                keys.extend(self.fresh[page])
+            before = self.pages[boundary].last
+            after = self.pages[boundary + 1].first
+            i = keys.index(before) if before in keys else None
+            j = keys.index(after) if after in keys else None
+
+            # A key that's missing while the other one sits inside the window
+            # was deleted; one at the edge of the window may have moved past it.
+            grow_up = j == 0 or (i is None and j is None)
+            grow_down = i == len(keys) - 1 or (i is None and j is None)
+            if (i is not None and j is not None) or not (grow_up or grow_down):
+                self.settled += 1
+                del self.windows[boundary]
+                continue
+            if grow_up and first > 1:
+                first -= 1
+            if grow_down and last < self.last_page:
+                last += 1
+            if (first, last) == self.windows[boundary]:
+                self.settled += 1  # nothing left to look at
+                del self.windows[boundary]
+            else:
+                self.windows[boundary] = (first, last)
+
+    def finish(self):
+        self.unsettled = sorted(self.windows)
+        self.windows = {}
+        self.intervals = []
+        return []
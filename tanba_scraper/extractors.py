@@ -0,0 +1,290 @@
+# Fast extraction helpers for the tanba registry pages.
+#
+# The list spiders used to build a full BeautifulSoup tree for every page just
+# to read one guid-* table. These helpers run compiled XPath expressions on an
+# lxml tree built straight from the response bytes instead, and return plain
+# lists so the same code can be used by the Scrapy spiders and new_parsing.py.
+#
+# Detail pages are described by a declarative field map (DetailExtractor),
+# compiled once into XPath and CSS selectors.
+
+import re
+from urllib.parse import urljoin
+
+from lxml import etree, html
+from lxml.cssselect import CSSSelector
+
+
+GUID_TABLE = etree.XPath("(//table[starts-with(@id, 'guid-')])[1]")
+HEADER_CELLS = etree.XPath(".//th")
+TABLE_ROWS = etree.XPath(".//tr")
+ROW_CELLS = etree.XPath(".//td")
+FIRST_HREF = etree.XPath("(.//a[@href])[1]/@href")
+PAGE_LINKS = etree.XPath(
+    "(//ul[contains(concat(' ', normalize-space(@class), ' '), ' pagination ')])[1]"
+    "//a[contains(concat(' ', normalize-space(@class), ' '), ' page-link ')]"
+)
+# Links, the active page and ellipses of the pagination widget
+PAGE_ITEMS = etree.XPath(
+    "(//ul[contains(concat(' ', normalize-space(@class), ' '), ' pagination ')])[1]"
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' page-link ')]"
+)
+PAGE_PARAM = re.compile(r"[?&]p=(\d+)")
+ELLIPSES = ("…", "...", "..")
+
+# Byte patterns used to cut the guid-* table out of the raw response without
+# parsing the navigation, scripts and footer around it.
+GUID_TABLE_START = re.compile(rb"<table\b[^>]*\bid\s*=\s*[\"']?guid-", re.IGNORECASE)
+TABLE_TAG = re.compile(rb"<(/?)table\b", re.IGNORECASE)
+
+_parsers = {}
+
+
+def _parser(encoding):
+    """Return a cached lxml HTML parser for the given encoding."""
+    parser = _parsers.get(encoding)
+    if parser is None:
+        parser = _parsers[encoding] = html.HTMLParser(encoding=encoding)
+    return parser
+
+
+def parse_html(body, encoding="utf-8"):
+    """Parse raw response bytes into an lxml tree, or None for an empty page."""
+    try:
+        return html.document_fromstring(body, parser=_parser(encoding))
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def cell_text(element):
+    """Same result as BeautifulSoup's `tag.text.strip()`."""
+    return element.text_content().strip()
+
+
+def slice_table(body, encoding="utf-8"):
+    """Return the bytes of the first guid-* table, or None if its span can't be found."""
+    if "<table".encode(encoding, "ignore") != b"<table":
+        return None  # Not an ASCII-compatible encoding, byte search won't work
+    start = GUID_TABLE_START.search(body)
+    if start is None:
+        return None
+
+    depth = 0
+    for tag in TABLE_TAG.finditer(body, start.start()):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0:
+            end = body.find(b">", tag.end())
+            if end == -1:
+                return None
+            return body[start.start():end + 1]
+    return None
+
+
+def find_table(body, encoding="utf-8", region=True):
+    """Return the guid-* table element, or None if the page has no such table.
+
+    With `region` only the table's byte span is parsed; the whole page is
+    parsed when the span can't be found or doesn't contain the table.
+    """
+    if region:
+        fragment = slice_table(body, encoding)
+        if fragment is not None:
+            root = parse_html(fragment, encoding)
+            found = GUID_TABLE(root) if root is not None else None
+            if found:
+                return found[0]
+
+    root = parse_html(body, encoding)
+    if root is None:
+        return None
+    found = GUID_TABLE(root)
+    return found[0] if found else None
+
+
+def extract_last_page(body, encoding="utf-8"):
+    """Read the last page number from the pagination widget (1 if missing)."""
+    root = parse_html(body, encoding)
+    if root is None:
+        return 1
+    try:
+        return int(cell_text(PAGE_LINKS(root)[-2]))
+    except Exception:
+        return 1
+
+
+def extract_pagination(body, encoding="utf-8"):
+    """Return (last page, truncated) from the pagination widget.
+
+    The last page is the highest page number shown or linked to. The widget
+    counts as truncated when an ellipsis follows that number, so there may be
+    more pages than it shows.
+    """
+    root = parse_html(body, encoding)
+    if root is None:
+        return 1, False
+    last, truncated = 1, False
+    for element in PAGE_ITEMS(root):
+        text = cell_text(element)
+        numbers = [int(n) for n in PAGE_PARAM.findall(element.get("href") or "")]
+        if text.isdigit():
+            numbers.append(int(text))
+        if numbers and max(numbers) > last:
+            last, truncated = max(numbers), False
+        elif text in ELLIPSES:
+            truncated = True
+    return last, truncated
+
+
+def extract_table(body, encoding="utf-8", base_url=None, with_links=False, region=True):
+    """Extract (headers, rows) from the guid-* table, or None if there is no table.
+
+    With `with_links` every row that has a link gets its absolute URL inserted
+    as the first value and a "Link" header is prepended, like the old
+    capturecert/services/mark_factory spiders did.
+    """
+    table = find_table(body, encoding, region)
+    if table is None:
+        return None
+
+    headers = [cell_text(th) for th in HEADER_CELLS(table)]
+    if with_links:
+        headers.insert(0, "Link")
+
+    rows = []
+    for tr in TABLE_ROWS(table)[1:]:  # Skip headers
+        values = [cell_text(td) for td in ROW_CELLS(tr)]
+        if with_links:
+            href = FIRST_HREF(tr)
+            if href:
+                values.insert(0, urljoin(base_url, href[0]))
+        rows.append(values)
+    return headers, rows
+
+
+def compile_selector(spec):
+    """Compiled selector of a schema entry with a "css" or an "xpath" key."""
+    if "css" in spec:
+        return CSSSelector(spec["css"], translator="html")
+    return etree.XPath(spec["xpath"])
+
+
+class Field:
+    """One value of a detail page, see DetailExtractor."""
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.context = spec.get("context")
+        self.cell = spec.get("cell")
+        self.select = compile_selector(spec) if "css" in spec or "xpath" in spec else None
+        self.index = spec.get("index", 0)
+        self.replace = tuple(spec.get("replace", {}).items())
+        self.line = spec.get("line")
+        self.split = spec.get("split")
+        self.part = spec.get("part")
+        self.required = "default" not in spec
+        self.default = spec.get("default")
+
+    def extract(self, node, cells=None, context=None):
+        """The field's value; raises LookupError when the page doesn't have it."""
+        if self.context is not None:
+            return context[self.context]
+        if self.cell is not None:
+            return self.convert(cell_text(cells[self.cell]))
+        return self.convert(text_of(self.select(node)[self.index]))
+
+    def extract_all(self, node):
+        return [self.convert(text_of(match)) for match in self.select(node)]
+
+    def convert(self, text):
+        value = text.strip()
+        for old, new in self.replace:
+            value = value.replace(old, new)
+        if self.line is not None:
+            value = [line.strip() for line in value.split("\n") if line.strip()][self.line]
+        if self.split is not None:
+            value = value.split(self.split)
+            if self.part is not None:
+                value = value[self.part].strip()
+        return value
+
+
+class DetailExtractor:
+    """Extracts the items of a detail page described by a field map.
+
+    `schema` keys:
+
+    - "root": CSS selector of the element the other selectors start from;
+      pages without it have no items.
+    - "fields": {name: field} of values found once per page.
+    - "pairs": {"labels": field, "values": field, "limit": n}, label/value
+      blocks of any length, zipped into the item in page order.
+    - "records": {"css"/"xpath": ..., "cells": selector, "min_cells": n,
+      "fields": {name: field}}; one item per record with at least
+      `min_cells` cells, the page fields included. Without "records" the page
+      gives one item.
+
+    A field selects elements with "css" or "xpath" (relative to the root or
+    the record) and takes the stripped text of match "index" (default 0), or
+    takes cell "cell" of a record, or "context" value such as "url". Then
+    "replace" ({old: new}), "line" (n-th non-blank line), "split" (a list)
+    and "part" (one stripped element of the split) are applied in that order.
+    Fields missing from the page get their "default", or None and are
+    reported as missing.
+    """
+
+    def __init__(self, schema):
+        self.root = schema["root"]
+        self.select_root = compile_selector({"css": self.root})
+        self.fields = [Field(name, spec) for name, spec in schema.get("fields", {}).items()]
+        pairs = schema.get("pairs")
+        self.pairs = None
+        if pairs is not None:
+            self.pairs = (Field("labels", pairs["labels"]), Field("values", pairs["values"]), pairs.get("limit"))
+        records = schema.get("records")
+        self.records = None
+        if records is not None:
+            self.records = (
+                compile_selector(records),
+                compile_selector(records["cells"]),
+                records.get("min_cells", 0),
+                [Field(name, spec) for name, spec in records.get("fields", {}).items()],
+            )
+
+    def extract(self, body, encoding="utf-8", context=None):
+        """Return (items, missing field names), or None when the root isn't on the page."""
+        document = parse_html(body, encoding)
+        found = self.select_root(document) if document is not None else None
+        if not found:
+            return None
+        root = found[0]
+        missing = []
+        item = self.values(self.fields, root, None, context, missing)
+        if self.pairs is not None:
+            labels, values, limit = self.pairs
+            item.update(zip(labels.extract_all(root)[:limit], values.extract_all(root)[:limit]))
+        if self.records is None:
+            return [item], missing
+
+        select, select_cells, min_cells, fields = self.records
+        items = []
+        for record in select(root):
+            cells = select_cells(record)
+            if len(cells) >= min_cells:
+                items.append({**item, **self.values(fields, record, cells, context, missing)})
+        return items, missing
+
+    def values(self, fields, node, cells, context, missing):
+        values = {}
+        for field in fields:
+            try:
+                values[field.name] = field.extract(node, cells, context)
+            except LookupError:
+                values[field.name] = field.default
+                if field.required and field.name not in missing:
+                    missing.append(field.name)
+        return values
+
+
+def text_of(match):
+    """Text of an element, or a string result of an XPath."""
+    return match if isinstance(match, str) else cell_text(match)
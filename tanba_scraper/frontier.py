@@ -0,0 +1,101 @@
+# Memory-bounded crawl frontier: a scheduler that keeps at most
+# TANBA_FRONTIER_MEMORY_REQUESTS requests in memory and queues the rest on
+# disk, and a dupefilter that keeps request fingerprints in a FingerprintSet
+# (8 bytes each, spilling to SQLite) instead of a set of 20-byte digests.
+#
+# Without JOBDIR the disk queue lives in TANBA_STATE_DIR/<spider>.frontier and
+# is removed when the spider closes. With JOBDIR both behave like Scrapy's own
+# so a paused crawl can still be resumed.
+
+import os
+import shutil
+
+from scrapy.core.scheduler import Scheduler
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+
+from tanba_scraper.dedup import FingerprintSet
+
+
+class FrontierScheduler(Scheduler):
+    """Scheduler that spills requests to a disk queue past a memory cap."""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super().from_crawler(crawler)
+        scheduler.memory_requests = crawler.settings.getint("TANBA_FRONTIER_MEMORY_REQUESTS")
+        scheduler.spill_dir = None
+        state_dir = crawler.settings.get("TANBA_STATE_DIR")
+        if scheduler.dqdir is None and scheduler.memory_requests and state_dir:
+            scheduler.spill_dir = scheduler.dqdir = os.path.join(state_dir, f"{crawler.spidercls.name}.frontier")
+        return scheduler
+
+    def open(self, spider):
+        if self.spill_dir is not None:
+            # Leftovers of a crawl that didn't close cleanly aren't resumed
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            os.makedirs(self.spill_dir)
+        return super().open(spider)
+
+    def close(self, reason):
+        if self.spill_dir is None:
+            return super().close(reason)
+        self.dqs.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        return self.df.close(reason)
+
+    def enqueue_request(self, request):
+        if self.spill_dir is None:
+            return super().enqueue_request(request)  # JOBDIR: everything goes to disk
+        if not request.dont_filter and self.df.request_seen(request):
+            self.df.log(request, self.spider)
+            return False
+        if len(self.mqs) < self.memory_requests or not self._dqpush(request):
+            self._mqpush(request)
+            self.stats.inc_value("scheduler/enqueued/memory")
+        else:
+            self.stats.inc_value("scheduler/enqueued/disk")
+        self.stats.inc_value("scheduler/enqueued")
+        return True
+
+
+class CompactDupeFilter(RFPDupeFilter):
+    """RFPDupeFilter keeping 64-bit fingerprints in a FingerprintSet."""
+
+    def __init__(self, path=None, debug=False, *, fingerprinter=None, memory_items=5_000_000, spill_path=None):
+        super().__init__(path, debug, fingerprinter=fingerprinter)
+        self.seen = FingerprintSet(memory_items, spill_path)
+        # With JOBDIR the fingerprints of the paused crawl were read from requests.seen
+        for fp in self._fingerprints:
+            self.seen.add(compact(fp))
+        self._fingerprints = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        state_dir = settings.get("TANBA_STATE_DIR")
+        spill_path = os.path.join(state_dir, f"{crawler.spidercls.name}.requests.sqlite") if state_dir else None
+        return cls(
+            job_dir(settings),
+            settings.getbool("DUPEFILTER_DEBUG"),
+            fingerprinter=crawler.request_fingerprinter,
+            memory_items=settings.getint("TANBA_FRONTIER_MEMORY_FINGERPRINTS"),
+            spill_path=spill_path,
+        )
+
+    def request_seen(self, request):
+        fp = self.fingerprinter.fingerprint(request)
+        if not self.seen.add(compact(fp)):
+            return True
+        if self.file:
+            self.file.write(len(fp).to_bytes(2, "big") + fp)
+        return False
+
+    def close(self, reason):
+        super().close(reason)
+        self.seen.close()
+
+
+def compact(fp):
+    """First 8 bytes of a request fingerprint as an int."""
+    return int.from_bytes(fp[:8], "big")
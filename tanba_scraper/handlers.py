@@ -0,0 +1,84 @@
+# Download handler capping the requests to one host across every crawler of
+# the process at TANBA_HOST_BUDGET, for several registries crawled in one
+# CrawlerProcess (tanba_scraper/orchestrator.py).
+#
+# Each crawler keeps its own slots and AIMD window. A request takes a share of
+# the host budget once its slot starts the transfer and gives it back when the
+# response or the failure comes in, so requests queued in a slot never hold
+# one and freed shares go to the waiting registries in turn. The download
+# itself is left to the handler Scrapy would use for the scheme.
+#
+# Only installed by use_host_budget() when a budget is set, which the
+# orchestrator does for its crawlers; other crawls keep Scrapy's handlers.
+# Needs a Scrapy with coroutine download handlers.
+
+from scrapy.exceptions import IgnoreRequest
+from scrapy.settings.default_settings import DOWNLOAD_HANDLERS_BASE
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import build_from_crawler, load_object
+
+from tanba_scraper.throttle import FairBudget
+
+try:
+    from scrapy.core.downloader.handlers.base import BaseDownloadHandler
+except ImportError:  # Scrapy without coroutine download handlers
+    BaseDownloadHandler = None
+
+HANDLER = "tanba_scraper.handlers.HostBudgetDownloadHandler"
+
+
+def use_host_budget(settings):
+    """Route http and https through HostBudgetDownloadHandler when TANBA_HOST_BUDGET is set.
+
+    Returns False when the budget is off or the installed Scrapy can't run
+    the handler.
+    """
+    if settings.getint("TANBA_HOST_BUDGET") <= 0 or BaseDownloadHandler is None:
+        return False
+    handlers = dict(settings.getdict("DOWNLOAD_HANDLERS"))
+    handlers.update({"http": HANDLER, "https": HANDLER})
+    settings.set("DOWNLOAD_HANDLERS", handlers, priority="cmdline")
+    return True
+
+
+class HostBudgetDownloadHandler:
+    """HTTP(S) download handler that waits for a share of the host budget."""
+
+    lazy = False
+    budgets = {}  # host -> FairBudget, shared by the crawlers of the process
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.limit = crawler.settings.getint("TANBA_HOST_BUDGET")
+        self.handlers = {}  # scheme -> Scrapy's handler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def handler(self, scheme):
+        handler = self.handlers.get(scheme)
+        if handler is None:
+            handler = self.handlers[scheme] = build_from_crawler(load_object(DOWNLOAD_HANDLERS_BASE[scheme]), self.crawler)
+        return handler
+
+    async def download_request(self, request):
+        handler = self.handler(urlparse_cached(request).scheme)
+        host = urlparse_cached(request).hostname
+        budget = self.budgets.get(host)
+        if budget is None:
+            budget = self.budgets[host] = FairBudget(self.limit)
+        spider = self.crawler.spider
+        if budget.in_use >= budget.limit:
+            self.crawler.stats.inc_value("host_budget/waited")
+        await budget.acquire(spider.name)
+        try:
+            if self.crawler.engine is None or not self.crawler.engine.running:
+                raise IgnoreRequest(f"Spider closed while waiting for the host budget: {request.url}")
+            return await handler.download_request(request)
+        finally:
+            budget.release()
+
+    async def close(self):
+        for handler in self.handlers.values():
+            await handler.close()
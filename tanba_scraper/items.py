@@ -1,12 +1,43 @@
-# Define here the models for your scraped items
-#
-# See documentation in:
-# https://docs.scrapy.org/en/latest/topics/items.html
-
-import scrapy
-
-
-class TanbaScraperItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+# Define here the models for your scraped items
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/items.html
+
+import scrapy
+from scrapy.extensions.feedexport import ItemFilter
+
+
+class TanbaScraperItem(scrapy.Item):
+    # define the fields for your item here like:
+    # name = scrapy.Field()
+    pass
+
+
+class DetailItem(dict):
+    """Item scraped from a registry detail page.
+
+    A plain dict for the exporters; the type only lets a combined list and
+    detail crawl send both kinds of items to their own feeds.
+    """
+
+
+def item_registry(item, spider):
+    """Name of the registry an item belongs to, e.g. "capturecert_view" for
+    detail items scraped by the capturecert spider."""
+    if isinstance(item, DetailItem):
+        return getattr(spider, "detail_registry", spider.name)
+    return spider.name
+
+
+def item_key_fields(item, spider):
+    """Columns identifying the records of an item's registry, None for the default key."""
+    if isinstance(item, DetailItem):
+        return getattr(spider, "detail_key_fields", None)
+    return getattr(spider, "key_fields", None)
+
+
+class ListRowFilter(ItemFilter):
+    """Feed item filter that leaves out DetailItem."""
+
+    def accepts(self, item):
+        return not isinstance(item, DetailItem)
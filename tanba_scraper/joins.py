@@ -0,0 +1,183 @@
+"""Cross-registry join index of the SQLite database written by SqlitePipeline.
+
+    python -m tanba_scraper.joins build
+    python -m tanba_scraper.joins lookup 123456789012
+    python -m tanba_scraper.joins lookup 'ТОО "Бирка Завод"'
+
+`build` reads the BIN and organization name columns of every registry table
+and maps each row to an organization: its BIN, or for rows without one
+(capturecert_view has only the name) the BIN that rows with the same
+normalized name carry, or else the normalized name itself. The result is
+kept in two tables next to the registries:
+
+- join_organizations: org, bin, name_norm, name, registries, rows
+- join_rows: org, registry, row_key (the registry table's primary key)
+
+so a report over certificates, services and factory stock of an
+organization is an index lookup instead of a join of CSV files. The
+orchestrator rebuilds the index after a run with TANBA_SQLITE_ENABLED.
+"""
+
+import argparse
+import json
+import logging
+import re
+import sqlite3
+import sys
+
+from tanba_scraper.pipelines import quote
+
+logger = logging.getLogger(__name__)
+
+BIN_COLUMN = re.compile(r"\b(бин|bin)\b", re.IGNORECASE)
+NAME_COLUMN = re.compile(r"^(наименование( организации)?|организация|organization( name)?)$", re.IGNORECASE)
+INDEX_TABLES = ("join_organizations", "join_rows")
+
+LEGAL_FORMS = {"тоо", "ип", "ао", "оао", "зао", "ооо", "кх", "фх", "пк", "гу", "ргп", "кгп", "гкп", "llp", "jsc", "llc", "ltd"}
+NAME_NOISE = re.compile(r"[\"'«»“”„`.,;:()\[\]/\\-]+")
+BIN_DIGITS = re.compile(r"\d{12}")
+
+
+def normalize_name(name):
+    """Organization name reduced for matching: no legal form, quotes or case."""
+    if not name:
+        return None
+    words = NAME_NOISE.sub(" ", name.replace("\xa0", " ").replace("ё", "е").replace("Ё", "Е")).casefold().split()
+    words = [word for word in words if word not in LEGAL_FORMS]
+    return " ".join(words) or None
+
+
+def normalize_bin(value):
+    """The 12-digit BIN/IIN of a value, or None."""
+    if not value:
+        return None
+    match = BIN_DIGITS.search(value.replace(" ", "").replace("\xa0", ""))
+    return match.group() if match else None
+
+
+def registry_tables(db):
+    """(table, BIN column, name column) of the registries having either."""
+    tables = []
+    for (table,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"):
+        if table in INDEX_TABLES or table.startswith("sqlite_"):
+            continue
+        columns = [row[1] for row in db.execute(f"PRAGMA table_info({quote(table)})")]
+        if "row_key" not in columns:
+            continue
+        bin_column = next((c for c in columns if BIN_COLUMN.search(c)), None)
+        name_column = next((c for c in columns if NAME_COLUMN.match(c.strip())), None)
+        if bin_column or name_column:
+            tables.append((table, bin_column, name_column))
+    return tables
+
+
+def build_index(path):
+    """Rebuild the join tables of the database at `path`, return the registries indexed."""
+    db = sqlite3.connect(path, timeout=60, isolation_level=None)
+    try:
+        tables = registry_tables(db)
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("CREATE TEMP TABLE raw (registry TEXT, row_key TEXT, bin TEXT, name_norm TEXT, name TEXT)")
+            for table, bin_column, name_column in tables:
+                columns = ", ".join(quote(c) if c else "NULL" for c in (bin_column, name_column))
+                rows = db.execute(f"SELECT row_key, {columns} FROM {quote(table)}")
+                db.executemany(
+                    "INSERT INTO raw VALUES (?, ?, ?, ?, ?)",
+                    ((table, key, normalize_bin(bin_value), normalize_name(name), name.strip() if name else None)
+                     for key, bin_value, name in rows),
+                )
+            # Names carried together with exactly one BIN lend it to rows without one
+            db.execute(
+                "CREATE TEMP TABLE name_bins AS SELECT name_norm, MIN(bin) AS bin FROM raw "
+                "WHERE bin IS NOT NULL AND name_norm IS NOT NULL GROUP BY name_norm HAVING COUNT(DISTINCT bin) = 1"
+            )
+            db.execute("CREATE UNIQUE INDEX temp.name_bins_idx ON name_bins (name_norm)")
+            db.execute(
+                "CREATE TEMP TABLE mapped AS SELECT COALESCE(raw.bin, name_bins.bin, 'name:' || raw.name_norm) AS org, "
+                "raw.registry, raw.row_key, raw.name_norm, raw.name FROM raw LEFT JOIN name_bins USING (name_norm) "
+                "WHERE raw.bin IS NOT NULL OR raw.name_norm IS NOT NULL"
+            )
+
+            db.execute("DROP TABLE IF EXISTS join_rows")
+            db.execute("DROP TABLE IF EXISTS join_organizations")
+            db.execute("CREATE TABLE join_rows (org TEXT NOT NULL, registry TEXT NOT NULL, row_key TEXT NOT NULL)")
+            db.execute("INSERT INTO join_rows SELECT org, registry, row_key FROM mapped ORDER BY org")
+            db.execute("CREATE INDEX join_rows_org_idx ON join_rows (org)")
+            db.execute("CREATE INDEX join_rows_row_idx ON join_rows (registry, row_key)")
+            db.execute(
+                "CREATE TABLE join_organizations (org TEXT PRIMARY KEY, bin TEXT, name_norm TEXT, name TEXT, "
+                "registries INTEGER, rows INTEGER)"
+            )
+            db.execute(
+                "INSERT INTO join_organizations SELECT org, CASE WHEN org LIKE 'name:%' THEN NULL ELSE org END, "
+                "MAX(name_norm), MAX(name), COUNT(DISTINCT registry), COUNT(*) FROM mapped GROUP BY org"
+            )
+            db.execute("CREATE INDEX join_organizations_name_idx ON join_organizations (name_norm)")
+            db.execute("DROP TABLE raw")
+            db.execute("DROP TABLE name_bins")
+            db.execute("DROP TABLE mapped")
+        organizations, linked = db.execute(
+            "SELECT COUNT(*), SUM(registries > 1) FROM join_organizations"
+        ).fetchone()
+        logger.info(f"Join index of {len(tables)} registries: {organizations} organizations, {linked or 0} in several registries")
+        return [table for table, _, _ in tables]
+    finally:
+        db.close()
+
+
+def lookup(db, query):
+    """Rows of every registry for the organization with a BIN or name: {registry: [row]}."""
+    bin_number = normalize_bin(query)
+    if bin_number is not None:
+        orgs = [bin_number]
+    else:
+        orgs = [org for (org,) in db.execute(
+            "SELECT org FROM join_organizations WHERE name_norm = ?", (normalize_name(query),)
+        )]
+    found = {}
+    for org in orgs:
+        registries = db.execute("SELECT DISTINCT registry FROM join_rows WHERE org = ?", (org,)).fetchall()
+        for (registry,) in registries:
+            cursor = db.execute(
+                f"SELECT t.* FROM join_rows AS j JOIN {quote(registry)} AS t ON t.row_key = j.row_key "
+                "WHERE j.org = ? AND j.registry = ?",
+                (org, registry),
+            )
+            columns = [d[0] for d in cursor.description]
+            found.setdefault(registry, []).extend(dict(zip(columns, row)) for row in cursor)
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Join index of the tanba SQLite database")
+    parser.add_argument("--db", help="SQLite database (default: TANBA_SQLITE_PATH)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="rebuild the join index")
+    lookup_parser = commands.add_parser("lookup", help="print the rows of an organization as JSON")
+    lookup_parser.add_argument("query", help="BIN or organization name")
+    args = parser.parse_args(argv)
+
+    path = args.db
+    if path is None:
+        from scrapy.utils.project import get_project_settings
+
+        path = get_project_settings().get("TANBA_SQLITE_PATH")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s] %(levelname)s: %(message)s")
+
+    if args.command == "build":
+        build_index(path)
+        return
+    db = sqlite3.connect(path)
+    try:
+        found = lookup(db, args.query)
+    finally:
+        db.close()
+    if not found:
+        sys.exit(f"No organization matches {args.query!r}")
+    json.dump(found, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# Live crawl metrics of the tanba spiders.
+#
+# The middlewares record counters, gauges and histograms labelled with the
+# registry (spider name) in the process-wide REGISTRY. With TANBA_METRICS_PORT
+# they are served on http://<TANBA_METRICS_HOST>:<port>/metrics in the
+# Prometheus text format and on /metrics.json as JSON, from a background
+# thread so a scrape never waits for the crawl. One registry is shared by all
+# spiders of a process, so several crawls can run behind one endpoint.
+
+import json
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PARSE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+ROW_BUCKETS = (0, 1, 10, 25, 50, 100, 250, 500, 1000)
+
+HELP = {
+    "tanba_request_latency_seconds": "Download latency of responses",
+    "tanba_response_bytes_total": "Bytes of response bodies downloaded",
+    "tanba_responses_total": "Responses by status code, retried ones included",
+    "tanba_retries_total": "Requests sent again by the retry middleware",
+    "tanba_parse_seconds": "Time spent in a spider callback per response",
+    "tanba_rows_per_page": "Items yielded per response",
+    "tanba_items_total": "Items yielded by the spider callbacks",
+    "tanba_queue_depth": "Requests waiting in the scheduler",
+    "tanba_requests_in_flight": "Requests being downloaded",
+}
+
+
+class Histogram:
+    """Prometheus-style histogram with fixed upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else low
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Counters, gauges and histograms keyed by name and label values."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """Sum of a counter over all series matching `labels`."""
+        with self.lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and labels.items() <= dict(l).items())
+
+    def histogram(self, name, **labels):
+        """A histogram merging all series matching `labels`, or None."""
+        merged = None
+        with self.lock:
+            for (n, l), histogram in self.histograms.items():
+                if n != name or not labels.items() <= dict(l).items():
+                    continue
+                if merged is None:
+                    merged = Histogram(histogram.buckets)
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+        return merged
+
+    def prometheus(self):
+        """All series in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            series = [(key, "counter", value) for key, value in self.counters.items()]
+            series += [(key, "gauge", value) for key, value in self.gauges.items()]
+            series += [(key, "histogram", h) for key, h in self.histograms.items()]
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()}
+        typed = set()
+        for (name, labels), kind, value in sorted(series, key=lambda s: s[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            counts, total, count = histograms[(name, labels)]
+            cumulative = 0
+            for bound, bucket in zip(value.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        """All series as JSON-friendly lists of {"name", "labels", ...}."""
+        with self.lock:
+            return {
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self.counters.items()],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self.gauges.items()],
+                "histograms": [
+                    {"name": n, "labels": dict(l), "buckets": list(h.buckets), "counts": list(h.counts),
+                     "sum": h.sum, "count": h.count}
+                    for (n, l), h in self.histograms.items()
+                ],
+            }
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+REGISTRY = Metrics()
+
+_server = None
+_server_lock = threading.Lock()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body, content_type = REGISTRY.prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/metrics.json":
+            body, content_type = json.dumps(REGISTRY.as_dict()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the crawl log
+
+
+def serve(port, host="127.0.0.1"):
+    """Start the metrics endpoint once per process, return its (host, port)."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="tanba-metrics", daemon=True).start()
+        return _server.server_address[:2]
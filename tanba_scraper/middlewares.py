@@ -1,103 +1,472 @@
-# Define here the models for your spider middleware
-#
-# See documentation in:
-# https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-
-from scrapy import signals
-
-# useful for handling different item types with a single interface
-from itemadapter import is_item, ItemAdapter
-
-
-class TanbaScraperSpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
-
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
-
-        # Should return None or raise an exception.
-        return None
-
-    def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
-
-        # Must return an iterable of Request, or item objects.
-        for i in result:
-            yield i
-
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
-
-        # Should return either None or an iterable of Request or item objects.
-        pass
-
-    def process_start_requests(self, start_requests, spider):
-        # Called with the start requests of the spider, and works
-        # similarly to the process_spider_output() method, except
-        # that it doesn’t have a response associated.
-
-        # Must return only requests (not items).
-        for r in start_requests:
-            yield r
-
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
-
-
-class TanbaScraperDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
-
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
-        return None
-
-    def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
-
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
-        return response
-
-    def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
-
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
-
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
+# Define here the models for your spider middleware
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.response import get_base_url
+
+# useful for handling different item types with a single interface
+from itemadapter import is_item, ItemAdapter
+
+from tanba_scraper.cache import ResponseCache, body_digest
+from tanba_scraper.extractors import extract_table
+from tanba_scraper.metrics import LATENCY_BUCKETS, PARSE_BUCKETS, REGISTRY, ROW_BUCKETS, serve
+from tanba_scraper.throttle import AimdController
+
+try:
+    from scrapy.utils.asyncio import create_looping_call
+except ImportError:  # Scrapy < 2.13
+    from twisted.internet.task import LoopingCall as create_looping_call
+
+
+class CallbackMeter:
+    """Time spent in a spider callback and the items it yielded."""
+
+    def __init__(self, response, spider):
+        callback = getattr(getattr(response, "request", None), "callback", None)
+        self.registry = spider.name
+        self.labels = {"registry": spider.name, "callback": getattr(callback, "__name__", "parse")}
+        self.elapsed = 0.0
+        self.items = 0
+
+    def count(self, output):
+        if is_item(output):
+            self.items += 1
+
+    def record(self):
+        REGISTRY.observe("tanba_parse_seconds", self.labels, self.elapsed, PARSE_BUCKETS)
+        REGISTRY.observe("tanba_rows_per_page", self.labels, self.items, ROW_BUCKETS)
+        REGISTRY.inc("tanba_items_total", {"registry": self.registry}, self.items)
+
+
+class TanbaScraperSpiderMiddleware:
+    # Not all methods need to be defined. If a method is not defined,
+    # scrapy acts as if the spider middleware does not modify the
+    # passed objects.
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # This method is used by Scrapy to create your spiders.
+        s = cls()
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_spider_input(self, response, spider):
+        # Called for each response that goes through the spider
+        # middleware and into the spider.
+
+        # Should return None or raise an exception.
+        return None
+
+    def process_spider_output(self, response, result, spider):
+        # Called with the results returned from the Spider, after
+        # it has processed the response.
+
+        # Must return an iterable of Request, or item objects.
+        # The time spent in the callback and the items it yields are
+        # recorded per registry and callback (tanba_scraper/metrics.py).
+        meter = CallbackMeter(response, spider)
+        result = iter(result)
+        while True:
+            started = time.perf_counter()
+            try:
+                i = next(result)
+            except StopIteration:
+                break
+            finally:
+                meter.elapsed += time.perf_counter() - started
+            meter.count(i)
+            yield i
+        meter.record()
+
+    async def process_spider_output_async(self, response, result, spider):
+        # Same as process_spider_output() for async callbacks
+        meter = CallbackMeter(response, spider)
+        result = result.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                i = await result.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                meter.elapsed += time.perf_counter() - started
+            meter.count(i)
+            yield i
+        meter.record()
+
+    def process_spider_exception(self, response, exception, spider):
+        # Called when a spider or process_spider_input() method
+        # (from other spider middleware) raises an exception.
+
+        # Should return either None or an iterable of Request or item objects.
+        pass
+
+    async def process_start(self, start):
+        # Scrapy 2.13+ counterpart of process_start_requests()
+        async for item_or_request in start:
+            yield item_or_request
+
+    def process_start_requests(self, start_requests, spider):
+        # Called with the start requests of the spider, and works
+        # similarly to the process_spider_output() method, except
+        # that it doesn’t have a response associated.
+
+        # Must return only requests (not items).
+        for r in start_requests:
+            yield r
+
+    def spider_opened(self, spider):
+        spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class TanbaScraperDownloaderMiddleware:
+    # Validation cache for the detail pages of capturecert_view, services_view
+    # and factory_view, which rarely change. Enabled with TANBA_CACHE_ENABLED;
+    # see settings.py for the other options. Only requests with the
+    # "tanba_detail" meta key are cached: the list pages lead to every other
+    # page, so they are always downloaded and parsed.
+    #
+    # Known URLs are requested with If-None-Match/If-Modified-Since. A 304,
+    # or a 200 whose body hash matches the cached one, marks the page as
+    # unchanged: it is dropped before reaching the spider when
+    # TANBA_CACHE_SKIP_UNCHANGED is set, otherwise the cached body is passed on.
+    #
+    # It also records the download metrics of every registry: latency, bytes,
+    # status codes (before RetryMiddleware turns 429/503 into retries),
+    # retries, queue depth and requests in flight. They are served on
+    # TANBA_METRICS_PORT and logged every TANBA_METRICS_INTERVAL seconds.
+
+    def __init__(self, settings=None, stats=None, crawler=None):
+        self.cache = None
+        self.stats = stats
+        self.crawler = crawler
+        self.metrics_task = None
+        self.metrics_port = settings.getint("TANBA_METRICS_PORT") if settings is not None else 0
+        self.metrics_host = settings.get("TANBA_METRICS_HOST", "127.0.0.1") if settings is not None else None
+        self.metrics_interval = settings.getfloat("TANBA_METRICS_INTERVAL") if settings is not None else 0
+        if settings is not None and settings.getbool("TANBA_CACHE_ENABLED"):
+            self.cache = ResponseCache(settings.get("TANBA_CACHE_PATH"))
+            self.skip_unchanged = settings.getbool("TANBA_CACHE_SKIP_UNCHANGED")
+            # Feeds rewritten by each crawl would lose the skipped pages
+            self.overwritten_feeds = [] if settings.getbool("TANBA_CDC_ENABLED") else [
+                uri for uri, options in settings.getdict("FEEDS").items() if options.get("overwrite")
+            ]
+            self.max_age = settings.getfloat("TANBA_CACHE_MAX_AGE")
+            self.max_bytes = settings.getint("TANBA_CACHE_MAX_BYTES")
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # This method is used by Scrapy to create your spiders.
+        s = cls(crawler.settings, crawler.stats, crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.response_downloaded, signal=signals.response_downloaded)
+        return s
+
+    def process_request(self, request, spider):
+        if request.meta.get("retry_times"):
+            REGISTRY.inc("tanba_retries_total", {"registry": spider.name})
+
+        if self.cache is None or not self.cacheable(request):
+            return None
+
+        cached = self.cache.get(request.url)
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                request.headers.setdefault("If-None-Match", etag)
+            if last_modified:
+                request.headers.setdefault("If-Modified-Since", last_modified)
+        return None
+
+    def process_response(self, request, response, spider):
+        if self.cache is None or not self.cacheable(request):
+            return response
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        etag = etag.decode("latin-1") if etag else None
+        last_modified = last_modified.decode("latin-1") if last_modified else None
+
+        if response.status == 304:
+            cached = self.cache.load(request.url)
+            if cached is None:
+                return response
+            self.cache.touch(request.url, etag, last_modified)
+            self.stats.inc_value("tanba_cache/not_modified")
+            return self.unchanged(request, response, *cached)
+
+        if response.status != 200:
+            return response
+
+        cached = self.cache.get(request.url)
+        if cached and cached[2] == body_digest(response.body):
+            self.cache.touch(request.url, etag, last_modified)
+            self.stats.inc_value("tanba_cache/same_body")
+            return self.unchanged(request, response, None, response.body)
+
+        content_type = response.headers.get("Content-Type")
+        content_type = content_type.decode("latin-1") if content_type else None
+        self.cache.store(request.url, etag, last_modified, content_type, response.body)
+        self.stats.inc_value("tanba_cache/stored")
+        return response
+
+    def cacheable(self, request):
+        return request.meta.get("tanba_detail", False) and not request.meta.get("dont_cache")
+
+    def unchanged(self, request, response, content_type, body):
+        """Drop an unchanged page or rebuild it from the cached body."""
+        if self.skip_unchanged:
+            raise IgnoreRequest(f"Unchanged since last crawl: {request.url}")
+
+        headers = {"Content-Type": content_type} if content_type else response.headers
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return respcls(
+            url=request.url,
+            status=200,
+            headers=headers,
+            body=body,
+            request=request,
+            flags=response.flags + ["unchanged"],
+        )
+
+    def process_exception(self, request, exception, spider):
+        # Called when a download handler or a process_request()
+        # (from other downloader middleware) raises an exception.
+
+        # Must either:
+        # - return None: continue processing this exception
+        # - return a Response object: stops process_exception() chain
+        # - return a Request object: stops process_exception() chain
+        pass
+
+    def response_downloaded(self, response, request, spider):
+        # Every downloaded response, also the ones that are retried
+        labels = {"registry": spider.name}
+        REGISTRY.inc("tanba_responses_total", {"registry": spider.name, "status": response.status})
+        REGISTRY.inc("tanba_response_bytes_total", labels, len(response.body))
+        if "download_latency" in request.meta:
+            REGISTRY.observe("tanba_request_latency_seconds", labels, request.meta["download_latency"], LATENCY_BUCKETS)
+        self.sample_queues(spider)
+
+    def sample_queues(self, spider):
+        engine = self.crawler.engine if self.crawler is not None else None
+        if engine is None:
+            return
+        scheduler = getattr(engine, "scheduler", None) or getattr(getattr(engine, "slot", None), "scheduler", None)
+        if scheduler is not None:
+            REGISTRY.set("tanba_queue_depth", {"registry": spider.name}, len(scheduler))
+        REGISTRY.set("tanba_requests_in_flight", {"registry": spider.name}, len(engine.downloader.active))
+
+    def log_metrics(self, spider):
+        """Log one line with the registry's metrics since the crawl started."""
+        name = spider.name
+        self.sample_queues(spider)
+        latency = REGISTRY.histogram("tanba_request_latency_seconds", registry=name)
+        parse = REGISTRY.histogram("tanba_parse_seconds", registry=name)
+        errors = sum(
+            REGISTRY.counter("tanba_responses_total", registry=name, status=status) for status in (429, 500, 502, 503, 504)
+        )
+        with REGISTRY.lock:
+            depth = REGISTRY.gauges.get(("tanba_queue_depth", (("registry", name),)), 0)
+            in_flight = REGISTRY.gauges.get(("tanba_requests_in_flight", (("registry", name),)), 0)
+        line = (
+            f"Metrics: {REGISTRY.counter('tanba_responses_total', registry=name)} responses, "
+            f"{REGISTRY.counter('tanba_items_total', registry=name)} items, "
+            f"{REGISTRY.counter('tanba_response_bytes_total', registry=name) / 1e6:.1f} MB, "
+            f"{REGISTRY.counter('tanba_retries_total', registry=name)} retries, {errors} 429/5xx"
+        )
+        if latency is not None and latency.count:
+            line += f", latency p50 {latency.quantile(0.5):.2f}s p95 {latency.quantile(0.95):.2f}s"
+        if parse is not None and parse.count:
+            line += f", parse p95 {parse.quantile(0.95) * 1000:.1f} ms"
+        spider.logger.info(f"{line}, queue {depth}, in flight {in_flight}")
+
+    def spider_opened(self, spider):
+        spider.logger.info("Spider opened: %s" % spider.name)
+        if self.cache is not None and self.skip_unchanged and self.overwritten_feeds:
+            spider.logger.warning(
+                f"TANBA_CACHE_SKIP_UNCHANGED leaves unchanged pages out of {self.overwritten_feeds}, which are "
+                f"overwritten; use an appending feed or TANBA_CDC_ENABLED"
+            )
+        if self.metrics_port:
+            try:
+                host, port = serve(self.metrics_port, self.metrics_host)
+                spider.logger.info(f"Metrics on http://{host}:{port}/metrics and /metrics.json")
+            except OSError as e:
+                spider.logger.warning(f"Can't serve metrics on port {self.metrics_port}: {e}")
+        if self.metrics_interval:
+            self.metrics_task = create_looping_call(self.log_metrics, spider)
+            self.metrics_task.start(self.metrics_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.metrics_task is not None and self.metrics_task.running:
+            self.metrics_task.stop()
+            self.log_metrics(spider)
+        if self.cache is not None:
+            self.cache.prune(self.max_age, self.max_bytes)
+            self.cache.close()
+
+
+class AimdConcurrencyMiddleware:
+    # Adjusts the concurrency of each download slot (one per host) with an
+    # AimdController: more parallel requests while responses are fast and
+    # healthy, fewer after 429/503, timeouts or a latency spike. Must sit
+    # above RetryMiddleware (550) so it sees the 429/503 before they are
+    # turned into retries. The current window is kept in the stats as
+    # aimd/window/<slot>.
+    #
+    # The window never grows past CONCURRENT_REQUESTS_PER_DOMAIN, the
+    # spider's politeness cap, unless TANBA_AIMD_MAX_CONCURRENCY allows more.
+    # It is applied to a slot when its first request reaches the downloader,
+    # before anything is sent.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("TANBA_AIMD_ENABLED"):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.controllers = {}
+        per_domain = settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN")
+        self.options = {
+            "start": per_domain,
+            "minimum": settings.getint("TANBA_AIMD_MIN_CONCURRENCY"),
+            "maximum": settings.getint("TANBA_AIMD_MAX_CONCURRENCY") or per_domain,
+            "decrease": settings.getfloat("TANBA_AIMD_DECREASE"),
+            "latency_spike": settings.getfloat("TANBA_AIMD_LATENCY_SPIKE"),
+        }
+        crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_response(self, request, response, spider):
+        self.record(request, response.status)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.record(request, None)
+
+    def request_reached_downloader(self, request, spider):
+        # The slot exists by now and nothing of its queue was sent yet
+        key = request.meta.get("download_slot")
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None and key not in self.controllers:
+            slot.concurrency = self.controller(key).limit
+
+    def controller(self, key):
+        controller = self.controllers.get(key)
+        if controller is None:
+            controller = self.controllers[key] = AimdController(**self.options)
+        return controller
+
+    def record(self, request, status):
+        key = request.meta.get("download_slot")
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+
+        controller = self.controller(key)
+        cuts = controller.cuts
+        slot.concurrency = controller.record(status, request.meta.get("download_latency"))
+
+        self.stats.set_value(f"aimd/window/{key}", slot.concurrency)
+        if controller.cuts > cuts:
+            self.stats.inc_value("aimd/decrease_count")
+
+
+class ParsePoolMiddleware:
+    # Parses the table of the list pages (extract_table) in a pool of
+    # TANBA_PARSE_PROCESSES processes, so parsing runs on several cores while
+    # the reactor thread keeps downloading. The table goes to the callback in
+    # response.meta["tanba_table"], where RegistryListSpider.extract() picks
+    # it up. At most TANBA_PARSE_MAX_IN_FLIGHT pages are in the pool and as
+    # many wait for it; the next ones go straight to the callback, which
+    # parses them in the crawl process. That slows the reactor and with it the
+    # downloads, and Scrapy's scraper stops taking new responses past
+    # SCRAPER_SLOT_MAX_ACTIVE_SIZE, so responses don't pile up in memory. Sits
+    # below the retry, redirect and cache middlewares so only final responses
+    # are parsed. Needs the asyncio reactor.
+
+    pool = None  # shared by the crawlers of the process
+    in_flight = None
+    waiting = 0
+    users = 0
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        processes = settings.getint("TANBA_PARSE_PROCESSES")
+        if processes <= 0:
+            raise NotConfigured
+        if not settings.get("TWISTED_REACTOR", "").endswith("AsyncioSelectorReactor"):
+            raise NotConfigured("TANBA_PARSE_PROCESSES needs the asyncio reactor")
+        self.processes = processes
+        self.max_in_flight = settings.getint("TANBA_PARSE_MAX_IN_FLIGHT") or 2 * processes
+        self.region = settings.getbool("TANBA_TABLE_REGION_PARSING", True)
+        self.stats = crawler.stats
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        cls = type(self)
+        if cls.pool is None:
+            # Spawned rather than forked from a process running the reactor
+            cls.pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            cls.in_flight = asyncio.Semaphore(self.max_in_flight)
+        cls.users += 1
+
+    def spider_closed(self, spider):
+        cls = type(self)
+        cls.users -= 1
+        if cls.users == 0 and cls.pool is not None:
+            cls.pool.shutdown(wait=False, cancel_futures=True)
+            cls.pool = cls.in_flight = None
+
+    async def process_response(self, request, response, spider):
+        # Only list pages (meta "page") of RegistryListSpider
+        if self.pool is None or "page" not in request.meta or response.status != 200 \
+                or not isinstance(response, TextResponse) or not hasattr(spider, "with_links"):
+            return response
+        base_url = get_base_url(response) if spider.with_links else None
+        cls = type(self)
+        in_flight = self.in_flight
+        if in_flight.locked():
+            if cls.waiting >= self.max_in_flight:
+                self.stats.inc_value("parse_pool/overflow")
+                return response
+            self.stats.inc_value("parse_pool/waited")
+        cls.waiting += 1
+        try:
+            await in_flight.acquire()
+        finally:
+            cls.waiting -= 1
+        try:
+            table = await asyncio.wrap_future(self.pool.submit(
+                extract_table, response.body, response.encoding, base_url, spider.with_links, self.region
+            ))
+        except Exception as e:
+            # The callback parses the page itself
+            self.stats.inc_value("parse_pool/failed")
+            spider.logger.warning(f"Parse pool failed on {response.url}: {e!r}")
+            return response
+        finally:
+            in_flight.release()
+        request.meta["tanba_table"] = table
+        self.stats.inc_value("parse_pool/parsed")
+        return response
@@ -0,0 +1,148 @@
+"""Run every registry in one process.
+
+    python -m tanba_scraper.orchestrator
+    python -m tanba_scraper.orchestrator animals capturecert capturecert_view
+    python -m tanba_scraper.orchestrator --host-budget 8 -s TANBA_BASE_URL=http://127.0.0.1:8080
+
+All list spiders start together in a single CrawlerProcess, so the reactor,
+settings and spiders are loaded once and the daily refresh takes as long as
+the longest registry. The requests of all of them to a host are capped by
+TANBA_HOST_BUDGET (HostBudgetDownloadHandler), which hands free slots to the
+registries in turn. A detail spider (capturecert_view, services_view,
+factory_view) starts as soon as the crawl of its list spider is done and its
+CSV is complete; with --follow-details the list spiders request the detail
+pages while they run instead (TANBA_FOLLOW_DETAILS).
+
+With TANBA_SQLITE_ENABLED the cross-registry join index of the database is
+rebuilt once all crawls are done (tanba_scraper/joins.py).
+
+Exits with status 1 when a crawl failed or didn't finish.
+"""
+
+import argparse
+import logging
+import sys
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+
+from tanba_scraper.handlers import use_host_budget
+from tanba_scraper.joins import build_index
+from tanba_scraper.spiders.base import RegistryListSpider
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST_BUDGET = 16
+
+
+def plan(spider_loader, names=None, follow_details=False):
+    """Spiders to start right away and the detail spider each list spider unlocks."""
+    names = names or sorted(spider_loader.list())
+    first, then = [], {}
+    details = set()
+    for name in names:
+        spidercls = spider_loader.load(name)
+        if issubclass(spidercls, RegistryListSpider) and spidercls.detail_feed:
+            if not follow_details and spidercls.detail_registry in names:
+                then[name] = spidercls.detail_registry
+                details.add(spidercls.detail_registry)
+            elif follow_details:
+                details.add(spidercls.detail_registry)  # crawled along with the list
+    for name in names:
+        if name not in details:
+            first.append(name)
+    return first, then
+
+
+class Orchestrator:
+    def __init__(self, settings):
+        self.settings = settings
+        self.process = CrawlerProcess(settings)
+        self.then = {}
+        self.crawlers = {}
+        self.failed = []
+
+    def run(self, names=None, follow_details=False):
+        """Crawl until every spider is done, return whether all finished."""
+        first, self.then = plan(self.process.spider_loader, names, follow_details)
+        for name in first:
+            self.crawl(name)
+        self.process.start()
+        self.report()
+        if self.settings.getbool("TANBA_SQLITE_ENABLED"):
+            build_index(self.settings.get("TANBA_SQLITE_PATH"))
+        return not self.failed
+
+    def crawl(self, name):
+        crawler = self.crawlers[name] = self.process.create_crawler(name)
+        d = self.process.crawl(crawler)
+        d.addCallbacks(self.crawled, self.crawl_failed, callbackArgs=(name,), errbackArgs=(name,))
+        return d
+
+    def crawled(self, _, name):
+        reason = self.crawlers[name].stats.get_value("finish_reason")
+        if reason != "finished":
+            self.failed.append(name)
+        detail = self.then.get(name)
+        if detail is None:
+            return
+        if reason == "finished":
+            logger.info(f"{name} finished, starting {detail}")
+            # Started from the callback so CrawlerProcess.join() waits for it too
+            self.crawl(detail)
+        else:
+            logger.error(f"{name} closed with {reason}, not starting {detail}")
+            self.failed.append(detail)
+
+    def crawl_failed(self, failure, name):
+        logger.error(f"{name} failed: {failure.getErrorMessage()}", exc_info=(failure.type, failure.value, failure.tb))
+        self.failed.append(name)
+        if name in self.then:
+            self.failed.append(self.then[name])
+
+    def report(self):
+        for name, crawler in self.crawlers.items():
+            stats = crawler.stats.get_stats()
+            logger.info(
+                f"{name}: {stats.get('finish_reason', 'not finished')}, {stats.get('item_scraped_count', 0)} items, "
+                f"{stats.get('response_received_count', 0)} responses in {stats.get('elapsed_time_seconds', 0):.0f}s"
+            )
+        if self.failed:
+            logger.error(f"Failed or unfinished: {', '.join(self.failed)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Crawl the tanba registries in one process")
+    parser.add_argument("spiders", nargs="*", help="spiders to run (default: all)")
+    parser.add_argument(
+        "--host-budget", type=int,
+        help=f"requests in flight to one host across all registries (default: TANBA_HOST_BUDGET or {DEFAULT_HOST_BUDGET})",
+    )
+    parser.add_argument("--follow-details", action="store_true", help="crawl the detail pages along with the lists")
+    parser.add_argument("-s", "--set", action="append", default=[], metavar="NAME=VALUE", help="set a Scrapy setting")
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    for option in args.set:
+        name, sep, value = option.partition("=")
+        if not sep:
+            parser.error(f"-s expects NAME=VALUE, got {option!r}")
+        settings.set(name, value, priority="cmdline")
+    if args.host_budget is not None:
+        settings.set("TANBA_HOST_BUDGET", args.host_budget, priority="cmdline")
+    elif not settings.getint("TANBA_HOST_BUDGET"):
+        settings.set("TANBA_HOST_BUDGET", DEFAULT_HOST_BUDGET, priority="cmdline")
+    if settings.getint("TANBA_HOST_BUDGET") > 0 and not use_host_budget(settings):
+        logger.warning("TANBA_HOST_BUDGET needs a Scrapy with coroutine download handlers, not capping hosts")
+    if args.follow_details:
+        settings.set("TANBA_FOLLOW_DETAILS", True, priority="cmdline")
+
+    orchestrator = Orchestrator(settings)
+    unknown = set(args.spiders) - set(orchestrator.process.spider_loader.list())
+    if unknown:
+        parser.error(f"unknown spiders: {', '.join(sorted(unknown))}")
+    sys.exit(0 if orchestrator.run(args.spiders, args.follow_details) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,377 @@
-# Define your item pipelines here
-#
-# Don't forget to add your pipeline to the ITEM_PIPELINES setting
-# See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-
-
-# useful for handling different item types with a single interface
-from itemadapter import ItemAdapter
-
-
-class TanbaScraperPipeline:
-    def process_item(self, item, spider):
-        return item
+# Define your item pipelines here
+#
+# Don't forget to add your pipeline to the ITEM_PIPELINES setting
+# See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+
+import os
+import re
+import shutil
+import sqlite3
+import time
+from datetime import date
+
+from scrapy.exceptions import NotConfigured
+
+# useful for handling different item types with a single interface
+from itemadapter import ItemAdapter
+
+from tanba_scraper.items import item_key_fields, item_registry
+from tanba_scraper.state import row_key
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = None
+
+
+DATE_VALUE = re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4})")
+INT_VALUE = re.compile(r"-?\d+")
+
+# Column type by header name, first match wins. Headers are the Russian
+# table titles of the list pages or the English keys of the detail spiders.
+COLUMN_TYPES = [
+    (re.compile(r"\b(дата|date)\b", re.IGNORECASE), "date"),
+    (re.compile(r"\b(quantity|количество)\b", re.IGNORECASE), "int"),
+    (re.compile(r"\b(регион|region|область|type|тип|вид|table name)\b", re.IGNORECASE), "category"),
+]
+
+# Columns looked up by value, indexed in the SQLite database: BINs, certificate
+# and permit numbers and detail page links.
+INDEXED_COLUMNS = re.compile(
+    r"\b(бин|bin|link|url|certificate id)\b|номер (разрешения|удостоверения|сертификата)", re.IGNORECASE
+)
+
+
+def column_type(name):
+    for pattern, kind in COLUMN_TYPES:
+        if pattern.search(name):
+            return kind
+    return "string"
+
+
+def to_text(value):
+    """Text of a value as the CSV exporter writes it (lists joined by commas)."""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(v) for v in value)
+    return str(value)
+
+
+def to_date(value):
+    match = DATE_VALUE.search(to_text(value) or "")
+    if not match:
+        return None
+    day, month, year = map(int, match.groups())
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def to_int(value):
+    match = INT_VALUE.search((to_text(value) or "").replace(" ", "").replace("\xa0", ""))
+    return int(match.group()) if match else None
+
+
+class ParquetSink:
+    """Typed Parquet output of one registry, written one row group per flush.
+
+    Columns are added to the schema as they first appear. The run is written
+    next to the previous output and replaces it on close, so a registry's
+    directory only ever holds the rows of one crawl. Files written before a
+    column appeared get it as nulls then.
+    """
+
+    def __init__(self, registry, directory, compression, partition_by_month):
+        self.registry = registry
+        self.directory = directory
+        self.compression = compression
+        self.partition_by_month = partition_by_month
+        self.columns = {}
+        self.schema = None
+        self.writer = None
+        self.flushes = 0
+        self.files = []  # (path, schema) written by this run
+        if partition_by_month:
+            self.path = os.path.join(directory, registry)
+        else:
+            self.path = os.path.join(directory, f"{registry}.parquet")
+        self.staging = self.path + ".tmp"
+        shutil.rmtree(self.staging, ignore_errors=True)  # left by a run that died
+        os.makedirs(self.staging)
+
+    def extend_schema(self, rows):
+        """Add the columns not seen yet, in the order they appear."""
+        for row in rows:
+            for name in row:
+                if name not in self.columns:
+                    self.columns[name] = column_type(name)
+        types = {
+            "date": pa.date32(),
+            "int": pa.int64(),
+            "category": pa.dictionary(pa.int32(), pa.string()),
+            "string": pa.string(),
+        }
+        self.schema = pa.schema([(name, types[kind]) for name, kind in self.columns.items()])
+
+    def to_table(self, rows):
+        convert = {"date": to_date, "int": to_int, "category": to_text, "string": to_text}
+        arrays = {}
+        for name, kind in self.columns.items():
+            values = [convert[kind](row.get(name)) for row in rows]
+            if kind == "category":
+                arrays[name] = pa.array(values, pa.string()).dictionary_encode()
+            else:
+                arrays[name] = pa.array(values, self.schema.field(name).type)
+        return pa.table(arrays, schema=self.schema)
+
+    def conform(self, table):
+        """The table with the current schema, missing columns as nulls."""
+        arrays = [
+            table.column(field.name) if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+            for field in self.schema
+        ]
+        return pa.table(arrays, schema=self.schema)
+
+    def write(self, rows):
+        schema = self.schema
+        self.extend_schema(rows)
+        table = self.to_table(rows)
+
+        if self.partition_by_month:
+            self.write_partitioned(table)
+        else:
+            if self.writer is not None and self.schema != schema:
+                self.writer.close()  # new columns, start another file
+                self.writer = None
+            if self.writer is None:
+                path = os.path.join(self.staging, f"part-{len(self.files):05d}.parquet")
+                self.writer = pq.ParquetWriter(path, self.schema, compression=self.compression)
+                self.files.append((path, self.schema))
+            self.writer.write_table(table)
+        self.flushes += 1
+
+    def write_partitioned(self, table):
+        """Write rows under <registry>/month=YYYY-MM/ by the first date column."""
+        date_columns = [name for name, kind in self.columns.items() if kind == "date"]
+        months = [None] * table.num_rows
+        if date_columns:
+            months = [d.strftime("%Y-%m") if d else None for d in table.column(date_columns[0]).to_pylist()]
+        table = table.append_column("month", pa.array(months, pa.string()))
+        ds.write_dataset(
+            table,
+            self.staging,
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive"),
+            basename_template=f"part-{self.flushes:05d}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+            file_visitor=lambda written: self.files.append((written.path, self.schema)),
+        )
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.partition_by_month:
+            # Files written before the last column appeared get it as nulls
+            for path, schema in self.files:
+                if schema != self.schema:
+                    pq.write_table(self.conform(pq.read_table(path)), path, compression=self.compression)
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.replace(self.staging, self.path)
+            return
+
+        if len(self.files) == 1:
+            os.replace(self.files[0][0], self.path + ".part")
+        elif self.files:
+            # Row group by row group, so memory stays bounded by the flush size
+            with pq.ParquetWriter(self.path + ".part", self.schema, compression=self.compression) as writer:
+                for path, _ in self.files:
+                    part = pq.ParquetFile(path)
+                    for i in range(part.num_row_groups):
+                        writer.write_table(self.conform(part.read_row_group(i)))
+        if self.files:
+            os.replace(self.path + ".part", self.path)
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+
+class TanbaScraperPipeline:
+    # Buffers items per registry and writes them as typed, compressed Parquet
+    # next to the CSV feeds: dates parsed from dd.mm.yyyy, quantities as
+    # integers and region/type columns dictionary-encoded. Enabled with
+    # TANBA_PARQUET_ENABLED, see settings.py.
+
+    def __init__(self, settings):
+        if not settings.getbool("TANBA_PARQUET_ENABLED"):
+            raise NotConfigured
+        if pa is None:
+            raise NotConfigured("TANBA_PARQUET_ENABLED needs pyarrow: pip install pyarrow")
+        self.directory = settings.get("TANBA_PARQUET_DIR")
+        self.row_group_size = settings.getint("TANBA_PARQUET_ROW_GROUP_SIZE")
+        self.compression = settings.get("TANBA_PARQUET_COMPRESSION")
+        self.partition_by_month = settings.getbool("TANBA_PARQUET_PARTITION_BY_MONTH")
+        self.buffers = {}
+        self.sinks = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def process_item(self, item, spider):
+        registry = item_registry(item, spider)
+        buffer = self.buffers.setdefault(registry, [])
+        buffer.append(ItemAdapter(item).asdict())
+        if len(buffer) >= self.row_group_size:
+            self.flush(registry, spider)
+        return item
+
+    def flush(self, registry, spider):
+        rows = self.buffers.pop(registry, None)
+        if not rows:
+            return
+        sink = self.sinks.get(registry)
+        if sink is None:
+            sink = self.sinks[registry] = ParquetSink(registry, self.directory, self.compression, self.partition_by_month)
+        sink.write(rows)
+        spider.logger.info(f"Wrote {len(rows)} {registry} rows to Parquet")
+
+    def close_spider(self, spider):
+        for registry in list(self.buffers):
+            self.flush(registry, spider)
+        for sink in self.sinks.values():
+            sink.close()
+
+
+def quote(name):
+    """SQLite identifier for a table or column name."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SqliteSink:
+    """Table of one registry in the SQLite database, keyed by row_key().
+
+    Columns are added as they first appear. Rows are upserted, so a row
+    crawled again replaces the stored one and gets a new `last_seen`.
+    """
+
+    def __init__(self, db, registry):
+        self.db = db
+        self.registry = registry
+        self.table = quote(registry)
+        self.columns = None
+        self.statements = {}
+
+    def load_columns(self):
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (row_key TEXT PRIMARY KEY, last_seen REAL NOT NULL)"
+        )
+        self.columns = [row[1] for row in self.db.execute(f"PRAGMA table_info({self.table})")][2:]
+
+    def add_columns(self, rows):
+        if self.columns is None:
+            self.load_columns()
+        known = set(self.columns)
+        for row in rows:
+            for name in row:
+                if name not in known:
+                    self.db.execute(f"ALTER TABLE {self.table} ADD COLUMN {quote(name)} TEXT")
+                    self.columns.append(name)
+                    known.add(name)
+
+    def upsert(self, keyed_rows):
+        """Insert or replace (key, row) pairs; runs inside the caller's transaction."""
+        self.add_columns(row for _, row in keyed_rows)
+        now = time.time()
+        # One statement per column set, so columns a row doesn't have keep their value
+        by_columns = {}
+        for key, row in keyed_rows:
+            by_columns.setdefault(tuple(row), []).append((key, now, *(to_text(v) for v in row.values())))
+        for columns, values in by_columns.items():
+            self.db.executemany(self.statement(columns), values)
+
+    def statement(self, columns):
+        sql = self.statements.get(columns)
+        if sql is None:
+            names = ["row_key", "last_seen", *columns]
+            updates = ", ".join(f"{quote(name)} = excluded.{quote(name)}" for name in names[1:])
+            sql = self.statements[columns] = (
+                f"INSERT INTO {self.table} ({', '.join(map(quote, names))}) "
+                f"VALUES ({', '.join('?' * len(names))}) "
+                f"ON CONFLICT (row_key) DO UPDATE SET {updates}"
+            )
+        return sql
+
+    def create_indexes(self):
+        if self.columns is None:
+            self.load_columns()
+        for name in self.columns:
+            if INDEXED_COLUMNS.search(name):
+                index = quote(f"{self.registry}_{name}_idx")
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {self.table} ({quote(name)})")
+
+
+class SqlitePipeline:
+    # Writes every registry into one SQLite database (TANBA_SQLITE_PATH), a
+    # table per registry with row_key() as primary key. Items are upserted in
+    # transactions of TANBA_SQLITE_BATCH_SIZE rows, in WAL mode so the
+    # database can be queried while a crawl writes to it. BIN, certificate
+    # number and Link columns are indexed when the spider closes. Enabled
+    # with TANBA_SQLITE_ENABLED, see settings.py.
+
+    def __init__(self, settings):
+        if not settings.getbool("TANBA_SQLITE_ENABLED"):
+            raise NotConfigured
+        self.path = settings.get("TANBA_SQLITE_PATH")
+        self.batch_size = settings.getint("TANBA_SQLITE_BATCH_SIZE")
+        self.db = None
+        self.sinks = {}
+        self.pending = {}
+        self.pending_rows = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def open_spider(self, spider):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Crawls of the same process write to the database one batch at a time
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+
+    def process_item(self, item, spider):
+        registry = item_registry(item, spider)
+        row = ItemAdapter(item).asdict()
+        self.pending.setdefault(registry, []).append((row_key(row, item_key_fields(item, spider)), row))
+        self.pending_rows += 1
+        if self.pending_rows >= self.batch_size:
+            self.flush()
+        return item
+
+    def flush(self):
+        """Upsert the pending rows of all registries in one transaction."""
+        if not self.pending_rows:
+            return
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for registry, keyed_rows in self.pending.items():
+                sink = self.sinks.get(registry)
+                if sink is None:
+                    sink = self.sinks[registry] = SqliteSink(self.db, registry)
+                sink.upsert(keyed_rows)
+        self.pending = {}
+        self.pending_rows = 0
+
+    def close_spider(self, spider):
+        self.flush()
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for sink in self.sinks.values():
+                sink.create_indexes()
+        for registry, sink in self.sinks.items():
+            count = self.db.execute(f"SELECT COUNT(*) FROM {sink.table}").fetchone()[0]
+            spider.logger.info(f"{registry}: {count} rows in {self.path}")
+        self.db.close()
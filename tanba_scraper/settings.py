@@ -1,94 +1,299 @@
-# Scrapy settings for tanba_scraper project
-#
-# For simplicity, this file contains only settings considered important or
-# commonly used. You can find more settings consulting the documentation:
-#
-#     https://docs.scrapy.org/en/latest/topics/settings.html
-#     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-
-BOT_NAME = "tanba_scraper"
-
-SPIDER_MODULES = ["tanba_scraper.spiders"]
-NEWSPIDER_MODULE = "tanba_scraper.spiders"
-
-
-# Crawl responsibly by identifying yourself (and your website) on the user-agent
-#USER_AGENT = "tanba_scraper (+http://www.yourdomain.com)"
-
-# Obey robots.txt rules
-# ROBOTSTXT_OBEY = True
-
-# Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
-
-# Configure a delay for requests for the same website (default: 0)
-# See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
-# See also autothrottle settings and docs
-#DOWNLOAD_DELAY = 3
-# The download delay setting will honor only one of:
-#CONCURRENT_REQUESTS_PER_DOMAIN = 16
-#CONCURRENT_REQUESTS_PER_IP = 16
-
-# Disable cookies (enabled by default)
-#COOKIES_ENABLED = False
-
-# Disable Telnet Console (enabled by default)
-#TELNETCONSOLE_ENABLED = False
-
-# Override the default request headers:
-#DEFAULT_REQUEST_HEADERS = {
-#    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-#    "Accept-Language": "en",
-#}
-
-# Enable or disable spider middlewares
-# See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    "tanba_scraper.middlewares.TanbaScraperSpiderMiddleware": 543,
-#}
-
-# Enable or disable downloader middlewares
-# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
-#     'scrapy_user_agents.middlewares.RandomUserAgentMiddleware': 400,
-# }
-
-
-# Enable or disable extensions
-# See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-#}
-
-# Configure item pipelines
-# See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    "tanba_scraper.pipelines.TanbaScraperPipeline": 300,
-#}
-
-# Enable and configure the AutoThrottle extension (disabled by default)
-# See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-#AUTOTHROTTLE_ENABLED = True
-# The initial download delay
-#AUTOTHROTTLE_START_DELAY = 5
-# The maximum download delay to be set in case of high latencies
-#AUTOTHROTTLE_MAX_DELAY = 60
-# The average number of requests Scrapy should be sending in parallel to
-# each remote server
-#AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
-# Enable showing throttling stats for every response received:
-#AUTOTHROTTLE_DEBUG = False
-
-# Enable and configure HTTP caching (disabled by default)
-# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = "httpcache"
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
-
-# Set settings whose default value is deprecated to a future-proof value
-TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
-FEED_EXPORT_ENCODING = "utf-8"
+# Scrapy settings for tanba_scraper project
+#
+# For simplicity, this file contains only settings considered important or
+# commonly used. You can find more settings consulting the documentation:
+#
+#     https://docs.scrapy.org/en/latest/topics/settings.html
+#     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+#     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+
+BOT_NAME = "tanba_scraper"
+
+SPIDER_MODULES = ["tanba_scraper.spiders"]
+NEWSPIDER_MODULE = "tanba_scraper.spiders"
+
+
+# Crawl responsibly by identifying yourself (and your website) on the user-agent
+#USER_AGENT = "tanba_scraper (+http://www.yourdomain.com)"
+
+# Obey robots.txt rules
+# ROBOTSTXT_OBEY = True
+
+# Configure maximum concurrent requests performed by Scrapy (default: 16)
+#CONCURRENT_REQUESTS = 32
+
+# Configure a delay for requests for the same website (default: 0)
+# See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
+# See also autothrottle settings and docs
+#DOWNLOAD_DELAY = 3
+# The download delay setting will honor only one of:
+#CONCURRENT_REQUESTS_PER_DOMAIN = 16
+#CONCURRENT_REQUESTS_PER_IP = 16
+
+# Disable cookies (enabled by default)
+#COOKIES_ENABLED = False
+
+# Disable Telnet Console (enabled by default)
+#TELNETCONSOLE_ENABLED = False
+
+# Override the default request headers:
+#DEFAULT_REQUEST_HEADERS = {
+#    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+#    "Accept-Language": "en",
+#}
+
+# Enable or disable spider middlewares
+# See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+SPIDER_MIDDLEWARES = {
+    "tanba_scraper.middlewares.TanbaScraperSpiderMiddleware": 543,
+}
+
+# Enable or disable downloader middlewares
+# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+# DOWNLOADER_MIDDLEWARES = {
+#     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
+#     'scrapy_user_agents.middlewares.RandomUserAgentMiddleware': 400,
+# }
+DOWNLOADER_MIDDLEWARES = {
+    "tanba_scraper.middlewares.TanbaScraperDownloaderMiddleware": 543,
+    "tanba_scraper.middlewares.AimdConcurrencyMiddleware": 560,
+    "tanba_scraper.middlewares.ParsePoolMiddleware": 100,
+}
+
+
+# Memory-bounded frontier (tanba_scraper/frontier.py): at most
+# TANBA_FRONTIER_MEMORY_REQUESTS requests are queued in memory, the rest go to
+# a disk queue in TANBA_STATE_DIR/<spider>.frontier (JOBDIR if set). Seen
+# request fingerprints take 8 bytes each and move to a SQLite file past
+# TANBA_FRONTIER_MEMORY_FINGERPRINTS. Both only spill with TANBA_STATE_DIR or
+# JOBDIR set. Off by default, e.g.
+#   scrapy crawl animals -s TANBA_STATE_DIR=state \
+#       -s SCHEDULER=tanba_scraper.frontier.FrontierScheduler \
+#       -s DUPEFILTER_CLASS=tanba_scraper.frontier.CompactDupeFilter
+# The list spiders keep at most TANBA_FRONTIER_WINDOW page requests in flight
+# (0 requests all pages at once).
+# SCHEDULER = "tanba_scraper.frontier.FrontierScheduler"
+# DUPEFILTER_CLASS = "tanba_scraper.frontier.CompactDupeFilter"
+TANBA_FRONTIER_MEMORY_REQUESTS = 100_000
+TANBA_FRONTIER_MEMORY_FINGERPRINTS = 5_000_000
+TANBA_FRONTIER_WINDOW = 1000
+
+
+# Enable or disable extensions
+# See https://docs.scrapy.org/en/latest/topics/extensions.html
+#EXTENSIONS = {
+#    "scrapy.extensions.telnet.TelnetConsole": None,
+#}
+
+# Configure item pipelines
+# See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+ITEM_PIPELINES = {
+    "tanba_scraper.pipelines.TanbaScraperPipeline": 300,
+    "tanba_scraper.cdc.ChangeCapturePipeline": 400,
+    "tanba_scraper.pipelines.SqlitePipeline": 500,
+}
+
+# Typed Parquet copy of every registry (TanbaScraperPipeline, needs pyarrow),
+# written to TANBA_PARQUET_DIR/<registry>.parquet in row groups of
+# TANBA_PARQUET_ROW_GROUP_SIZE items, or partitioned as
+# TANBA_PARQUET_DIR/<registry>/month=YYYY-MM/ by the first date column. Each
+# crawl replaces the previous output of the registry when it closes; columns
+# first seen late in the crawl are null in the rows before them.
+TANBA_PARQUET_ENABLED = False
+TANBA_PARQUET_DIR = "parquet"
+TANBA_PARQUET_ROW_GROUP_SIZE = 50000
+TANBA_PARQUET_COMPRESSION = "zstd"
+TANBA_PARQUET_PARTITION_BY_MONTH = False
+
+# Change-data-capture export (tanba_scraper/cdc.py): every crawl writes the
+# rows inserted, updated and deleted since the previous one to
+# TANBA_CDC_DIR/<registry>/delta-<time>.csv and keeps a snapshot sorted by
+# row key next to it. Rows are sorted on disk in runs of
+# TANBA_CDC_SORT_BUFFER rows. Rows without a Link or key_fields values are
+# keyed by all their values, so a change to one shows as a delete and an
+# insert (counted in cdc/<registry>/unkeyed); a key crawled twice keeps the
+# last row (cdc/<registry>/duplicates). The full CSV feeds can be turned off
+# with -s FEEDS={}, e.g.
+#   scrapy crawl services -s TANBA_CDC_ENABLED=1 -s FEEDS={}
+TANBA_CDC_ENABLED = False
+TANBA_CDC_DIR = "cdc"
+TANBA_CDC_SORT_BUFFER = 200_000
+
+# All registries in one SQLite database (SqlitePipeline): a table per
+# registry keyed by row key, upserted in WAL mode in transactions of
+# TANBA_SQLITE_BATCH_SIZE rows, with BIN, certificate number and Link columns
+# indexed, e.g.
+#   scrapy crawl capturecert -s TANBA_SQLITE_ENABLED=1
+#   sqlite3 tanba.sqlite "SELECT * FROM capturecert WHERE \"БИН\" = '123456789012'"
+TANBA_SQLITE_ENABLED = False
+TANBA_SQLITE_PATH = "tanba.sqlite"
+TANBA_SQLITE_BATCH_SIZE = 10_000
+
+# Sharded crawl of one registry by several processes or hosts
+# (tanba_scraper/shards.py): `plan` queues page ranges of TANBA_SHARD_PAGES
+# pages in TANBA_SHARD_QUEUE, each `work` process leases them in turn and
+# writes TANBA_SHARD_DIR/<job>/<pages>.csv, and `merge` joins the shards.
+#   python -m tanba_scraper.shards plan animals
+#   python -m tanba_scraper.shards work --workers 4
+#   python -m tanba_scraper.shards merge <job>
+# A lease not renewed for TANBA_SHARD_LEASE_SECONDS goes to another worker, at
+# most TANBA_SHARD_MAX_ATTEMPTS times. CONCURRENT_REQUESTS_PER_DOMAIN is split
+# between the live workers (at least --workers), each shard crawled with its
+# share. Workers on several hosts need both paths on shared storage.
+TANBA_SHARD_QUEUE = "state/shards.sqlite"
+TANBA_SHARD_DIR = "shards"
+TANBA_SHARD_PAGES = 200
+TANBA_SHARD_LEASE_SECONDS = 120
+TANBA_SHARD_MAX_ATTEMPTS = 3
+
+# Enable and configure the AutoThrottle extension (disabled by default)
+# See https://docs.scrapy.org/en/latest/topics/autothrottle.html
+#AUTOTHROTTLE_ENABLED = True
+# The initial download delay
+#AUTOTHROTTLE_START_DELAY = 5
+# The maximum download delay to be set in case of high latencies
+#AUTOTHROTTLE_MAX_DELAY = 60
+# The average number of requests Scrapy should be sending in parallel to
+# each remote server
+#AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
+# Enable showing throttling stats for every response received:
+#AUTOTHROTTLE_DEBUG = False
+
+# Enable and configure HTTP caching (disabled by default)
+# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
+#HTTPCACHE_ENABLED = True
+#HTTPCACHE_EXPIRATION_SECS = 0
+#HTTPCACHE_DIR = "httpcache"
+#HTTPCACHE_IGNORE_HTTP_CODES = []
+#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+
+# Crawl another host than https://tanba.kezekte.kz, e.g. the local stand-in
+# of the registry for load tests:
+#   python benchmarks/server.py --rows 1000000
+#   scrapy crawl animals -s TANBA_BASE_URL=http://127.0.0.1:8080 -s TANBA_STATE_DIR=state-local
+# Use a separate TANBA_STATE_DIR so the state of real crawls isn't mixed in.
+TANBA_BASE_URL = None
+
+# Parse only the byte span of the guid-* registry table instead of the whole
+# page. Falls back to a full parse when the table can't be located.
+TANBA_TABLE_REGION_PARSING = True
+
+# State kept between crawls goes to TANBA_STATE_DIR; nothing is written when
+# it's None. With it set, the row keys of every list crawl are stored in
+# TANBA_STATE_DIR/<spider>.sqlite. With TANBA_INCREMENTAL (which needs
+# TANBA_STATE_DIR) the list spiders walk the registry from page 1, export
+# only rows missing from that store and stop after TANBA_INCREMENTAL_STOP_PAGES
+# consecutive pages that contain only known rows, e.g.
+#   scrapy crawl animals -s TANBA_STATE_DIR=state
+#   scrapy crawl animals -s TANBA_STATE_DIR=state -s TANBA_INCREMENTAL=1
+# Rows are keyed by the spider's key_fields (the record number). A page that
+# fails for good closes the crawl with incremental_page_failed, and the next
+# incremental crawl then walks every page.
+TANBA_STATE_DIR = None
+TANBA_INCREMENTAL = False
+TANBA_INCREMENTAL_STOP_PAGES = 3
+
+# Drop rows already extracted from an earlier page of the same crawl (rows
+# shift between pages when records are added mid-crawl), e.g.
+#   scrapy crawl animals -s TANBA_DEDUP=1
+# Rows are tracked by 8-byte fingerprints of their key; above
+# TANBA_DEDUP_MEMORY_ITEMS fingerprints they move to a temporary SQLite file
+# in TANBA_STATE_DIR when it is set.
+TANBA_DEDUP = False
+TANBA_DEDUP_MEMORY_ITEMS = 5_000_000
+
+# Once all pages are crawled, check whether the registry changed during the
+# crawl and refetch the pages around the boundaries that shifted, passing on
+# the rows that were skipped. Each boundary is checked against the row order
+# of the previous crawl, kept in TANBA_STATE_DIR; without one the pages are
+# bisected in the order they were received instead, which only catches some
+# changes. Takes at most TANBA_DRIFT_MAX_ROUNDS rounds of refetches. Needs
+# TANBA_DEDUP; not used with TANBA_INCREMENTAL. Off by default, e.g.
+#   scrapy crawl animals -s TANBA_DEDUP=1 -s TANBA_DRIFT_CHECK=1 -s TANBA_STATE_DIR=state
+TANBA_DRIFT_CHECK = False
+TANBA_DRIFT_MAX_ROUNDS = 20
+
+# The first crawl of a registry requests page 1 with each of
+# TANBA_PAGE_SIZE_PARAMS set to TANBA_PAGE_SIZE_MAX and keeps the first one
+# that returns more rows in the same order. The result is saved in
+# TANBA_STATE_DIR and probed again after TANBA_PAGE_SIZE_MAX_AGE seconds.
+# Off by default, e.g.
+#   scrapy crawl animals -s TANBA_PAGE_SIZE_PROBE=1 -s TANBA_STATE_DIR=state
+TANBA_PAGE_SIZE_PROBE = False
+TANBA_PAGE_SIZE_PARAMS = ["per-page", "pageSize", "page_size", "size", "limit"]
+TANBA_PAGE_SIZE_MAX = 500
+TANBA_PAGE_SIZE_MAX_AGE = 7 * 24 * 3600
+
+# Combined list and detail crawl for capturecert, services and mark_factory:
+# each Link is requested as soon as it is extracted and the detail rows are
+# written to the detail spider's feed, e.g.
+#   scrapy crawl capturecert -s TANBA_FOLLOW_DETAILS=1
+# writes both capturecert.csv and capturecert_view.csv.
+TANBA_FOLLOW_DETAILS = False
+
+# Adaptive per-host concurrency (AimdConcurrencyMiddleware). Starts at
+# CONCURRENT_REQUESTS_PER_DOMAIN (or the maximum when lower), grows by one
+# request per window of healthy responses up to TANBA_AIMD_MAX_CONCURRENCY
+# (CONCURRENT_REQUESTS_PER_DOMAIN when 0, so it only ever slows a spider down
+# from its politeness cap) and
+# is multiplied by TANBA_AIMD_DECREASE on 429/503, timeouts or a response
+# slower than TANBA_AIMD_LATENCY_SPIKE times the average latency.
+# DOWNLOAD_DELAY still applies on top of it. Off by default, so the
+# spiders' own CONCURRENT_REQUESTS_PER_DOMAIN holds, e.g.
+#   scrapy crawl animals -s TANBA_AIMD_ENABLED=1
+TANBA_AIMD_ENABLED = False
+TANBA_AIMD_MIN_CONCURRENCY = 1
+TANBA_AIMD_MAX_CONCURRENCY = 0
+TANBA_AIMD_DECREASE = 0.5
+TANBA_AIMD_LATENCY_SPIKE = 3.0
+
+# Requests in flight to one host across all spiders of a process, shared out
+# to the registries in turn (tanba_scraper/handlers.py). A share is only held
+# while the response is downloaded. Used by the orchestrator running every
+# registry in one process, where it defaults to 16; single crawls keep
+# Scrapy's own download handlers:
+#   python -m tanba_scraper.orchestrator --host-budget 16
+TANBA_HOST_BUDGET = 0
+
+# Table parsing of the list spiders in TANBA_PARSE_PROCESSES worker processes
+# (ParsePoolMiddleware), for crawls that are CPU bound on one core, e.g. with
+# a high CONCURRENT_REQUESTS against a fast host:
+#   scrapy crawl animals -s TANBA_PARSE_PROCESSES=4 -s CONCURRENT_REQUESTS=64
+# At most TANBA_PARSE_MAX_IN_FLIGHT pages (2 per process when 0) are parsed and
+# as many wait at a time; the spider parses the next ones itself, which slows
+# the downloads down. 0 parses in the crawl process.
+TANBA_PARSE_PROCESSES = 0
+TANBA_PARSE_MAX_IN_FLIGHT = 0
+
+# Live metrics of every registry: request latency, bytes, status codes,
+# retries, queue depth, parse time per callback and rows per page. Served in
+# the Prometheus text format on http://TANBA_METRICS_HOST:TANBA_METRICS_PORT/metrics
+# and as JSON on /metrics.json when the port is set, e.g.
+#   scrapy crawl animals -s TANBA_METRICS_PORT=9410
+# and logged as one line every TANBA_METRICS_INTERVAL seconds (0 disables).
+TANBA_METRICS_PORT = 0
+TANBA_METRICS_HOST = "127.0.0.1"
+TANBA_METRICS_INTERVAL = 60
+
+# Validation cache of TanbaScraperDownloaderMiddleware for the detail pages
+# (capturecert_view, services_view, factory_view, or the list spiders with
+# TANBA_FOLLOW_DETAILS); list pages are never cached:
+#   scrapy crawl services_view -s TANBA_CACHE_ENABLED=1
+# Pages answered with 304 are parsed from the cache, so the feed still gets
+# every page. With TANBA_CACHE_SKIP_UNCHANGED, pages answered with 304 or
+# with an unchanged body are dropped instead and the feed only gets new and
+# changed pages; the CSV feeds are overwritten on each crawl, so only use it
+# with an appending feed or the CDC export, e.g.
+#   scrapy crawl services_view -s TANBA_CACHE_ENABLED=1 \
+#       -s TANBA_CACHE_SKIP_UNCHANGED=1 -s TANBA_CDC_ENABLED=1 -s FEEDS={}
+# Entries older than TANBA_CACHE_MAX_AGE seconds, then the oldest above
+# TANBA_CACHE_MAX_BYTES, are evicted when the spider closes.
+TANBA_CACHE_ENABLED = False
+TANBA_CACHE_PATH = "state/httpcache.sqlite"
+TANBA_CACHE_SKIP_UNCHANGED = False
+TANBA_CACHE_MAX_AGE = 30 * 24 * 3600
+TANBA_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Set settings whose default value is deprecated to a future-proof value
+TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+FEED_EXPORT_ENCODING = "utf-8"
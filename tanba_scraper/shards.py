@@ -0,0 +1,400 @@
+"""Sharded crawl of a registry by several worker processes or hosts.
+
+    python -m tanba_scraper.shards plan animals --shard-pages 200
+    python -m tanba_scraper.shards work            # in as many processes as wanted
+    python -m tanba_scraper.shards work --workers 4
+    python -m tanba_scraper.shards status
+    python -m tanba_scraper.shards merge animals-20261018T120000 -o animals.csv
+
+`plan` reads the registry's page count from its first page (or --pages when
+the pagination widget hides the last page) and queues page ranges of
+--shard-pages pages in TANBA_SHARD_QUEUE. Each `work` process leases a
+shard, crawls its pages with the list spider (`-a first_page= -a
+last_page=`) into TANBA_SHARD_DIR/<job>/<shard>.csv and renews the lease
+every third of TANBA_SHARD_LEASE_SECONDS while it runs. The lease of a
+worker that died runs out and the shard goes to the next worker that asks,
+up to TANBA_SHARD_MAX_ATTEMPTS times. So does a shard whose crawl didn't
+finish or lost a page or rows (FAILED_STATS). `merge` concatenates the shards in
+page order into one CSV, dropping rows repeated at shard boundaries.
+
+CONCURRENT_REQUESTS_PER_DOMAIN is the budget of all workers together. Every
+worker has its own download slots, so each shard is crawled with the budget
+divided by the number of live workers: the ones registered in the queue with
+a heartbeat younger than the lease, or --workers when that's more. A worker
+joining later lowers the share of the others from their next shard on, so
+give --workers when starting several at once.
+Workers on several hosts need the queue and shard directory on a shared
+filesystem with working locks. ShardQueue is the only thing they share and
+they only call register(), live_workers(), lease(), heartbeat(), complete()
+and release(), so a queue on a Redis-compatible server with the same methods
+can take its place.
+"""
+
+import argparse
+import csv
+import logging
+import math
+import os
+import socket
+import sqlite3
+import sys
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.spiderloader import get_spider_loader
+from scrapy.utils.project import get_project_settings
+from w3lib.url import add_or_replace_parameter
+
+from tanba_scraper.cdc import LOST_ROWS_STATS
+from tanba_scraper.dedup import FingerprintSet, fingerprint
+from tanba_scraper.extractors import extract_pagination
+from tanba_scraper.state import PageSizeCache, row_key
+
+try:
+    from scrapy.utils.asyncio import create_looping_call
+except ImportError:  # Scrapy < 2.13
+    from twisted.internet.task import LoopingCall as create_looping_call
+
+logger = logging.getLogger(__name__)
+
+# Stats of a crawl that lost pages or rows; its shard is crawled again
+FAILED_STATS = ("frontier/failed_pages",) + LOST_ROWS_STATS
+
+
+class ShardQueue:
+    """Page ranges of crawl jobs, leased to workers, in a SQLite file."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                job TEXT PRIMARY KEY,
+                registry TEXT NOT NULL,
+                pages INTEGER NOT NULL,
+                page_size TEXT,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY,
+                job TEXT NOT NULL,
+                first_page INTEGER NOT NULL,
+                last_page INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                output TEXT
+            )"""
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS shards_state_idx ON shards (state, lease_until)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, seen_until REAL NOT NULL)")
+
+    def plan(self, registry, pages, shard_pages, page_size=None):
+        """Queue a job crawling pages 1..pages in shards, return its id."""
+        job = f"{registry}-{time.strftime('%Y%m%dT%H%M%S')}"
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?)", (job, registry, pages, page_size, time.time()))
+            self.db.executemany(
+                "INSERT INTO shards (job, first_page, last_page) VALUES (?, ?, ?)",
+                ((job, first, min(first + shard_pages - 1, pages)) for first in range(1, pages + 1, shard_pages)),
+            )
+        return job
+
+    def register(self, worker, seconds):
+        """Count a worker as live for the next `seconds`."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker, time.time() + seconds))
+
+    def unregister(self, worker):
+        with self.db:
+            self.db.execute("DELETE FROM workers WHERE worker = ?", (worker,))
+
+    def live_workers(self):
+        return self.db.execute("SELECT COUNT(*) FROM workers WHERE seen_until > ?", (time.time(),)).fetchone()[0]
+
+    def lease(self, worker, seconds, max_attempts, job=None):
+        """Lease the next pending or expired shard: (id, job, registry, first, last, page size), or None."""
+        now = time.time()
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            # Shards leased too often are given up, their pages likely break the spider
+            self.db.execute(
+                "UPDATE shards SET state = 'failed' WHERE attempts >= ? AND (state = 'pending' "
+                "OR (state = 'leased' AND lease_until < ?))",
+                (max_attempts, now),
+            )
+            row = self.db.execute(
+                "SELECT shards.id, shards.job, registry, first_page, last_page, page_size FROM shards "
+                "JOIN jobs USING (job) WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?)) "
+                "AND (? IS NULL OR job = ?) ORDER BY shards.id LIMIT 1",
+                (now, job, job),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE shards SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + seconds, row[0]),
+            )
+        return row
+
+    def heartbeat(self, shard, worker, seconds):
+        """Extend a lease; False when the worker lost it to another one."""
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE shards SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (time.time() + seconds, shard, worker),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, shard, worker, output):
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE shards SET state = 'done', output = ?, lease_until = NULL "
+                "WHERE id = ? AND worker = ? AND state = 'leased'",
+                (output, shard, worker),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, shard, worker):
+        """Give a shard back for another attempt."""
+        with self.db:
+            self.db.execute(
+                "UPDATE shards SET state = 'pending', worker = NULL, lease_until = NULL "
+                "WHERE id = ? AND worker = ? AND state = 'leased'",
+                (shard, worker),
+            )
+
+    def job(self, job):
+        return self.db.execute("SELECT registry, pages, page_size FROM jobs WHERE job = ?", (job,)).fetchone()
+
+    def shards(self, job):
+        """(first page, last page, state, output) of a job's shards in page order."""
+        return self.db.execute(
+            "SELECT first_page, last_page, state, output FROM shards WHERE job = ? ORDER BY first_page", (job,)
+        ).fetchall()
+
+    def status(self):
+        """{job: {state: shards}}"""
+        status = {}
+        for job, state, count in self.db.execute("SELECT job, state, COUNT(*) FROM shards GROUP BY job, state"):
+            status.setdefault(job, {})[state] = count
+        return status
+
+    def close(self):
+        self.db.close()
+
+
+class ShardWorker:
+    """Leases shards and crawls them one after another in one CrawlerProcess."""
+
+    def __init__(self, settings, job=None, workers=1):
+        self.settings = settings
+        self.job = job
+        self.workers = workers
+        self.budget = settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN")
+        self.worker = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.queue = ShardQueue(settings.get("TANBA_SHARD_QUEUE"))
+        self.directory = settings.get("TANBA_SHARD_DIR")
+        self.lease_seconds = settings.getfloat("TANBA_SHARD_LEASE_SECONDS")
+        self.max_attempts = settings.getint("TANBA_SHARD_MAX_ATTEMPTS")
+        # Workers on one host must not share the frontier and dedup files
+        state_dir = settings.get("TANBA_STATE_DIR")
+        if state_dir:
+            settings.set("TANBA_STATE_DIR", os.path.join(state_dir, "workers", self.worker), priority="cmdline")
+        self.process = CrawlerProcess(settings)
+        self.crawled = 0
+
+    def run(self):
+        self.queue.register(self.worker, self.lease_seconds)
+        if not self.crawl_next():
+            logger.info("No shard to crawl")
+            self.queue.unregister(self.worker)
+            return
+        self.process.start()
+        self.queue.unregister(self.worker)
+        self.queue.close()
+        logger.info(f"Worker {self.worker} crawled {self.crawled} shards")
+
+    def crawl_next(self):
+        """Lease a shard and start crawling it; False when none is left."""
+        shard = self.queue.lease(self.worker, self.lease_seconds, self.max_attempts, self.job)
+        if shard is None:
+            return False
+        shard_id, job, registry, first_page, last_page, page_size = shard
+        output = os.path.join(self.directory, job, f"{first_page:08d}-{last_page:08d}.csv")
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        share = self.share()
+        logger.info(f"Crawling {registry} pages {first_page}-{last_page} of {job}, {share} requests at a time")
+
+        crawler = self.process.create_crawler(registry)
+        crawler.settings.set(
+            "FEEDS", {output: {"format": "csv", "encoding": "utf-8-sig", "overwrite": True}}, priority="cmdline"
+        )
+        crawler.settings.set("CONCURRENT_REQUESTS_PER_DOMAIN", share, priority="cmdline")
+        if crawler.settings.getint("TANBA_AIMD_MAX_CONCURRENCY") > share:
+            crawler.settings.set("TANBA_AIMD_MAX_CONCURRENCY", share, priority="cmdline")
+        kwargs = {"first_page": first_page, "last_page": last_page}
+        if page_size:
+            kwargs["page_size"] = page_size
+        d = self.process.crawl(crawler, **kwargs)
+        heartbeat = create_looping_call(self.heartbeat, shard_id, crawler)
+        heartbeat.start(self.lease_seconds / 3, now=False)
+        d.addBoth(self.shard_crawled, shard_id, crawler, output, heartbeat)
+        return True
+
+    def share(self):
+        """This worker's part of the per-domain budget."""
+        self.queue.register(self.worker, self.lease_seconds)
+        return max(1, self.budget // max(self.workers, self.queue.live_workers()))
+
+    def heartbeat(self, shard_id, crawler):
+        self.queue.register(self.worker, self.lease_seconds)
+        if not self.queue.heartbeat(shard_id, self.worker, self.lease_seconds):
+            logger.warning(f"Lost the lease of shard {shard_id}, stopping its crawl")
+            crawler.stop()
+
+    def shard_crawled(self, result, shard_id, crawler, output, heartbeat):
+        if heartbeat.running:
+            heartbeat.stop()
+        stats = crawler.stats.get_stats() if crawler.stats else {}
+        problems = [f"closed with {stats.get('finish_reason')}"] if stats.get("finish_reason") != "finished" else []
+        problems += [f"{name} {stats[name]}" for name in FAILED_STATS if stats.get(name)]
+        if not problems and self.queue.complete(shard_id, self.worker, output):
+            self.crawled += 1
+        else:
+            logger.warning(f"Shard {shard_id} {', '.join(problems) or 'lost its lease'}, giving it back")
+            self.queue.release(shard_id, self.worker)
+        # Started from the callback so CrawlerProcess.join() waits for it too
+        self.crawl_next()
+
+
+def count_pages(settings, registry, page_size):
+    """Page count of a registry from the pagination of its first page."""
+    spidercls = get_spider_loader(settings).load(registry)
+    url = spidercls.page_url.format(page=1)
+    base_url = settings.get("TANBA_BASE_URL")
+    if base_url:
+        base = urllib.parse.urlsplit(base_url)
+        url = urllib.parse.urlunsplit(urllib.parse.urlsplit(url)._replace(scheme=base.scheme, netloc=base.netloc))
+    if page_size:
+        param, _, size = page_size.partition("=")
+        url = add_or_replace_parameter(url, param, size)
+    request = urllib.request.Request(url, headers={"User-Agent": settings.get("USER_AGENT")})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        body = response.read()
+        encoding = response.headers.get_content_charset() or "utf-8"
+    return extract_pagination(body, encoding)
+
+
+def merge(settings, queue, job, output, partial=False):
+    """Concatenate the shards of a job in page order, return the rows written."""
+    registry, _, _ = queue.job(job)
+    shards = queue.shards(job)
+    missing = [(first, last, state) for first, last, state, _ in shards if state != "done"]
+    if missing and not partial:
+        raise ValueError(f"{len(missing)} shards of {job} are not done: {missing[:5]}")
+    paths = [path for _, _, state, path in shards if state == "done"]
+
+    columns = {}
+    for path in paths:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for name in next(csv.reader(f), []):
+                columns.setdefault(name, None)
+    key_fields = get_spider_loader(settings).load(registry).key_fields
+
+    # Rows shifting between pages while the shards ran show up in two of them
+    seen = FingerprintSet()
+    written = duplicates = 0
+    with open(output, "w", newline="", encoding="utf-8-sig") as out:
+        writer = csv.DictWriter(out, fieldnames=list(columns), restval="")
+        writer.writeheader()
+        for path in paths:
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                for row in csv.DictReader(f):
+                    if not seen.add(fingerprint(row_key(row, key_fields))):
+                        duplicates += 1
+                        continue
+                    writer.writerow(row)
+                    written += 1
+    seen.close()
+    logger.info(f"Merged {len(paths)} shards of {job} into {output}: {written} rows, {duplicates} duplicates dropped")
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded crawl of a tanba registry")
+    parser.add_argument("-s", "--set", action="append", default=[], metavar="NAME=VALUE", help="set a Scrapy setting")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser("plan", help="queue the shards of a registry")
+    plan_parser.add_argument("registry")
+    plan_parser.add_argument("--pages", type=int, help="page count, read from the first page by default")
+    plan_parser.add_argument("--shard-pages", type=int, help="pages per shard (default: TANBA_SHARD_PAGES)")
+    plan_parser.add_argument("--page-size", help="page size as PARAM=SIZE (default: the size probed by the spider)")
+    work_parser = commands.add_parser("work", help="crawl shards until none is left")
+    work_parser.add_argument("--job", help="only crawl shards of this job")
+    work_parser.add_argument(
+        "--workers", type=int, default=1, help="workers sharing CONCURRENT_REQUESTS_PER_DOMAIN, at least (default: 1)"
+    )
+    commands.add_parser("status", help="shards of every job by state")
+    merge_parser = commands.add_parser("merge", help="combine the shards of a job into one CSV")
+    merge_parser.add_argument("job")
+    merge_parser.add_argument("-o", "--output", help="CSV file (default: <registry>.csv)")
+    merge_parser.add_argument("--partial", action="store_true", help="merge the done shards even if others aren't")
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    for option in args.set:
+        name, sep, value = option.partition("=")
+        if not sep:
+            parser.error(f"-s expects NAME=VALUE, got {option!r}")
+        settings.set(name, value, priority="cmdline")
+
+    if args.command == "work":
+        ShardWorker(settings, args.job, args.workers).run()
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s] %(levelname)s: %(message)s")
+    queue = ShardQueue(settings.get("TANBA_SHARD_QUEUE"))
+    try:
+        if args.command == "plan":
+            page_size = args.page_size
+            state_dir = settings.get("TANBA_STATE_DIR")
+            if page_size is None and state_dir:
+                try:
+                    probed = PageSizeCache(os.path.join(state_dir, f"{args.registry}.pagesize.json"), math.inf).load()
+                except KeyError:
+                    probed = None
+                if probed:
+                    page_size = f"{probed[0]}={probed[1]}"
+            pages = args.pages
+            if pages is None:
+                pages, truncated = count_pages(settings, args.registry, page_size)
+                if truncated:
+                    parser.error(f"The pagination of {args.registry} hides its last page, give --pages")
+            shard_pages = args.shard_pages or settings.getint("TANBA_SHARD_PAGES")
+            job = queue.plan(args.registry, pages, shard_pages, page_size)
+            print(f"{job}: {math.ceil(pages / shard_pages)} shards of {shard_pages} pages, {pages} pages in all")
+        elif args.command == "status":
+            for job, states in sorted(queue.status().items()):
+                print(job, " ".join(f"{state}={count}" for state, count in sorted(states.items())))
+        elif args.command == "merge":
+            if queue.job(args.job) is None:
+                parser.error(f"Unknown job {args.job}")
+            try:
+                merge(settings, queue, args.job, args.output or f"{queue.job(args.job)[0]}.csv", args.partial)
+            except ValueError as e:
+                sys.exit(str(e))
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,562 @@
+import csv
+import os
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import scrapy
+from scrapy import signals
+from scrapy.exceptions import CloseSpider, DontCloseSpider
+from scrapy.utils.response import get_base_url
+from w3lib.url import add_or_replace_parameter
+
+from tanba_scraper.dedup import FingerprintSet, fingerprint
+from tanba_scraper.drift import DriftReconciler
+from tanba_scraper.extractors import extract_pagination, extract_table
+from tanba_scraper.items import DetailItem, ListRowFilter
+from tanba_scraper.state import PageSizeCache, RowOrder, SeenKeyStore, row_key
+
+
+class TanbaSpider(scrapy.Spider):
+    """Base of all spiders, points them at TANBA_BASE_URL.
+
+    URLs of the live site in `start_urls` and `page_url` are moved to the
+    base URL, so the spiders can crawl a local stand-in of the registry
+    (benchmarks/server.py) instead.
+    """
+
+    allowed_domains = ["tanba.kezekte.kz"]
+    page_url = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.base_url = crawler.settings.get("TANBA_BASE_URL")
+        if spider.base_url:
+            spider.allowed_domains = [urlsplit(spider.base_url).hostname]
+            spider.start_urls = [spider.site_url(url) for url in getattr(spider, "start_urls", [])]
+            if spider.page_url:
+                spider.page_url = spider.site_url(spider.page_url)
+        return spider
+
+    async def start(self):
+        # Scrapy 2.13+ entry point, start_requests() is kept for older versions
+        for request in self.start_requests():
+            yield request
+
+    def csv_requests(self, path, column="Link"):
+        """Detail page requests for the URLs in a column of a list spider's CSV.
+
+        The file is read one row at a time as Scrapy asks for more start
+        requests, so large CSVs are never loaded into memory.
+        """
+        try:
+            with open(path, newline="", encoding="utf-8-sig") as f:
+                reader = csv.DictReader(f)
+                if column not in (reader.fieldnames or []):
+                    self.logger.error(f"No {column} column in {path}")
+                    return
+                for row in reader:
+                    if not row[column]:
+                        continue
+                    url = self.site_url(row[column])
+                    yield scrapy.Request(url=url, callback=self.parse_detail, meta={"url": url, "tanba_detail": True})
+        except (OSError, csv.Error) as e:
+            self.logger.error(f"Error reading {path}: {e}")
+
+    def extract_detail(self, response, extractor):
+        """DetailItems of a detail page, described by a DetailExtractor."""
+        context = {"url": response.url, "request_url": response.meta.get("url", response.url)}
+        result = extractor.extract(response.body, response.encoding, context)
+        if result is None:
+            self.logger.warning(f"No {extractor.root} found on {response.url}")
+            return
+        items, missing = result
+        if missing:
+            self.crawler.stats.inc_value("tanba_detail/missing_fields")
+            self.logger.warning(f"Missing {', '.join(missing)} on {response.url}")
+        for item in items:
+            yield DetailItem(item)
+
+    def site_url(self, url):
+        """Move a URL of the live site to TANBA_BASE_URL."""
+        if not self.base_url:
+            return url
+        base = urlsplit(self.base_url)
+        return urlunsplit(urlsplit(url)._replace(scheme=base.scheme, netloc=base.netloc))
+
+
+class RegistryListSpider(TanbaSpider):
+    """Shared logic for the paginated registry list spiders.
+
+    Subclasses set `name`, `start_urls`, `page_url` (with a `{page}`
+    placeholder) and `with_links` when the rows link to a detail page.
+    `key_fields` names the columns identifying a record; by default, or
+    when one of them is missing from the table or empty in a row, the
+    "Link" column or a hash of the whole row is used.
+
+    Spiders whose rows link to a detail spider also mix in that spider's
+    `parse_detail` and set `detail_feed` to its FEEDS. With
+    TANBA_FOLLOW_DETAILS every extracted Link is then requested right away
+    and the detail items go to the detail feed, in a single crawl.
+
+    Pages are requested TANBA_FRONTIER_WINDOW at a time, more as earlier
+    ones finish.
+
+    With TANBA_DRIFT_CHECK the page boundaries that shifted while the crawl
+    ran are refetched once all pages are done, see tanba_scraper/drift.py.
+
+    The rows of the first response are kept as page 1. With
+    TANBA_PAGE_SIZE_PROBE the first crawl of a registry tries the page size
+    parameters in TANBA_PAGE_SIZE_PARAMS and later crawls request pages of
+    the largest size that worked. When the pagination widget doesn't show the
+    last page, it is found by binary search.
+
+    With the spider arguments `first_page` and `last_page` only that range of
+    pages is crawled, at the page size given as `page_size=PARAM=SIZE` (the
+    site's default without it), with no probe, drift check or incremental
+    stop. The shard workers of tanba_scraper/shards.py run it this way.
+    """
+
+    with_links = False
+    key_fields = None
+    detail_feed = None
+    detail_priority = 10  # Detail pages go first so the frontier stays small
+
+    # Header row of the registry table, read from the first page and reused
+    # for every following page with the same header.
+    header_schema = None
+
+    @classmethod
+    def update_settings(cls, settings):
+        super().update_settings(settings)
+        if cls.detail_feed and settings.getbool("TANBA_FOLLOW_DETAILS"):
+            feeds = {uri: dict(options, item_filter=ListRowFilter) for uri, options in settings.getdict("FEEDS").items()}
+            for uri, options in cls.detail_feed.items():
+                feeds[uri] = dict(options, item_classes=[DetailItem])
+            settings.set("FEEDS", feeds, priority="spider")
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.follow_details = bool(cls.detail_feed) and crawler.settings.getbool("TANBA_FOLLOW_DETAILS")
+        state_dir = crawler.settings.get("TANBA_STATE_DIR")
+        spider.seen = SeenKeyStore(os.path.join(state_dir, f"{spider.name}.sqlite")) if state_dir else None
+        spider.incremental = crawler.settings.getbool("TANBA_INCREMENTAL") and spider.seen is not None
+        if crawler.settings.getbool("TANBA_INCREMENTAL") and not state_dir:
+            spider.logger.warning("TANBA_INCREMENTAL needs TANBA_STATE_DIR, crawling every page")
+        # Left by an incremental crawl that lost a page, so the next one
+        # walks every page instead of stopping at known rows
+        spider.incomplete_marker = os.path.join(state_dir, f"{spider.name}.incomplete") if state_dir else None
+        spider.walk_all = spider.incremental and os.path.exists(spider.incomplete_marker)
+        spider.dedup = None
+        if crawler.settings.getbool("TANBA_DEDUP"):
+            spill_path = os.path.join(state_dir, f"{spider.name}.dedup.sqlite") if state_dir else None
+            spider.dedup = FingerprintSet(crawler.settings.getint("TANBA_DEDUP_MEMORY_ITEMS"), spill_path)
+        spider.drift = None
+        if crawler.settings.getbool("TANBA_DRIFT_CHECK") and spider.dedup is not None and not spider.incremental:
+            # Refetched pages rely on the dedup to pass on only rows not
+            # extracted yet. Requests in flight together can reach the server
+            # in any order, hence the spread. The row order is kept for the
+            # boundary check of the next crawl.
+            order = RowOrder(os.path.join(state_dir, f"{spider.name}.order.sqlite")) if state_dir else None
+            spider.drift = DriftReconciler(
+                crawler.settings.getint("TANBA_DRIFT_MAX_ROUNDS"),
+                spread=crawler.settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN"),
+                order=order,
+            )
+        spider.page_sizes = None
+        spider.page_size = None  # (query parameter, rows per page)
+        spider.probe_page_size = False
+        if crawler.settings.getbool("TANBA_PAGE_SIZE_PROBE") and state_dir:
+            spider.page_sizes = PageSizeCache(
+                os.path.join(state_dir, f"{spider.name}.pagesize.json"),
+                crawler.settings.getfloat("TANBA_PAGE_SIZE_MAX_AGE"),
+            )
+            try:
+                spider.page_size = spider.page_sizes.load()
+            except KeyError:
+                spider.probe_page_size = True
+        spider.frontier_window = crawler.settings.getint("TANBA_FRONTIER_WINDOW")
+        spider.next_page = 2
+        spider.pages_in_flight = set()
+        crawler.signals.connect(spider.on_idle, signal=signals.spider_idle)
+        crawler.signals.connect(spider.request_dropped, signal=signals.request_dropped)
+        spider.start_response = None
+        spider.searched_pages = set()
+        spider.known_pages = 0
+        spider.last_page = 1
+        spider.shard = None
+        if kwargs.get("first_page"):
+            spider.shard = (int(kwargs["first_page"]), int(kwargs.get("last_page") or kwargs["first_page"]))
+            spider.incremental = False
+            spider.drift = None
+            spider.probe_page_size = False
+            spider.page_size = None
+            if kwargs.get("page_size"):
+                param, _, size = kwargs["page_size"].partition("=")
+                spider.page_size = (param, int(size))
+        return spider
+
+    def closed(self, reason):
+        if self.incremental and reason != "finished":
+            with open(self.incomplete_marker, "w", encoding="utf-8") as f:
+                f.write(reason)
+            self.logger.warning(f"Incremental crawl closed with {reason}, the next one walks every page")
+        elif reason == "finished" and self.shard is None and self.incomplete_marker \
+                and os.path.exists(self.incomplete_marker):
+            os.remove(self.incomplete_marker)  # every page was walked this time
+        if self.seen is not None:
+            self.seen.close()
+        if self.drift is not None and self.drift.order is not None:
+            if reason == "finished":
+                self.drift.order.commit()
+            self.drift.order.close()
+        if self.dedup is not None:
+            self.logger.info(f"Dedup kept {len(self.dedup)} distinct rows")
+            self.dedup.close()
+
+    def start_requests(self):
+        # With a known page size the first page is requested at that size
+        # right away, otherwise start_urls gives the first page.
+        if self.shard is not None:
+            self.next_page, self.last_page = self.shard
+            self.logger.info(f"Crawling pages {self.next_page}-{self.last_page}")
+            yield from self.fill_frontier()
+            return
+        if self.page_size is not None:
+            yield scrapy.Request(self.page_link(1), callback=self.parse, errback=self.start_failed, meta={"page": 1})
+            return
+        for url in self.start_urls:
+            yield scrapy.Request(url, callback=self.parse, errback=self.start_failed, meta={"page": 1})
+
+    def start_failed(self, failure):
+        # Every other page is found from the first one
+        self.logger.error(f"First page failed: {failure.value!r}")
+        raise CloseSpider("first_page_failed")
+
+    def page_link(self, page, page_size=None):
+        """URL of a page, with the page size parameter once one is known."""
+        url = self.page_url.format(page=page)
+        param, size = page_size or self.page_size or (None, None)
+        if param:
+            url = add_or_replace_parameter(url, param, str(size))
+        return url
+
+    def page_request(self, page):
+        return scrapy.Request(
+            url=self.page_link(page),
+            callback=self.parse_page,
+            errback=self.incremental_page_failed,
+            meta={"page": page},
+        )
+
+    def incremental_page_failed(self, failure):
+        # The pages of an incremental crawl are chained, so the crawl can't
+        # go on past one that failed
+        self.logger.error(f"Page {failure.request.meta['page']} failed: {failure.value!r}")
+        self.crawler.stats.inc_value("incremental/failed_pages")
+        raise CloseSpider("incremental_page_failed")
+
+    def fill_frontier(self):
+        """Request the next pages until TANBA_FRONTIER_WINDOW of them are in flight.
+
+        Pages are requested as earlier ones finish rather than all at once,
+        so the scheduler and dupefilter only ever hold a window of them.
+        """
+        while self.next_page <= self.last_page and (
+            not self.frontier_window or len(self.pages_in_flight) < self.frontier_window
+        ):
+            page = self.next_page
+            self.next_page += 1
+            if page in self.searched_pages:
+                continue  # crawled by the last page search already
+            self.pages_in_flight.add(page)
+            yield scrapy.Request(
+                url=self.page_link(page),
+                callback=self.parse_page,
+                errback=self.page_failed,
+                meta={"page": page, "frontier": True},
+            )
+
+    def page_failed(self, failure):
+        self.pages_in_flight.discard(failure.request.meta["page"])
+        self.logger.warning(f"Page {failure.request.meta['page']} failed: {failure.value!r}")
+        self.crawler.stats.inc_value("frontier/failed_pages")
+        yield from self.fill_frontier()
+
+    def request_dropped(self, request, spider):
+        # Dropped by the scheduler (e.g. the dupefilter), so neither the
+        # callback nor the errback frees its place in the window; the next
+        # page to finish or on_idle fills it
+        if spider is self and request.meta.get("frontier"):
+            self.pages_in_flight.discard(request.meta["page"])
+            self.crawler.stats.inc_value("frontier/dropped_pages")
+
+    def refetch_request(self, page):
+        """Request a page again for the drift check, bypassing the caches."""
+        return scrapy.Request(
+            url=self.page_link(page),
+            callback=self.parse_page,
+            meta={"page": page, "refetch": True, "dont_cache": True},
+            priority=self.detail_priority + 10,
+            dont_filter=True,
+        )
+
+    def on_idle(self, spider):
+        """Refill the page window if it ran dry, then run the drift check."""
+        if spider is not self:
+            return
+        requests = [] if self.incremental else list(self.fill_frontier())
+        if requests:
+            for request in requests:
+                self.crawler.engine.crawl(request)
+            raise DontCloseSpider
+        if self.drift is not None:
+            self.reconcile()
+
+    def reconcile(self):
+        """Schedule the next round of boundary refetches, if any."""
+        self.drift.last_page = self.last_page
+        pages = self.drift.next_round()
+        if pages:
+            self.logger.info(f"Drift check round {self.drift.rounds}: refetching pages {pages}")
+            self.crawler.stats.inc_value("drift/refetched_pages", len(pages))
+            for page in pages:
+                self.crawler.engine.crawl(self.refetch_request(page))
+            raise DontCloseSpider
+        if self.drift.rounds and self.drift.pages:
+            self.drift.pages = {}  # done, the check runs once per crawl
+            message = f"Drift check done: {self.drift.settled} boundaries settled"
+            if self.drift.unsettled:
+                self.logger.warning(f"{message}, gave up on the ones after pages {self.drift.unsettled}")
+            else:
+                self.logger.info(message)
+
+    def parse(self, response):
+        """Probes the page size if needed, then crawls the registry from its first page."""
+        if self.probe_page_size:
+            self.probe_page_size = False
+            table = self.extract(response)
+            if table is not None and table[1] and extract_pagination(response.body, response.encoding)[0] > 1:
+                self.start_response = response
+                params = self.settings.getlist("TANBA_PAGE_SIZE_PARAMS")
+                yield from self.next_probe(params, len(table[1]), table[1][0])
+                return
+        yield from self.discover(response)
+
+    def next_probe(self, params, page_size, first_row):
+        """Request the first page with the next page size parameter to try."""
+        if not params:
+            self.logger.info("No page size parameter is honoured, keeping the default page size")
+            self.page_sizes.save(None, None)
+            response, self.start_response = self.start_response, None
+            yield from self.discover(response)
+            return
+        size = self.settings.getint("TANBA_PAGE_SIZE_MAX")
+        yield scrapy.Request(
+            self.page_link(1, (params[0], size)),
+            callback=self.parse_probe,
+            errback=self.probe_failed,
+            meta={"page": 1, "params": params, "page_size": page_size, "first_row": first_row, "dont_cache": True},
+            dont_filter=True,
+        )
+
+    def parse_probe(self, response):
+        """Keep a page size parameter if it returns more rows in the same order."""
+        params = response.meta["params"]
+        table = self.extract(response)
+        rows = table[1] if table is not None else []
+        if len(rows) <= response.meta["page_size"] or rows[0] != response.meta["first_row"]:
+            yield from self.next_probe(params[1:], response.meta["page_size"], response.meta["first_row"])
+            return
+
+        # A short single page holds the whole registry, otherwise the row
+        # count is the largest size the site allows.
+        size = self.settings.getint("TANBA_PAGE_SIZE_MAX")
+        if extract_pagination(response.body, response.encoding)[0] > 1:
+            size = len(rows)
+        self.page_size = (params[0], size)
+        self.page_sizes.save(*self.page_size)
+        self.logger.info(f"Using {size} rows per page with the {params[0]!r} parameter")
+        self.start_response = None
+        yield from self.discover(response)
+
+    def probe_failed(self, failure):
+        meta = failure.request.meta
+        yield from self.next_probe(meta["params"][1:], meta["page_size"], meta["first_row"])
+
+    def discover(self, response):
+        """Pass on the rows of the first page and schedule the other pages."""
+        self.last_page, truncated = extract_pagination(response.body, response.encoding)
+        self.logger.info(f"Total pages found: {self.last_page}")
+        if self.incremental:
+            # Pages are fetched one after another so the crawl can stop as
+            # soon as it reaches rows that earlier runs already saved.
+            self.logger.info(f"Incremental crawl, {len(self.seen)} known rows")
+        yield from self.parse_page(response, page=1)
+        if not self.incremental:
+            yield from self.fill_frontier()
+        if truncated:
+            self.logger.info(f"Pagination stops at page {self.last_page}, searching for the last page")
+            yield self.search_request(self.last_page * 2, self.last_page, None)
+
+    def search_request(self, page, low, high):
+        return scrapy.Request(
+            url=self.page_link(page),
+            callback=self.parse_search,
+            errback=self.search_failed,
+            meta={"page": page, "low": low, "high": high},
+            priority=self.detail_priority,
+        )
+
+    def parse_search(self, response):
+        """Binary search for the last page that has rows, from the last one the widget shows."""
+        page, low, high = response.meta["page"], response.meta["low"], response.meta["high"]
+        table = self.extract(response)
+        if table is not None and table[1]:
+            low = page
+            if not self.incremental:
+                # The page is crawled already, keep its rows
+                self.searched_pages.add(page)
+                yield from self.parse_page(response, page=page)
+        else:
+            high = page
+        yield from self.next_search(low, high)
+
+    def search_failed(self, failure):
+        # Some sites answer pages past the end with an error status
+        meta = failure.request.meta
+        yield from self.next_search(meta["low"], meta["page"])
+
+    def next_search(self, low, high):
+        if high is None or high - low > 1:
+            yield self.search_request(low * 2 if high is None else (low + high) // 2, low, high)
+            return
+        if low > self.last_page:
+            self.logger.info(f"Last page found: {low}")
+            self.last_page = low
+            if not self.incremental:
+                yield from self.fill_frontier()
+
+    def extract(self, response):
+        if "tanba_table" in response.meta:
+            return response.meta["tanba_table"]  # parsed by ParsePoolMiddleware
+        base_url = get_base_url(response) if self.with_links else None
+        return extract_table(
+            response.body,
+            response.encoding,
+            base_url,
+            self.with_links,
+            region=self.settings.getbool("TANBA_TABLE_REGION_PARSING", True),
+        )
+
+    def parse_page(self, response, page=None):
+        """Extracts data from a table on each page."""
+        table = self.extract(response)
+        if response.meta.get("frontier") and page is None:
+            self.pages_in_flight.discard(response.meta["page"])
+            yield from self.fill_frontier()
+        page = page or response.meta["page"]
+        refetch = response.meta.get("refetch", False)
+        if refetch:
+            yield from self.follow_new_pages(response)
+        if table is None:
+            self.logger.warning(f"No table found on page {page}")
+            if refetch:
+                self.drift.record_fresh(page, [])
+            elif self.incremental:
+                yield from self.next_incremental_page(page, has_new_rows=True)
+            return
+
+        headers, rows = table
+        headers = self.cache_headers(headers, page)
+        items = [dict(zip(headers, values)) for values in rows]
+        if self.seen is None and self.dedup is None:
+            yield from self.emit(items)
+            return
+
+        keys = [row_key(item, self.key_fields) for item in items]
+        if self.dedup is not None:
+            page_keys = keys
+            items, keys = self.drop_duplicates(items, keys, page, log=not refetch)
+            if refetch:
+                self.drift.record_fresh(page, page_keys)
+                self.crawler.stats.inc_value("drift/recovered_rows", len(items))
+            elif self.drift is not None:
+                sent = time.monotonic() - response.meta.get("download_latency", 0)
+                self.drift.record(page, page_keys, sent, duplicates=len(page_keys) - len(keys))
+        if self.seen is None:
+            yield from self.emit(items)
+            return
+        if not self.incremental:
+            self.seen.add_many(keys)
+            yield from self.emit(items)
+            return
+
+        # In incremental mode only rows unknown to previous runs are exported
+        new_rows = [(key, item) for key, item in zip(keys, items) if key not in self.seen]
+        self.seen.add_many(key for key, _ in new_rows)
+        yield from self.emit(item for _, item in new_rows)
+        yield from self.next_incremental_page(page, has_new_rows=bool(new_rows))
+
+    def follow_new_pages(self, response):
+        """Crawl the pages added at the end of the registry since the crawl began."""
+        last_page, _ = extract_pagination(response.body, response.encoding)
+        if last_page > self.last_page:
+            self.logger.info(f"Registry grew from {self.last_page} to {last_page} pages during the crawl")
+            self.last_page = self.drift.last_page = last_page
+            yield from self.fill_frontier()
+
+    def drop_duplicates(self, items, keys, page, log=True):
+        """Drop rows already extracted from an earlier page of this crawl.
+
+        Rows shift between pages when records are added while the crawl runs,
+        so the same row can show up at the end of one page and the start of
+        the next.
+        """
+        kept_items, kept_keys = [], []
+        for item, key in zip(items, keys):
+            if self.dedup.add(fingerprint(key)):
+                kept_items.append(item)
+                kept_keys.append(key)
+        dropped = len(items) - len(kept_items)
+        if dropped and log:
+            self.logger.info(f"Dropped {dropped} duplicate rows on page {page}")
+            self.crawler.stats.inc_value("dedup/dropped", dropped)
+            self.crawler.stats.inc_value("dedup/pages_with_duplicates")
+        return kept_items, kept_keys
+
+    def emit(self, items):
+        """Yield rows, each followed by its detail page request when following details."""
+        for item in items:
+            yield item
+            if self.follow_details and item.get("Link"):
+                yield scrapy.Request(
+                    url=item["Link"],
+                    callback=self.parse_detail,
+                    meta={"url": item["Link"], "tanba_detail": True},
+                    priority=self.detail_priority,
+                )
+
+    def next_incremental_page(self, page, has_new_rows):
+        """Request the next page unless enough pages in a row held only known rows."""
+        self.known_pages = 0 if has_new_rows else self.known_pages + 1
+        stop_pages = self.settings.getint("TANBA_INCREMENTAL_STOP_PAGES", 3)
+        if self.known_pages >= stop_pages and not self.walk_all:
+            self.logger.info(f"Stopping at page {page}: {self.known_pages} pages with only known rows")
+        elif page < self.last_page:
+            yield self.page_request(page + 1)
+
+    def cache_headers(self, headers, page):
+        """Return the cached header schema if `headers` matches it."""
+        if self.header_schema is None:
+            self.header_schema = headers
+            missing = [field for field in self.key_fields or () if field not in headers]
+            if missing:
+                # Keyed by value then, like a registry without key_fields
+                self.logger.warning(f"Key columns {missing} not in the table header {headers}, keying rows by their values")
+                self.key_fields = None
+        elif headers != self.header_schema:
+            self.logger.warning(f"Table header changed on page {page}: {headers}")
+            return headers
+        return self.header_schema
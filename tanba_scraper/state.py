@@ -0,0 +1,197 @@
+# Local state kept between crawls of the same registry.
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def row_key(row, key_fields=None):
+    """Return a stable key for a scraped row.
+
+    Uses the given columns (or the detail page "Link" when there is one) and
+    falls back to a hash of all values for registries without a record link,
+    or when any key column is missing or empty in the row, so rows with a
+    partial key never collapse onto one.
+    """
+    if key_fields and all(row.get(field) for field in key_fields):
+        return "|".join(str(row.get(field, "")) for field in key_fields)
+    if row.get("Link"):
+        return row["Link"]
+    joined = "\x1f".join(f"{k}={v}" for k, v in row.items())
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+
+
+class SeenKeyStore:
+    """Row keys seen by previous runs of a registry, kept in a SQLite file."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)")
+
+    def __contains__(self, key):
+        return self.db.execute("SELECT 1 FROM seen WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def add_many(self, keys):
+        """Record keys and commit, so a crash never loses a finished page."""
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO seen (key) VALUES (?)", ((k,) for k in keys))
+
+    def close(self):
+        self.db.close()
+
+
+class RowOrder:
+    """Order of the row keys on the last finished crawl, kept in a SQLite file.
+
+    Pages are added as they're crawled and only replace the stored order on
+    `commit()`, so a crawl that didn't finish leaves the previous one in place.
+    A refetched page replaces the rows the main crawl got for it.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS ranks (key TEXT PRIMARY KEY, rank INTEGER NOT NULL)")
+        self.db.execute("DROP TABLE IF EXISTS pages")
+        self.db.execute(
+            "CREATE TABLE pages (page INTEGER, position INTEGER, key TEXT, fresh INTEGER, PRIMARY KEY (page, fresh, position))"
+        )
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM ranks").fetchone()[0]
+
+    def rank(self, key):
+        """Position of the key on the last finished crawl, or None for a new row."""
+        row = self.db.execute("SELECT rank FROM ranks WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def add_page(self, page, keys, fresh=False):
+        with self.db:
+            self.db.execute("DELETE FROM pages WHERE page = ? AND fresh = ?", (page, int(fresh)))
+            self.db.executemany(
+                "INSERT INTO pages VALUES (?, ?, ?, ?)",
+                ((page, position, key, int(fresh)) for position, key in enumerate(keys)),
+            )
+
+    def commit(self):
+        """Replace the stored order with the pages of this crawl."""
+        with self.db:
+            self.db.execute("DELETE FROM ranks")
+            self.db.execute(
+                """INSERT INTO ranks
+                SELECT key, ROW_NUMBER() OVER (ORDER BY first) FROM (
+                    SELECT key, MIN(page * 1000000 + position) AS first FROM pages AS p
+                    WHERE fresh = (SELECT MAX(fresh) FROM pages WHERE page = p.page)
+                    GROUP BY key
+                )"""
+            )
+            self.db.execute("DELETE FROM pages")
+
+    def close(self):
+        self.db.close()
+
+
+class PageSizeCache:
+    """Page size query parameter found by probing a registry, kept in a JSON file."""
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+
+    def load(self):
+        """Return (param, size), or None when the probe found nothing.
+
+        Raises KeyError when the registry hasn't been probed within `max_age`
+        seconds and should be probed again.
+        """
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            raise KeyError(self.path)
+        if time.time() - saved.get("probed_at", 0) > self.max_age:
+            raise KeyError(self.path)
+        if not saved.get("param"):
+            return None
+        return saved["param"], saved["size"]
+
+    def save(self, param, size):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"param": param, "size": size, "probed_at": time.time()}, f)
+
+
+class PageLedger:
+    """Checkpoint of a new_parsing.py run: which pages are done, failed or in flight.
+
+    Pages are only marked done together with the output file size after
+    their rows were flushed, so a resumed run can cut the file back to the
+    last complete flush and fetch everything after it again.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                page INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def start(self, total_pages, output_offset):
+        """Forget previous progress and start a new run."""
+        with self.db:
+            self.db.execute("DELETE FROM pages")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("total_pages", str(total_pages)), ("output_offset", str(output_offset))],
+            )
+
+    def mark(self, page, status):
+        """Record a page as "in_flight" or "failed"."""
+        with self.db:
+            self.db.execute(
+                """INSERT INTO pages VALUES (?, ?, ?, ?)
+                ON CONFLICT(page) DO UPDATE SET status = excluded.status,
+                    attempts = attempts + excluded.attempts, updated_at = excluded.updated_at""",
+                (page, status, 1 if status == "in_flight" else 0, time.time()),
+            )
+
+    def commit_flush(self, pages, output_offset):
+        """Mark flushed pages done and store the output size in one transaction."""
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                """INSERT INTO pages VALUES (?, 'done', 0, ?)
+                ON CONFLICT(page) DO UPDATE SET status = 'done', updated_at = excluded.updated_at""",
+                ((page, now) for page in pages),
+            )
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('output_offset', ?)", (str(output_offset),))
+
+    def pages_to_resume(self, total_pages):
+        """Pages never finished (missing or in flight) followed by failed ones."""
+        status = dict(self.db.execute("SELECT page, status FROM pages"))
+        missing = [p for p in range(1, total_pages + 1) if status.get(p) not in ("done", "failed")]
+        failed = [p for p in range(1, total_pages + 1) if status.get(p) == "failed"]
+        return missing + failed
+
+    def close(self):
+        self.db.close()
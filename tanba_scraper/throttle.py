@@ -0,0 +1,146 @@
+# Adaptive (AIMD) concurrency control shared by the Scrapy spiders and
+# new_parsing.py.
+#
+# The window grows by `increase` per window's worth of healthy responses and is
+# multiplied by `decrease` on 429/503, timeouts or a latency spike, like TCP
+# congestion control. At most one cut is made per window of responses so a
+# burst of errors from requests already in flight doesn't collapse it to 1.
+#
+# FairBudget caps the requests to one host across all crawls of a process
+# (HostBudgetDownloadHandler), handing freed slots to the registries in turn.
+
+import asyncio
+from collections import deque
+
+BACKOFF_STATUSES = (429, 503)
+
+
+class AimdController:
+    """Additive-increase / multiplicative-decrease concurrency window."""
+
+    def __init__(self, start=8, minimum=1, maximum=64, increase=1.0, decrease=0.5,
+                 latency_spike=3.0, latency_floor=0.5, max_error_rate=0.05, smoothing=0.1):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.window = float(min(max(start, minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_spike = latency_spike
+        self.latency_floor = latency_floor  # responses faster than this never count as a spike
+        self.max_error_rate = max_error_rate
+        self.smoothing = smoothing
+        self.latency = None  # moving average of healthy response latency
+        self.error_rate = 0.0
+        self.cuts = 0
+        self._since_cut = self.maximum  # allow an immediate first cut
+
+    @property
+    def limit(self):
+        """Current window as a whole number of requests."""
+        return max(self.minimum, int(self.window))
+
+    def record(self, status=None, latency=None):
+        """Feed one finished request (status None for a network error)."""
+        self._since_cut += 1
+        error = status is None or status >= 500 or status == 429
+        self.error_rate += self.smoothing * ((1.0 if error else 0.0) - self.error_rate)
+
+        if status is None or status in BACKOFF_STATUSES:
+            self._cut()
+            return self.limit
+
+        # Every answered request moves the average, spikes included, so it
+        # follows a lasting change of latency instead of cutting on each
+        # response after one. A spike is a jump above the updated average.
+        spike = False
+        if latency is not None and not error:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+                spike = latency > max(self.latency * self.latency_spike, self.latency_floor)
+        if spike:
+            self._cut()
+        elif not error and self.error_rate <= self.max_error_rate:
+            self.window = min(self.maximum, self.window + self.increase / self.window)
+        return self.limit
+
+    def _cut(self):
+        if self._since_cut < self.window:
+            return  # already cut for this window of responses
+        self.window = max(self.minimum, self.window * self.decrease)
+        self._since_cut = 0
+        self.cuts += 1
+
+
+class AsyncAimdLimiter:
+    """asyncio gate that keeps at most `controller.limit` requests in flight."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.in_flight = 0
+        self._waiters = deque()
+
+    async def acquire(self):
+        while self.in_flight >= self.controller.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def release(self, status=None, latency=None):
+        """Free a slot and report how the request went."""
+        self.in_flight -= 1
+        self.controller.record(status, latency)
+        free = self.controller.limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class FairBudget:
+    """asyncio gate sharing `limit` slots between users, such as registries.
+
+    While slots are free they are taken right away. Once the budget is used
+    up, waiting users are served round-robin as slots are released, so a
+    registry with a deep queue doesn't starve the others.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = {}  # user -> deque of futures, in the order users are served
+
+    async def acquire(self, user):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot was handed over just before the cancel
+            raise
+
+    def release(self):
+        """Free a slot, handing it to the next user in turn if any wait."""
+        while self._waiters:
+            user = next(iter(self._waiters))
+            queue = self._waiters.pop(user)
+            waiter = queue.popleft()
+            if queue:
+                self._waiters[user] = queue  # back of the line
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_use -= 1
+
+    def waiting(self, user=None):
+        """Number of acquires waiting, of one user or of all."""
+        if user is not None:
+            return len(self._waiters.get(user, ()))
+        return sum(len(queue) for queue in self._waiters.values())
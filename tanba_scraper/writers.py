@@ -0,0 +1,110 @@
+# Streaming row writers for new_parsing.py.
+#
+# Rows are appended to the CSV file as they arrive instead of going through a
+# pandas DataFrame per batch, so memory stays flat over a full-registry run.
+
+import csv
+import importlib.util
+import logging
+import os
+import time
+
+
+class SchemaError(ValueError):
+    """A page's table doesn't match the columns of the output file."""
+
+
+class RowWriter:
+    """Append rows with a fixed column schema to a CSV and optionally a Parquet file.
+
+    The schema is taken from the first page unless given up front. Rows are
+    buffered and written once `flush_rows` rows are waiting or `flush_seconds`
+    have passed since the last write.
+
+    `on_flush(pages, size)` is called after every write has reached the disk
+    with the page numbers it contained and the new CSV file size.
+    """
+
+    def __init__(self, csv_path, columns=None, parquet_path=None, flush_rows=5000, flush_seconds=30.0,
+                 on_flush=None):
+        if parquet_path and importlib.util.find_spec("pyarrow") is None:
+            raise RuntimeError("Parquet output needs pyarrow: pip install pyarrow")
+        self.csv_path = csv_path
+        self.columns = list(columns) if columns else None
+        self.parquet_path = parquet_path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.on_flush = on_flush
+        self.buffer = []
+        self.buffer_pages = []
+        self.written = 0
+        self.last_flush = time.monotonic()
+
+        # utf-8-sig only writes the BOM when the file is empty
+        self.file = open(csv_path, "a", newline="", encoding="utf-8-sig")
+        self.csv = csv.writer(self.file)
+        self.header_written = self.file.tell() > 0
+
+        self.parquet = None
+
+    def check(self, titles, rows):
+        """Raise SchemaError if a page doesn't fit the schema."""
+        if self.columns is None:
+            self.columns = list(titles)
+        elif list(titles) != self.columns:
+            raise SchemaError(f"Columns {titles} don't match {self.columns}")
+        width = len(self.columns)
+        for row in rows:
+            if len(row) != width:
+                raise SchemaError(f"Row has {len(row)} values, expected {width}: {row}")
+
+    def write_page(self, titles, rows, page=None):
+        """Validate and buffer one page of rows, flushing when a threshold is hit."""
+        self.check(titles, rows)
+        self.buffer.extend(rows)
+        if page is not None:
+            self.buffer_pages.append(page)
+        if len(self.buffer) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows to disk."""
+        self.last_flush = time.monotonic()
+        if not self.buffer and not self.buffer_pages:
+            return
+        if self.buffer:
+            if not self.header_written:
+                self.csv.writerow(self.columns)
+                self.header_written = True
+            self.csv.writerows(self.buffer)
+            if self.parquet_path:
+                self.write_row_group(self.buffer)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        if self.on_flush is not None:
+            self.on_flush(self.buffer_pages, self.file.buffer.tell())
+        self.written += len(self.buffer)
+        logging.info(f"Wrote {len(self.buffer)} rows to {self.csv_path}")
+        self.buffer = []
+        self.buffer_pages = []
+
+    def write_row_group(self, rows):
+        """Write rows as one Parquet row group of string columns."""
+        # Imported here since pyarrow is optional and slow to import
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.table(
+            {name: [row[i] for row in rows] for i, name in enumerate(self.columns)},
+            schema=pa.schema([(name, pa.string()) for name in self.columns]),
+        )
+        if self.parquet is None:
+            self.parquet = pq.ParquetWriter(self.parquet_path, table.schema, compression="zstd")
+        self.parquet.write_table(table)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self.parquet is not None:
+            self.parquet.close()
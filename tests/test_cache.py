@@ -0,0 +1,45 @@
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from tanba_scraper.middlewares import TanbaScraperDownloaderMiddleware
+
+BODY = b"<html><body><table id='guid-1'><tr><td>1</td></tr></table></body></html>"
+
+
+def crawl(tmp_path, requests):
+    """Pass the requests through a fresh middleware as one crawl, return the responses kept."""
+    crawler = get_crawler(Spider, {
+        "TANBA_CACHE_ENABLED": True,
+        "TANBA_CACHE_PATH": str(tmp_path / "cache.sqlite"),
+        "TANBA_CACHE_SKIP_UNCHANGED": True,
+    })
+    spider = Spider("kinolog")
+    middleware = TanbaScraperDownloaderMiddleware(crawler.settings, MemoryStatsCollector(crawler), crawler)
+    kept = []
+    for request in requests:
+        middleware.process_request(request, spider)
+        response = HtmlResponse(request.url, body=BODY, request=request)
+        try:
+            kept.append(middleware.process_response(request, response, spider))
+        except IgnoreRequest:
+            pass
+    middleware.cache.close()
+    return kept
+
+
+def list_pages():
+    return [Request(f"http://127.0.0.1/kinolog/list?p={page}", meta={"page": page}) for page in range(1, 4)]
+
+
+def test_second_list_crawl_keeps_every_page(tmp_path):
+    assert len(crawl(tmp_path, list_pages())) == 3
+    assert len(crawl(tmp_path, list_pages())) == 3
+
+
+def test_unchanged_detail_page_is_dropped(tmp_path):
+    detail = lambda: [Request("http://127.0.0.1/services/view/1", meta={"tanba_detail": True})]
+    assert len(crawl(tmp_path, detail())) == 1
+    assert crawl(tmp_path, detail()) == []
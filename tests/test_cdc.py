@@ -0,0 +1,33 @@
+import csv
+
+from tanba_scraper.cdc import ChangeCapture, has_key
+
+
+def crawl(directory, rows, buffer_rows=2):
+    capture = ChangeCapture(str(directory), buffer_rows)
+    for key, row in rows:
+        capture.add(key, row)
+    delta_path, counts = capture.close()
+    with open(delta_path, encoding="utf-8-sig", newline="") as f:
+        return list(csv.DictReader(f)), counts
+
+
+def test_repeated_key_keeps_last_crawled_row(tmp_path):
+    rows = [("a", {"v": "3"}), ("b", {"v": "1"}), ("a", {"v": "1"}), ("c", {"v": "1"}), ("a", {"v": "2"})]
+    delta, counts = crawl(tmp_path, rows)
+    assert {row["key"]: row["v"] for row in delta} == {"a": "2", "b": "1", "c": "1"}
+    assert counts["duplicate"] == 2
+
+
+def test_changed_row_is_an_update(tmp_path):
+    crawl(tmp_path, [("a", {"v": "1"}), ("b", {"v": "1"})])
+    delta, counts = crawl(tmp_path, [("a", {"v": "2"}), ("b", {"v": "1"})])
+    assert [(row["op"], row["key"], row["v"]) for row in delta] == [("update", "a", "2")]
+    assert counts["unchanged"] == 1
+
+
+def test_row_without_key_values_is_unkeyed():
+    assert has_key({"Link": "http://x/1"}, None)
+    assert has_key({"BIN": "1", "Address": "x"}, ["BIN", "Address"])
+    assert not has_key({"BIN": "1", "Address": ""}, ["BIN", "Address"])
+    assert not has_key({"Name": "x"}, None)
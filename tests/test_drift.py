@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from tanba_scraper.drift import DriftReconciler
+from tanba_scraper.state import RowOrder
+
+PAGE_SIZE = 10
+PAGES = 30
+
+
+def page_keys(registry, page):
+    return registry[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+
+
+def previous_order(tmp_path, registry):
+    order = RowOrder(str(tmp_path / "order.sqlite"))
+    for page in range(1, PAGES + 1):
+        order.add_page(page, page_keys(registry, page))
+    order.commit()
+    return order
+
+
+def crawl(drift, registry, change=None, seed=0):
+    """Crawl the pages in shuffled order, calling `change` halfway through.
+
+    Returns the keys passed on and the number of refetched pages.
+    """
+    requested = list(range(1, PAGES + 1))
+    random.Random(seed).shuffle(requested)
+    extracted = set()
+    for sent, page in enumerate(requested):
+        if change is not None and sent == len(requested) // 2:
+            change(registry)
+        keys = page_keys(registry, page)
+        drift.record(page, keys, sent, duplicates=len(extracted.intersection(keys)))
+        extracted.update(keys)
+    drift.last_page = PAGES
+    refetched = 0
+    while True:
+        pages = drift.next_round()
+        if not pages:
+            return extracted, refetched
+        for page in pages:
+            drift.record_fresh(page, page_keys(registry, page))
+            extracted.update(page_keys(registry, page))
+        refetched += len(pages)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_mid_registry_deletion_loses_no_row(tmp_path, seed):
+    registry = [f"row-{i:04d}" for i in range(PAGES * PAGE_SIZE)]
+    drift = DriftReconciler(spread=2, order=previous_order(tmp_path, registry))
+    position = random.Random(seed).randrange(PAGE_SIZE, len(registry) - PAGE_SIZE)
+    extracted, refetched = crawl(drift, registry, lambda rows: rows.pop(position), seed)
+    assert set(registry) <= extracted
+    assert refetched < PAGES
+    assert not drift.unsettled
+
+
+def test_unchanged_registry_refetches_nothing(tmp_path):
+    registry = [f"row-{i:04d}" for i in range(PAGES * PAGE_SIZE)]
+    drift = DriftReconciler(spread=2, order=previous_order(tmp_path, registry))
+    extracted, refetched = crawl(drift, registry)
+    assert extracted == set(registry)
+    assert refetched == 0
+
+
+def test_order_keeps_refetched_page(tmp_path):
+    order = RowOrder(str(tmp_path / "order.sqlite"))
+    order.add_page(1, ["a", "b"])
+    order.add_page(2, ["d", "e"])
+    order.add_page(2, ["c", "d"], fresh=True)
+    order.commit()
+    assert [order.rank(key) for key in "abcde"] == [1, 2, 3, 4, None]
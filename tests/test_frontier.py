@@ -0,0 +1,18 @@
+from scrapy.utils.test import get_crawler
+
+from tanba_scraper.spiders.kinolog import KinologSpider
+
+
+def test_dropped_page_frees_its_place_in_the_window():
+    crawler = get_crawler(KinologSpider, {"TANBA_FRONTIER_WINDOW": 2})
+    spider = KinologSpider.from_crawler(crawler)
+    spider.last_page = 10
+    first = list(spider.fill_frontier())
+    assert [r.meta["page"] for r in first] == [2, 3]
+    assert list(spider.fill_frontier()) == []
+
+    spider.request_dropped(first[0], spider)
+    assert [r.meta["page"] for r in spider.fill_frontier()] == [4]
+    # A drop after the page was already handled doesn't free a second place
+    spider.request_dropped(first[0], spider)
+    assert list(spider.fill_frontier()) == []
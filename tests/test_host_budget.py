@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from scrapy import Request, Spider
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from tanba_scraper.handlers import HostBudgetDownloadHandler, use_host_budget
+from tanba_scraper.throttle import FairBudget
+
+
+async def download(budget, user, served, started=0.0):
+    await asyncio.sleep(started)
+    await budget.acquire(user)
+    served.append(user)
+    await asyncio.sleep(0.01)
+    budget.release()
+
+
+def test_delayed_crawler_gets_its_turn():
+    async def run():
+        budget = FairBudget(4)
+        served = []
+        # "deep" queues 100 downloads at once, "late" only shows up once the
+        # budget is used up
+        tasks = [download(budget, "deep", served) for _ in range(100)]
+        tasks += [download(budget, "late", served, started=0.005) for _ in range(10)]
+        await asyncio.gather(*tasks)
+        return served
+
+    served = asyncio.run(run())
+    first_late = served.index("late")
+    assert first_late <= 8
+    # served in turn from then on
+    assert served[first_late:first_late + 20:2] == ["late"] * 10
+
+
+class FakeHandler:
+    def __init__(self, budget, fail=False):
+        self.budget = budget
+        self.fail = fail
+        self.in_use = []
+
+    async def download_request(self, request):
+        self.in_use.append(self.budget.in_use)
+        await asyncio.sleep(0)
+        if self.fail:
+            raise ConnectionError("reset")
+        return request.url
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_share_held_for_the_transfer_only(fail):
+    crawler = get_crawler(Spider, {"TANBA_HOST_BUDGET": 2})
+    crawler.spider = Spider("registry")
+    crawler.engine = type("Engine", (), {"running": True})()
+    handler = HostBudgetDownloadHandler.from_crawler(crawler)
+    budget = handler.budgets["budget.test"] = FairBudget(2)
+    handler.handlers["http"] = fake = FakeHandler(budget, fail)
+
+    async def run():
+        request = Request("http://budget.test/page")
+        if fail:
+            with pytest.raises(ConnectionError):
+                await handler.download_request(request)
+        else:
+            assert await handler.download_request(request) == request.url
+
+    asyncio.run(run())
+    assert fake.in_use == [1]
+    assert budget.in_use == 0
+
+
+def test_handler_only_installed_with_a_budget():
+    settings = Settings({"TANBA_HOST_BUDGET": 0})
+    assert not use_host_budget(settings)
+    assert "http" not in settings.getdict("DOWNLOAD_HANDLERS")
+    settings.set("TANBA_HOST_BUDGET", 8)
+    assert use_host_budget(settings)
+    assert settings.getdict("DOWNLOAD_HANDLERS")["https"].endswith("HostBudgetDownloadHandler")
@@ -0,0 +1,29 @@
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+ds = pytest.importorskip("pyarrow.dataset")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from tanba_scraper.pipelines import ParquetSink
+
+
+def run(directory, partition_by_month):
+    """One crawl of three flushes, the last one with a column seen first there."""
+    sink = ParquetSink("registry", str(directory), "zstd", partition_by_month)
+    sink.write([{"Дата": "01.02.2024", "Name": "a"}, {"Дата": "03.03.2024", "Name": "b"}])
+    sink.write([{"Дата": "04.02.2024", "Name": "c"}])
+    sink.write([{"Дата": "05.03.2024", "Name": "d", "Label": "new"}])
+    sink.close()
+
+
+@pytest.mark.parametrize("partition_by_month", [False, True])
+def test_second_run_replaces_the_first(tmp_path, partition_by_month):
+    run(tmp_path, partition_by_month)
+    run(tmp_path, partition_by_month)
+    if partition_by_month:
+        table = ds.dataset(str(tmp_path / "registry"), format="parquet", partitioning="hive").to_table()
+    else:
+        table = pq.read_table(str(tmp_path / "registry.parquet"))
+    assert table.num_rows == 4
+    assert table.column("Label").null_count == 3
+    assert not (tmp_path / ("registry.parquet.tmp" if not partition_by_month else "registry.tmp")).exists()
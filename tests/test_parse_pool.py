@@ -0,0 +1,54 @@
+import asyncio
+from concurrent.futures import Future
+
+from scrapy import Request, Spider
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from tanba_scraper.middlewares import ParsePoolMiddleware
+
+
+class HeldPool:
+    """Pool whose parses only finish when the test says so."""
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+
+def test_pages_past_the_waiting_ones_go_to_the_callback(monkeypatch):
+    crawler = get_crawler(Spider, {
+        "TANBA_PARSE_PROCESSES": 1,
+        "TANBA_PARSE_MAX_IN_FLIGHT": 1,
+        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor",
+    })
+    middleware = ParsePoolMiddleware.from_crawler(crawler)
+    spider = Spider("registry")
+    spider.with_links = False
+    pool = HeldPool()
+
+    async def run():
+        monkeypatch.setattr(ParsePoolMiddleware, "pool", pool)
+        monkeypatch.setattr(ParsePoolMiddleware, "in_flight", asyncio.Semaphore(1))
+        pages = []
+        for page in range(3):
+            request = Request(f"http://registry.test/?page={page}", meta={"page": page})
+            response = HtmlResponse(request.url, body=b"<table></table>", encoding="utf-8", request=request)
+            pages.append(asyncio.ensure_future(middleware.process_response(request, response, spider)))
+        await asyncio.sleep(0)
+        # One page in the pool, one waiting for it, the third one not held back
+        assert len(pool.futures) == 1
+        assert pages[2].done() and "tanba_table" not in pages[2].result().meta
+        for _ in range(2):
+            pool.futures[-1].set_result(([], []))
+            await asyncio.sleep(0.01)
+        return await asyncio.gather(*pages)
+
+    responses = asyncio.run(run())
+    assert ["tanba_table" in response.meta for response in responses] == [True, True, False]
+    assert crawler.stats.get_value("parse_pool/overflow") == 1
+    assert ParsePoolMiddleware.waiting == 0
@@ -0,0 +1,19 @@
+from tanba_scraper.state import row_key
+
+KEY_FIELDS = ["БИН", "Адрес"]
+
+
+def test_full_key_joins_the_key_columns():
+    assert row_key({"БИН": "123", "Адрес": "ул. Абая 1", "Наименование": "x"}, KEY_FIELDS) == "123|ул. Абая 1"
+
+
+def test_partial_key_falls_back_to_the_values():
+    first = {"БИН": "123", "Адрес": "", "Наименование": "Филиал 1"}
+    second = {"БИН": "123", "Адрес": "", "Наименование": "Филиал 2"}
+    assert row_key(first, KEY_FIELDS) != row_key(second, KEY_FIELDS)
+    assert row_key(first, KEY_FIELDS) == row_key(dict(first), KEY_FIELDS)
+    assert "|" not in row_key(first, KEY_FIELDS)
+
+
+def test_missing_key_column_uses_the_link():
+    assert row_key({"БИН": "123", "Link": "http://x/1"}, KEY_FIELDS) == "http://x/1"
@@ -0,0 +1,26 @@
+from tanba_scraper.throttle import AimdController
+
+
+def test_window_follows_lasting_latency_change():
+    controller = AimdController(start=8, maximum=16)
+    for _ in range(500):
+        controller.record(200, 0.2)
+    for _ in range(5000):
+        controller.record(200, 0.7)
+    assert controller.limit == 16
+    assert abs(controller.latency - 0.7) < 0.01
+
+
+def test_latency_spike_cuts_window():
+    controller = AimdController(start=8, maximum=16)
+    for _ in range(500):
+        controller.record(200, 0.2)
+    controller.record(200, 3.0)
+    assert controller.limit == 8
+    assert controller.cuts == 1
+
+
+def test_backoff_status_cuts_window():
+    controller = AimdController(start=8, maximum=8)
+    controller.record(429, 0.1)
+    assert controller.limit == 4